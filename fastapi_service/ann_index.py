@@ -0,0 +1,308 @@
+import math
+
+import numpy as np
+
+from face_index import FACE_DIM, FACE_THRESHOLD, SEARCH_BLOCK, FaceIndex
+
+# float16 list codes lose ~1e-3 per distance, widen the coarse cut by this much
+COARSE_MARGIN = 0.02
+
+# Below this many faces a flat scan is cheaper than training an IVF
+MIN_TRAIN_SIZE = 20000
+MAX_NLIST = 4096
+TRAIN_POINTS_PER_LIST = 64
+KMEANS_ITERATIONS = 10
+
+
+def default_nlist(size):
+    return int(min(MAX_NLIST, max(16, 4 * math.sqrt(size))))
+
+
+def kmeans(points, k, iterations=KMEANS_ITERATIONS, seed=0):
+    """Plain Lloyd's k-means, returns float32 centroids of shape (k, dim)."""
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points, dtype=np.float32)
+    centroids = points[rng.choice(len(points), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroids(centroids, points, 1)[:, 0]
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        order = np.argsort(assign, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        sums = np.add.reduceat(points[order], starts, axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        # Re-seed empty lists from random points so no centroid is wasted
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = points[rng.choice(len(points), size=len(empty), replace=False)]
+    return centroids
+
+
+def nearest_centroids(centroids, points, n):
+    """Indices of the `n` nearest centroids for each row of `points`."""
+    points = np.atleast_2d(points).astype(np.float32)
+    out = np.empty((len(points), n), dtype=np.int64)
+    c_sq = np.einsum("ij,ij->i", centroids, centroids)
+    for start in range(0, len(points), SEARCH_BLOCK):
+        block = points[start:start + SEARCH_BLOCK]
+        sq_dist = c_sq[None, :] - 2.0 * (block @ centroids.T)
+        if n == 1:
+            order = np.argmin(sq_dist, axis=1)[:, None]
+        elif n >= len(centroids):
+            order = np.argsort(sq_dist, axis=1)[:, :n]
+        else:
+            part = np.argpartition(sq_dist, n - 1, axis=1)[:, :n]
+            rank = np.argsort(np.take_along_axis(sq_dist, part, axis=1), axis=1)
+            order = np.take_along_axis(part, rank, axis=1)
+        out[start:start + len(block)] = order
+    return out
+
+
+class _InvertedList:
+    """One IVF cell: float16 codes plus voter ids, swap-delete like FaceIndex."""
+
+    def __init__(self, dim):
+        self.size = 0
+        self.codes = np.zeros((16, dim), dtype=np.float16)
+        self.voter_ids = np.zeros(16, dtype=np.int64)
+        self.rows = {}
+
+    def fill(self, voter_ids, vectors):
+        self.size = len(voter_ids)
+        capacity = max(16, 2 * self.size)
+        self.codes = np.zeros((capacity, self.codes.shape[1]), dtype=np.float16)
+        self.voter_ids = np.zeros(capacity, dtype=np.int64)
+        self.codes[:self.size] = vectors
+        self.voter_ids[:self.size] = voter_ids
+        self.rows = {voter_id: row for row, voter_id in enumerate(voter_ids.tolist())}
+
+    def add(self, voter_id, vector):
+        if self.size == len(self.voter_ids):
+            capacity = 2 * len(self.voter_ids)
+            codes = np.zeros((capacity, self.codes.shape[1]), dtype=np.float16)
+            voter_ids = np.zeros(capacity, dtype=np.int64)
+            codes[:self.size] = self.codes[:self.size]
+            voter_ids[:self.size] = self.voter_ids[:self.size]
+            self.codes, self.voter_ids = codes, voter_ids
+        self.codes[self.size] = vector
+        self.voter_ids[self.size] = voter_id
+        self.rows[voter_id] = self.size
+        self.size += 1
+
+    def remove(self, voter_id):
+        row = self.rows.pop(voter_id)
+        last = self.size - 1
+        if row != last:
+            moved = int(self.voter_ids[last])
+            self.codes[row] = self.codes[last]
+            self.voter_ids[row] = moved
+            self.rows[moved] = row
+        self.size = last
+
+    def scan(self, query, cutoff):
+        diff = self.codes[:self.size].astype(np.float32) - query
+        sq_dist = np.einsum("ij,ij->i", diff, diff)
+        hits = np.flatnonzero(sq_dist < cutoff)
+        return self.voter_ids[hits], np.sqrt(sq_dist[hits])
+
+
+class IVFFaceIndex:
+    """
+    Inverted-file index over face embeddings.
+
+    A k-means coarse quantizer splits the faces into `nlist` cells; a query
+    only scans the `nprobe` nearest cells using float16 codes. With `rerank`
+    the surviving candidates are re-scored against the exact float32
+    FaceIndex, so the reported distances and the 0.6 cut are identical to a
+    flat scan and only recall depends on `nprobe`.
+    """
+
+    def __init__(self, dim=FACE_DIM, nlist=None, nprobe=16, rerank=True,
+                 min_train_size=MIN_TRAIN_SIZE):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.min_train_size = min_train_size
+        self.exact = FaceIndex(dim)
+        self.centroids = None
+        self.lists = []
+        self.cell_of = {}  # voter_id -> list number
+
+    def __len__(self):
+        return len(self.exact)
+
+    def __contains__(self, voter_id):
+        return voter_id in self.exact
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def get(self, voter_id):
+        return self.exact.get(voter_id)
+
+    def add(self, voter_id, vector):
+        if voter_id in self.cell_of:
+            self.lists[self.cell_of.pop(voter_id)].remove(voter_id)
+        self.exact.add(voter_id, vector)
+        if self.trained:
+            self._assign(voter_id, self.exact.get(voter_id))
+        # Past min_train_size the owner trains it, see needs_training
+
+    @property
+    def needs_training(self):
+        return not self.trained and len(self.exact) >= self.min_train_size
+
+    def remove(self, voter_id):
+        cell = self.cell_of.pop(voter_id, None)
+        if cell is not None:
+            self.lists[cell].remove(voter_id)
+        return self.exact.remove(voter_id)
+
+    def _assign(self, voter_id, vector):
+        cell = int(nearest_centroids(self.centroids, vector, 1)[0, 0])
+        self.lists[cell].add(voter_id, vector)
+        self.cell_of[voter_id] = cell
+
+    def train(self, nlist=None, seed=0):
+        """(Re)build the coarse quantizer and re-file every stored face."""
+        sample, nlist = self.training_sample(nlist, seed)
+        if nlist:
+            self.install(kmeans(sample, nlist, seed=seed))
+
+    def training_sample(self, nlist=None, seed=0):
+        """
+        A copy of the faces to cluster and the number of cells. k-means on it
+        can run while the index keeps serving; install() then files every
+        face, including those added in the meantime.
+        """
+        size = len(self.exact)
+        nlist = min(nlist or self.nlist or default_nlist(size), size)
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(size, size=min(size, nlist * TRAIN_POINTS_PER_LIST), replace=False)
+        return self.exact.vectors[sample], nlist
+
+    def install(self, centroids):
+        """Use `centroids` as the coarse quantizer and re-file every stored face."""
+        size = len(self.exact)
+        nlist = len(centroids)
+        vectors = self.exact.vectors[:size]
+        cells = nearest_centroids(centroids, vectors, 1)[:, 0]
+        voter_ids = self.exact.voter_ids[:size]
+        order = np.argsort(cells, kind="stable")
+        bounds = np.searchsorted(cells[order], np.arange(nlist + 1))
+        self.lists = [_InvertedList(self.dim) for _ in range(nlist)]
+        for cell, inverted in enumerate(self.lists):
+            rows = order[bounds[cell]:bounds[cell + 1]]
+            inverted.fill(voter_ids[rows], vectors[rows])
+        self.cell_of = dict(zip(voter_ids.tolist(), cells.tolist()))
+        self.centroids = centroids
+
+    def search(self, vector, threshold=FACE_THRESHOLD, nprobe=None, rerank=None):
+        if not self.trained:
+            return self.exact.search(vector, threshold)
+        nprobe = min(nprobe or self.nprobe, len(self.lists))
+        rerank = self.rerank if rerank is None else rerank
+
+        query = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        cutoff = (threshold + COARSE_MARGIN) ** 2 if rerank else threshold ** 2
+        matches = []
+        for cell in nearest_centroids(self.centroids, query, nprobe)[0]:
+            inverted = self.lists[cell]
+            if inverted.size == 0:
+                continue
+            ids, distances = inverted.scan(query, cutoff)
+            matches.extend(zip(ids.tolist(), distances.tolist()))
+
+        if rerank and matches:
+            exact_query = np.asarray(vector, dtype=np.float64).reshape(self.dim)
+            ids = [voter_id for voter_id, _ in matches]
+            rows = np.stack([self.exact.get(voter_id) for voter_id in ids])
+            distances = np.linalg.norm(rows.astype(np.float64) - exact_query, axis=1)
+            matches = [(voter_id, float(d)) for voter_id, d in zip(ids, distances) if d < threshold]
+
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+
+class PartitionedFaceIndex:
+    """
+    One IVFFaceIndex per (state, constituency) so a duplicate check can be
+    limited to the region of the voter being registered. Searching without a
+    state fans out over every partition.
+    """
+
+    def __init__(self, **index_options):
+        self.index_options = index_options
+        self.partitions = {}  # (state, constituency) -> IVFFaceIndex
+        self.partition_of = {}  # voter_id -> (state, constituency)
+
+    def __len__(self):
+        return len(self.partition_of)
+
+    def __contains__(self, voter_id):
+        return voter_id in self.partition_of
+
+    @staticmethod
+    def key(state=None, constituency=None):
+        return (state or "").strip().lower(), (constituency or "").strip().lower()
+
+    def get(self, voter_id):
+        key = self.partition_of.get(voter_id)
+        if key is None:
+            return None
+        return self.partitions[key].get(voter_id)
+
+    def add(self, voter_id, vector, state=None, constituency=None):
+        key = self.key(state, constituency)
+        old = self.partition_of.get(voter_id)
+        if old is not None and old != key:
+            self.partitions[old].remove(voter_id)
+        if key not in self.partitions:
+            self.partitions[key] = IVFFaceIndex(**self.index_options)
+        self.partitions[key].add(voter_id, vector)
+        self.partition_of[voter_id] = key
+
+    def remove(self, voter_id):
+        key = self.partition_of.pop(voter_id, None)
+        if key is None:
+            return False
+        return self.partitions[key].remove(voter_id)
+
+    def select(self, state=None, constituency=None):
+        state_key, constituency_key = self.key(state, constituency)
+        for (s, c), index in self.partitions.items():
+            if state_key and s != state_key:
+                continue
+            if constituency_key and c != constituency_key:
+                continue
+            yield index
+
+    def search(self, vector, threshold=FACE_THRESHOLD, state=None, constituency=None,
+               nprobe=None, rerank=None):
+        matches = []
+        for index in self.select(state, constituency):
+            matches.extend(index.search(vector, threshold, nprobe=nprobe, rerank=rerank))
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+    def train(self):
+        for index in self.partitions.values():
+            if len(index):
+                index.train()
+
+    def stats(self):
+        return {
+            "faces": len(self),
+            "partitions": [
+                {
+                    "state": state,
+                    "constituency": constituency,
+                    "faces": len(index),
+                    "trained": index.trained,
+                    "nlist": len(index.lists),
+                }
+                for (state, constituency), index in self.partitions.items()
+            ],
+        }
@@ -0,0 +1,92 @@
+"""
+Recall vs latency report for the IVF face index.
+
+    python ann_report.py --size 200000 --nprobe 4 8 16 32
+    python ann_report.py --embeddings faces.npy --queries 500
+
+Recall is measured against the exact FaceIndex scan: the share of true
+matches under the threshold that the IVF search also returns.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ann_index import IVFFaceIndex, default_nlist
+from face_index import FACE_DIM, FACE_THRESHOLD
+
+
+def synthetic_embeddings(size, dim=FACE_DIM, seed=0):
+    # Faces cluster loosely around a few thousand "looks"
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.09, size=(max(1, size // 500), dim))
+    picks = rng.integers(0, len(centres), size=size)
+    return (centres[picks] + rng.normal(0, 0.04, size=(size, dim))).astype(np.float32)
+
+
+def make_queries(embeddings, count, seed=1):
+    # Half are near-duplicates of enrolled faces, half are fresh faces
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(embeddings), size=count)
+    queries = embeddings[rows] + rng.normal(0, 0.02, size=(count, embeddings.shape[1]))
+    fresh = synthetic_embeddings(count // 2, embeddings.shape[1], seed=seed + 1)
+    queries[:len(fresh)] = fresh
+    return queries
+
+
+def percentile_ms(samples, q):
+    return 1000.0 * float(np.percentile(samples, q))
+
+
+def run(embeddings, queries, nlist, nprobes, threshold=FACE_THRESHOLD):
+    index = IVFFaceIndex(dim=embeddings.shape[1], nlist=nlist, min_train_size=len(embeddings) + 1)
+    for voter_id, vector in enumerate(embeddings):
+        index.add(voter_id, vector)
+    started = time.perf_counter()
+    index.train()
+    print(f"faces={len(index)} nlist={len(index.lists)} train={time.perf_counter() - started:.1f}s")
+
+    truth, exact_times = [], []
+    for query in queries:
+        started = time.perf_counter()
+        truth.append({voter_id for voter_id, _ in index.exact.search(query, threshold)})
+        exact_times.append(time.perf_counter() - started)
+    print(f"{'exact':>14}  recall=1.000  p50={percentile_ms(exact_times, 50):7.2f}ms  "
+          f"p99={percentile_ms(exact_times, 99):7.2f}ms")
+
+    for nprobe in nprobes:
+        for rerank in (True, False):
+            found = expected = 0
+            times = []
+            for query, true_ids in zip(queries, truth):
+                started = time.perf_counter()
+                got = index.search(query, threshold, nprobe=nprobe, rerank=rerank)
+                times.append(time.perf_counter() - started)
+                found += len(true_ids & {voter_id for voter_id, _ in got})
+                expected += len(true_ids)
+            recall = found / expected if expected else 1.0
+            label = f"nprobe={nprobe}{'+rr' if rerank else ''}"
+            print(f"{label:>14}  recall={recall:.3f}  p50={percentile_ms(times, 50):7.2f}ms  "
+                  f"p99={percentile_ms(times, 99):7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--embeddings", help=".npy file of float32 embeddings, one row per face")
+    parser.add_argument("--size", type=int, default=100000, help="synthetic faces when no file is given")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--threshold", type=float, default=FACE_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.load(args.embeddings, mmap_mode="r").astype(np.float32)
+    else:
+        embeddings = synthetic_embeddings(args.size)
+    queries = make_queries(embeddings, args.queries)
+    run(embeddings, queries, args.nlist or default_nlist(len(embeddings)), args.nprobe, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+"""
+On-disk face embedding store shared by every uvicorn worker.
+
+    <root>/CURRENT                 number of the live generation
+    <root>/gen-000042/*.npy        compacted segment, memory-mapped read-only
+    <root>/gen-000042/faces.log    append-only adds/deletes since compaction
+    <root>/signatures.log          append-only signature registrations
+
+Workers map the segment with np.load(mmap_mode="r"), so every process shares
+the same page cache and startup is a handful of mmap calls plus a replay of
+the (short) log. Writes go to the log and to a small in-memory delta index;
+other workers pick them up by tailing the log on their next request.
+
+Compaction (`python embedding_store.py compact`) runs as a separate process:
+it merges segment + log into a new generation, clusters each partition into
+IVF cells laid out contiguously on disk and flips CURRENT.
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import struct
+import threading
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from ann_index import (MIN_TRAIN_SIZE, TRAIN_POINTS_PER_LIST, PartitionedFaceIndex,
+                       default_nlist, kmeans, nearest_centroids)
+from face_index import FACE_DIM, FACE_THRESHOLD, scan_block
+
+FRAME = struct.Struct("<I")
+FACE_RECORD = struct.Struct("<BqH")
+OP_ADD = 1
+OP_REMOVE = 2
+
+SEGMENT_ARRAYS = ("vectors", "sq_norms", "voter_ids", "sorted_ids", "id_order",
+                  "cell_offsets", "centroids")
+
+
+class AppendLog:
+    """
+    Length-prefixed records appended with O_APPEND, so concurrent writers
+    from several processes never interleave inside a record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self.offset = 0  # bytes of the log this process has applied
+
+    def close(self):
+        os.close(self.fd)
+
+    def size(self):
+        return os.fstat(self.fd).st_size
+
+    def append(self, payload):
+        frame = FRAME.pack(len(payload)) + payload
+        os.write(self.fd, frame)
+        end = os.lseek(self.fd, 0, os.SEEK_CUR)
+        # Nobody else wrote since our last read: our own record is applied
+        if end - len(frame) == self.offset:
+            self.offset = end
+
+    def read_new(self):
+        size = self.size()
+        if size <= self.offset:
+            return []
+        data = os.pread(self.fd, size - self.offset, self.offset)
+        records, pos = [], 0
+        while pos + FRAME.size <= len(data):
+            (length,) = FRAME.unpack_from(data, pos)
+            end = pos + FRAME.size + length
+            if end > len(data):
+                break  # record still being written, pick it up next time
+            records.append(data[pos + FRAME.size:end])
+            pos = end
+        self.offset += pos
+        return records
+
+
+def partition_key(state=None, constituency=None):
+    return PartitionedFaceIndex.key(state, constituency)
+
+
+def encode_face_record(op, voter_id, key=("", ""), vector=None):
+    if op == OP_REMOVE:
+        return FACE_RECORD.pack(op, voter_id, 0)
+    key_bytes = "\x1f".join(key).encode("utf-8")
+    return (FACE_RECORD.pack(op, voter_id, len(key_bytes)) + key_bytes
+            + np.asarray(vector, dtype=np.float32).tobytes())
+
+
+def decode_face_record(payload):
+    op, voter_id, key_length = FACE_RECORD.unpack_from(payload)
+    if op == OP_REMOVE:
+        return op, voter_id, None, None
+    start = FACE_RECORD.size
+    key = tuple(payload[start:start + key_length].decode("utf-8").split("\x1f"))
+    vector = np.frombuffer(payload, dtype=np.float32, offset=start + key_length)
+    return op, voter_id, key, vector
+
+
+class FaceSegment:
+    """
+    Read-only compacted faces. Rows are grouped by partition and, inside a
+    partition, by IVF cell, so a probed cell is one contiguous mmap slice.
+    """
+
+    def __init__(self, path=None, dim=FACE_DIM):
+        self.dim = dim
+        self.partitions = {}  # (state, constituency) -> (first cell, last cell + 1)
+        self.deleted = None  # bool mask, allocated on the first delete
+        self.deleted_count = 0
+        if path is None:
+            self.vectors = np.zeros((0, dim), dtype=np.float32)
+            self.sq_norms = np.zeros(0, dtype=np.float32)
+            self.voter_ids = self.sorted_ids = self.id_order = np.zeros(0, dtype=np.int64)
+            self.cell_offsets = np.zeros(1, dtype=np.int64)
+            self.centroids = np.zeros((0, dim), dtype=np.float32)
+            return
+        for name in SEGMENT_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        with open(os.path.join(path, "partitions.json")) as f:
+            for entry in json.load(f):
+                self.partitions[(entry["state"], entry["constituency"])] = tuple(entry["cells"])
+
+    def __len__(self):
+        return len(self.voter_ids) - self.deleted_count
+
+    def row_of(self, voter_id):
+        pos = int(np.searchsorted(self.sorted_ids, voter_id))
+        if pos == len(self.sorted_ids) or self.sorted_ids[pos] != voter_id:
+            return None
+        row = int(self.id_order[pos])
+        if self.deleted is not None and self.deleted[row]:
+            return None
+        return row
+
+    def get(self, voter_id):
+        row = self.row_of(voter_id)
+        return None if row is None else self.vectors[row]
+
+    def delete(self, voter_id):
+        row = self.row_of(voter_id)
+        if row is None:
+            return False
+        if self.deleted is None:
+            self.deleted = np.zeros(len(self.voter_ids), dtype=bool)
+        self.deleted[row] = True
+        self.deleted_count += 1
+        return True
+
+    def rows(self, key):
+        first, last = self.partitions[key]
+        return int(self.cell_offsets[first]), int(self.cell_offsets[last])
+
+    def live(self, key):
+        """(voter_ids, vectors) of the partition without deleted rows."""
+        start, stop = self.rows(key)
+        keep = slice(None) if self.deleted is None else ~self.deleted[start:stop]
+        return self.voter_ids[start:stop][keep], self.vectors[start:stop][keep]
+
+    def search(self, vector, keys, threshold=FACE_THRESHOLD, nprobe=16):
+        query = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        matches = []
+        for key in keys:
+            first, last = self.partitions[key]
+            probe = min(nprobe, last - first)
+            cells = nearest_centroids(self.centroids[first:last], query, probe)[0] + first
+            for cell in cells:
+                start, stop = int(self.cell_offsets[cell]), int(self.cell_offsets[cell + 1])
+                if start == stop:
+                    continue
+                skip = None if self.deleted is None else self.deleted[start:stop]
+                matches.extend(scan_block(self.vectors[start:stop], self.sq_norms[start:stop],
+                                          self.voter_ids[start:stop], vector, threshold, skip))
+        return matches
+
+
+def write_segment(path, partitions, total, dim=FACE_DIM, seed=0):
+    """
+    Write a segment directory from an iterable of
+    ((state, constituency), voter_ids, vectors), one partition at a time so
+    only a single partition is ever held in memory.
+    """
+    os.makedirs(path)
+    vectors_out = open_memmap(os.path.join(path, "vectors.npy"), mode="w+",
+                              dtype=np.float32, shape=(total, dim))
+    voter_ids_out = np.zeros(total, dtype=np.int64)
+    sq_norms_out = np.zeros(total, dtype=np.float32)
+    cell_offsets = [0]
+    centroids = []
+    index = []
+    row = 0
+    for (state, constituency), voter_ids, vectors in partitions:
+        if len(voter_ids) == 0:
+            continue
+        vectors = np.asarray(vectors, dtype=np.float32)
+        size = len(voter_ids)
+        if size < MIN_TRAIN_SIZE:
+            cells = np.zeros(size, dtype=np.int64)
+            partition_centroids = vectors.mean(axis=0, keepdims=True)
+        else:
+            nlist = default_nlist(size)
+            rng = np.random.default_rng(seed)
+            sample = rng.choice(size, size=min(size, nlist * TRAIN_POINTS_PER_LIST), replace=False)
+            partition_centroids = kmeans(vectors[sample], nlist, seed=seed)
+            cells = nearest_centroids(partition_centroids, vectors, 1)[:, 0]
+        order = np.argsort(cells, kind="stable")
+        counts = np.bincount(cells, minlength=len(partition_centroids))
+
+        vectors_out[row:row + size] = vectors[order]
+        voter_ids_out[row:row + size] = np.asarray(voter_ids)[order]
+        sq_norms_out[row:row + size] = np.einsum("ij,ij->i", vectors[order], vectors[order])
+        first_cell = len(cell_offsets) - 1
+        cell_offsets.extend((row + np.cumsum(counts)).tolist())
+        centroids.append(partition_centroids)
+        index.append({"state": state, "constituency": constituency,
+                      "cells": [first_cell, len(cell_offsets) - 1]})
+        row += size
+
+    vectors_out.flush()
+    del vectors_out
+    id_order = np.argsort(voter_ids_out[:row], kind="stable")
+    arrays = {
+        "sq_norms": sq_norms_out[:row],
+        "voter_ids": voter_ids_out[:row],
+        "sorted_ids": voter_ids_out[:row][id_order],
+        "id_order": id_order,
+        "cell_offsets": np.asarray(cell_offsets, dtype=np.int64),
+        "centroids": (np.concatenate(centroids) if centroids
+                      else np.zeros((0, dim), dtype=np.float32)),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    if row != total:
+        # Fewer rows than announced (empty partitions): trim the vectors file
+        trimmed = np.array(np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")[:row])
+        np.save(os.path.join(path, "vectors.npy"), trimmed)
+    with open(os.path.join(path, "partitions.json"), "w") as f:
+        json.dump(index, f)
+
+
+class FaceStore:
+    """
+    Segment + delta view of every registered face. Same add / remove /
+    search / get interface as PartitionedFaceIndex.
+    """
+
+    def __init__(self, root, dim=FACE_DIM, nprobe=16, rerank=True):
+        self.root = root
+        self.dim = dim
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.generation = None
+        self._lock = threading.RLock()
+        os.makedirs(root, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(root, "LOCK"), os.O_RDWR | os.O_CREAT, 0o644)
+        self._open_generation()
+
+    def _gen_dir(self, generation):
+        return os.path.join(self.root, f"gen-{generation:06d}")
+
+    def _current(self):
+        try:
+            with open(os.path.join(self.root, "CURRENT")) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _open_generation(self):
+        generation = self._current()
+        gen_dir = self._gen_dir(generation)
+        os.makedirs(gen_dir, exist_ok=True)
+        has_segment = os.path.exists(os.path.join(gen_dir, "partitions.json"))
+        if self.generation is not None:
+            self.log.close()
+        self.segment = FaceSegment(gen_dir if has_segment else None, self.dim)
+        self.delta = PartitionedFaceIndex(dim=self.dim, nprobe=self.nprobe, rerank=self.rerank)
+        self.log = AppendLog(os.path.join(gen_dir, "faces.log"))
+        self.generation = generation
+        self._apply(self.log.read_new())
+
+    def refresh(self):
+        """Pick up a new generation or records appended by other workers."""
+        with self._lock:
+            if self._current() != self.generation:
+                self._open_generation()
+            else:
+                self._apply(self.log.read_new())
+
+    def _apply(self, records):
+        for payload in records:
+            op, voter_id, key, vector = decode_face_record(payload)
+            if op == OP_ADD:
+                self._add(voter_id, vector, key)
+            else:
+                self._remove(voter_id)
+
+    def _add(self, voter_id, vector, key):
+        self.segment.delete(voter_id)
+        self.delta.add(voter_id, vector, state=key[0], constituency=key[1])
+
+    def _remove(self, voter_id):
+        in_segment = self.segment.delete(voter_id)
+        return self.delta.remove(voter_id) or in_segment
+
+    def _write(self, payload):
+        # Shared lock: many writers at once, but never during a generation flip
+        fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+        try:
+            self.refresh()
+            self.log.append(payload)
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def add(self, voter_id, vector, state=None, constituency=None):
+        key = partition_key(state, constituency)
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        with self._lock:
+            self._write(encode_face_record(OP_ADD, voter_id, key, vector))
+            self._add(voter_id, vector, key)
+
+    def remove(self, voter_id):
+        with self._lock:
+            self.refresh()
+            if voter_id not in self:
+                return False
+            self._write(encode_face_record(OP_REMOVE, voter_id))
+            return self._remove(voter_id)
+
+    def __len__(self):
+        return len(self.segment) + len(self.delta)
+
+    def __contains__(self, voter_id):
+        return voter_id in self.delta or self.segment.row_of(voter_id) is not None
+
+    def get(self, voter_id):
+        vector = self.delta.get(voter_id)
+        return self.segment.get(voter_id) if vector is None else vector
+
+    def verify(self, voter_id, vector):
+        """1:1 distance to one stored embedding, None if not registered."""
+        self.refresh()
+        stored = self.get(voter_id)
+        if stored is None:
+            return None
+        return float(np.linalg.norm(np.asarray(stored, dtype=np.float64) - vector))
+
+    def search(self, vector, threshold=FACE_THRESHOLD, state=None, constituency=None,
+               nprobe=None, rerank=None):
+        self.refresh()
+        state_key, constituency_key = partition_key(state, constituency)
+        keys = [(s, c) for s, c in self.segment.partitions
+                if (not state_key or s == state_key)
+                and (not constituency_key or c == constituency_key)]
+        with self._lock:
+            matches = self.segment.search(vector, keys, threshold, nprobe or self.nprobe)
+            matches.extend(self.delta.search(vector, threshold, state=state, constituency=constituency,
+                                             nprobe=nprobe, rerank=rerank))
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+    def needs_training(self):
+        return any(index.needs_training for index in self.delta.partitions.values())
+
+    def train(self, pending_only=False):
+        """
+        Cluster the delta partitions, or with pending_only just those that
+        grew past MIN_TRAIN_SIZE. k-means runs outside the lock so searches
+        and adds go on meanwhile; only filing the faces into cells holds it.
+        """
+        with self._lock:
+            jobs = [(index, *index.training_sample()) for index in self.delta.partitions.values()
+                    if len(index) and (index.needs_training or not pending_only)]
+        for index, sample, nlist in jobs:
+            centroids = kmeans(sample, nlist)
+            with self._lock:
+                index.install(centroids)
+
+    def stats(self):
+        self.refresh()
+        stats = self.delta.stats()
+        stats.update({
+            "faces": len(self),
+            "generation": self.generation,
+            "segment_faces": len(self.segment),
+            "segment_partitions": len(self.segment.partitions),
+            "delta_faces": len(self.delta),
+            "log_bytes": self.log.size(),
+        })
+        return stats
+
+    def entries(self):
+        """Yield ((state, constituency), voter_ids, vectors) for every live face."""
+        keys = set(self.segment.partitions) | set(self.delta.partitions)
+        for key in sorted(keys):
+            voter_ids, vectors = [], []
+            if key in self.segment.partitions:
+                ids, vecs = self.segment.live(key)
+                voter_ids.append(np.asarray(ids))
+                vectors.append(np.asarray(vecs))
+            index = self.delta.partitions.get(key)
+            if index is not None and len(index):
+                voter_ids.append(index.exact.voter_ids[:index.exact.size].copy())
+                vectors.append(index.exact.vectors[:index.exact.size].copy())
+            if voter_ids:
+                yield key, np.concatenate(voter_ids), np.concatenate(vectors)
+
+    def publish(self, partitions, total, carry_from):
+        """
+        Write `partitions` as the next generation and make it live. Log
+        records past byte `carry_from` of the current log were not part of
+        the snapshot and are carried over into the new generation's log.
+        """
+        generation = self.generation + 1
+        gen_dir = self._gen_dir(generation)
+        tmp_dir = gen_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        write_segment(tmp_dir, partitions, total, self.dim)
+
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            tail = os.pread(self.log.fd, max(0, self.log.size() - carry_from), carry_from)
+            with open(os.path.join(tmp_dir, "faces.log"), "wb") as f:
+                f.write(tail)
+            os.rename(tmp_dir, gen_dir)
+            current_tmp = os.path.join(self.root, "CURRENT.tmp")
+            with open(current_tmp, "w") as f:
+                f.write(str(generation))
+            os.replace(current_tmp, os.path.join(self.root, "CURRENT"))
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+        self.refresh()
+        # Workers still mapping older generations keep their open files
+        for name in os.listdir(self.root):
+            if name.startswith("gen-") and name < os.path.basename(gen_dir):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def compact(self):
+        with self._lock:
+            self.refresh()
+            self.publish(self.entries(), len(self), self.log.offset)
+
+
+class SignatureRegistry:
+    """
+    voter_id -> (signature image path, perceptual hash), persisted in an
+    append-only JSON log. Hashes let a new worker build its prefilter index
+    without opening a single image.
+    """
+
+    def __init__(self, root):
+        self.dir = os.path.join(root, "signatures")
+        os.makedirs(self.dir, exist_ok=True)
+        self.paths = {}
+        self.hashes = {}
+        self.log = AppendLog(os.path.join(root, "signatures.log"))
+        self.refresh()
+
+    def refresh(self):
+        """Apply records written by other workers, return the voter_ids touched."""
+        changed = []
+        for payload in self.log.read_new():
+            record = json.loads(payload)
+            voter_id = record["voter_id"]
+            if record.get("path"):
+                self.paths[voter_id] = record["path"]
+                self.hashes[voter_id] = record.get("phash")
+            else:
+                self.paths.pop(voter_id, None)
+                self.hashes.pop(voter_id, None)
+            changed.append(voter_id)
+        return changed
+
+    def add(self, voter_id, filename, data, phash=None):
+        ext = os.path.splitext(filename or "")[1] or ".png"
+        path = os.path.join(self.dir, f"{voter_id}{ext}")
+        with open(path, "wb") as f:
+            f.write(data)
+        self.set(voter_id, path, phash)
+        return path
+
+    def set(self, voter_id, path, phash=None):
+        self.log.append(json.dumps({"voter_id": voter_id, "path": path, "phash": phash}).encode())
+        self.paths[voter_id] = path
+        self.hashes[voter_id] = phash
+
+    def items(self):
+        self.refresh()
+        return list(self.paths.items())
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the ML service embedding store")
+    parser.add_argument("command", choices=["compact", "stats"])
+    parser.add_argument("--root", default=os.environ.get("ML_STORE_DIR", "ml_store"))
+    args = parser.parse_args()
+
+    store = FaceStore(args.root)
+    if args.command == "compact":
+        store.compact()
+    print(json.dumps({k: v for k, v in store.stats().items() if k != "partitions"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
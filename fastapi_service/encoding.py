@@ -0,0 +1,67 @@
+"""
+CPU-bound work that runs inside the process pool. Everything here must be a
+top-level function taking and returning plain picklable values.
+"""
+import io
+
+import cv2
+import face_recognition
+import numpy as np
+from skimage.io import imread
+from skimage.metrics import structural_similarity as ssim
+
+from fingerprint_index import FP_DESCRIPTORS, make_template
+from signature_index import normalize_signature, phash
+
+
+def encode_face(data):
+    """Decode an image and return (embedding, error) for its first face."""
+    try:
+        img = face_recognition.load_image_file(io.BytesIO(data))
+    except Exception as e:
+        return None, f"Unreadable image: {e}"
+    encodings = face_recognition.face_encodings(img)
+    if len(encodings) == 0:
+        return None, "No face found"
+    return encodings[0], None
+
+
+def prepare_signature(data):
+    """Normalized grayscale array and perceptual hash of an uploaded signature."""
+    normalized = normalize_signature(imread(io.BytesIO(data)))
+    return normalized, phash(normalized)
+
+
+def load_signatures(items):
+    """[(voter_id, path)] -> [(voter_id, normalized, hash)], unreadable files skipped."""
+    loaded = []
+    for voter_id, path in items:
+        try:
+            normalized = normalize_signature(imread(path))
+        except Exception:
+            continue
+        loaded.append((voter_id, normalized, phash(normalized)))
+    return loaded
+
+
+def hash_signatures(items):
+    return [(voter_id, signature_hash) for voter_id, _, signature_hash in load_signatures(items)]
+
+
+def ssim_scores(query, candidates):
+    """SSIM of a normalized signature against [(voter_id, normalized)]."""
+    return [(voter_id, float(ssim(query, known))) for voter_id, known in candidates]
+
+
+def extract_fingerprint(data):
+    """Decode a fingerprint image and return (template, error)."""
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None, "Unreadable image"
+    scale = 320 / max(img.shape)
+    img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    img = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(img)
+    _, descriptors = cv2.ORB_create(nfeatures=FP_DESCRIPTORS).detectAndCompute(img, None)
+    if descriptors is None or len(descriptors) == 0:
+        return None, "No fingerprint features found"
+    return make_template(descriptors), None
@@ -0,0 +1,116 @@
+"""
+Runs CPU-bound ML stages in a process pool with admission control, so the
+event loop only does I/O.
+
+Index lookups and registrations need the in-memory stores of this worker,
+so they run in a thread pool instead (`local=True`). They go through the
+same admission slots and deadline as the process jobs.
+
+Admission is bounded: at most `workers` jobs run and `max_queue` wait. When
+the queue is full a request is shed with 429; when the expected wait already
+exceeds its deadline, or it runs past the deadline, it is shed with 503.
+A job still waiting in the pool when its deadline passes is cancelled and
+never occupies a worker.
+"""
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class Overloaded(Exception):
+    """Admission queue is full (429)."""
+
+
+class DeadlineExceeded(Exception):
+    """The request would not, or did not, finish within its deadline (503)."""
+
+
+def _timed(fn, *args):
+    # Runs in the worker: report pure service time, without queueing
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+class MLExecutor:
+    def __init__(self, workers, max_queue, deadline):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ml-local")
+        self.inflight = 0
+        self.avg_service = 0.0  # EWMA of seconds per job
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0,
+                         "rejected_full": 0, "rejected_deadline": 0, "timed_out": 0}
+        self._slot_free = None
+
+    @property
+    def capacity(self):
+        return self.workers + self.max_queue
+
+    def expected_wait(self):
+        queued = max(0, self.inflight - self.workers + 1)
+        return queued * self.avg_service / self.workers
+
+    def _release(self, future, local):
+        self.inflight -= 1
+        # Only pool jobs feed the service time estimate, index lookups would drag it down
+        if not local and not future.cancelled() and future.exception() is None:
+            elapsed = future.result()[1]
+            self.avg_service = elapsed if self.avg_service == 0 else 0.9 * self.avg_service + 0.1 * elapsed
+        if self._slot_free is not None:
+            self._slot_free.set()
+
+    async def run(self, fn, *args, deadline=None, wait=False, local=False):
+        """
+        Run `fn(*args)` in the pool, or in a thread of this process with
+        local=True. Interactive callers are rejected when the queue is full;
+        bulk callers pass wait=True to block for a free slot.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        if self.inflight >= self.capacity:
+            if not wait:
+                self.counters["rejected_full"] += 1
+                raise Overloaded()
+            if self._slot_free is None:
+                self._slot_free = asyncio.Event()
+            while self.inflight >= self.capacity:
+                self._slot_free.clear()
+                await self._slot_free.wait()
+        elif deadline and self.expected_wait() > deadline:
+            self.counters["rejected_deadline"] += 1
+            raise DeadlineExceeded()
+
+        loop = asyncio.get_running_loop()
+        self.inflight += 1
+        self.counters["submitted"] += 1
+        future = (self.threads if local else self.pool).submit(_timed, fn, *args)
+        # Release the slot when the job really ends, not when the caller gives up
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f, local))
+        try:
+            result, _ = await asyncio.wait_for(asyncio.wrap_future(future), timeout=deadline or None)
+        except asyncio.TimeoutError:
+            self.counters["timed_out"] += 1
+            raise DeadlineExceeded()
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+        self.counters["completed"] += 1
+        return result
+
+    def metrics(self):
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "inflight": self.inflight,
+            "running": min(self.inflight, self.workers),
+            "queued": max(0, self.inflight - self.workers),
+            "avg_service_ms": round(1000 * self.avg_service, 2),
+            "expected_wait_ms": round(1000 * self.expected_wait(), 2),
+            **self.counters,
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.threads.shutdown(cancel_futures=True)
@@ -0,0 +1,115 @@
+import numpy as np
+
+# face_recognition encodings are 128-d, matches are distance < 0.6
+FACE_DIM = 128
+FACE_THRESHOLD = 0.6
+
+# Rows scanned per block, keeps the temporary distance buffer small
+SEARCH_BLOCK = 65536
+
+# The float32 matmul pass is only a prefilter; anything within this margin of
+# the threshold is re-checked with the exact float64 norm used before.
+PREFILTER_MARGIN = 1e-3
+
+
+class FaceIndex:
+    """
+    Contiguous float32 embedding matrix with a parallel voter_id array.
+
+    Rows [0, size) are live. Deleting a voter moves the last row into the
+    freed slot so the matrix never has holes.
+    """
+
+    def __init__(self, dim=FACE_DIM, capacity=1024):
+        self.dim = dim
+        self.size = 0
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.sq_norms = np.zeros(capacity, dtype=np.float32)
+        self.voter_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}  # voter_id -> row
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, voter_id):
+        return voter_id in self.rows
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * len(self.voter_ids))
+        for name in ("vectors", "sq_norms", "voter_ids"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, voter_id, vector):
+        """Insert or replace the embedding of a voter."""
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        row = self.rows.get(voter_id)
+        if row is None:
+            if self.size == len(self.voter_ids):
+                self._grow(self.size + 1)
+            row = self.size
+            self.size += 1
+            self.rows[voter_id] = row
+            self.voter_ids[row] = voter_id
+        self.vectors[row] = vector
+        self.sq_norms[row] = np.dot(vector, vector)
+
+    def remove(self, voter_id):
+        row = self.rows.pop(voter_id, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            moved = int(self.voter_ids[last])
+            self.vectors[row] = self.vectors[last]
+            self.sq_norms[row] = self.sq_norms[last]
+            self.voter_ids[row] = moved
+            self.rows[moved] = row
+        self.size = last
+        return True
+
+    def get(self, voter_id):
+        row = self.rows.get(voter_id)
+        if row is None:
+            return None
+        return self.vectors[row]
+
+    def items(self):
+        for row in range(self.size):
+            yield int(self.voter_ids[row]), self.vectors[row]
+
+    def search(self, vector, threshold=FACE_THRESHOLD):
+        """
+        Return [(voter_id, distance)] for every stored face closer than
+        `threshold`, sorted by distance.
+        """
+        matches = []
+        for start in range(0, self.size, SEARCH_BLOCK):
+            stop = min(start + SEARCH_BLOCK, self.size)
+            matches.extend(scan_block(self.vectors[start:stop], self.sq_norms[start:stop],
+                                      self.voter_ids[start:stop], vector, threshold))
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+
+def scan_block(vectors, sq_norms, voter_ids, vector, threshold=FACE_THRESHOLD, skip=None):
+    """
+    Exact threshold search over one block of rows. `skip` is an optional
+    boolean mask of rows to ignore (deleted rows of a read-only segment).
+    """
+    query = np.asarray(vector, dtype=np.float64).reshape(vectors.shape[1])
+    query32 = query.astype(np.float32)
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab, compared squared to skip sqrt
+    sq_dist = sq_norms + float(np.dot(query32, query32)) - 2.0 * (vectors @ query32)
+    hit = sq_dist < (threshold + PREFILTER_MARGIN) ** 2
+    if skip is not None:
+        hit &= ~skip
+    hits = np.flatnonzero(hit)
+    if len(hits) == 0:
+        return []
+    exact = np.linalg.norm(vectors[hits].astype(np.float64) - query, axis=1)
+    keep = exact < threshold
+    return [(int(voter_id), float(distance))
+            for voter_id, distance in zip(voter_ids[hits[keep]], exact[keep])]
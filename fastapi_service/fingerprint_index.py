@@ -0,0 +1,233 @@
+"""
+Fingerprint templates and 1:N search.
+
+A template is up to FP_DESCRIPTORS ORB descriptors (32 bytes each, packed
+into one uint8 array) plus a 256-d float16 "bit frequency" vector summarising
+them. A search first scores the whole gallery against the summary vector
+with one matrix-vector product, then matches descriptors by Hamming
+distance (XOR + popcount) on the shortlist only.
+"""
+import os
+import struct
+import threading
+
+import numpy as np
+
+from embedding_store import AppendLog, partition_key
+
+FP_DESCRIPTORS = 64
+FP_DESCRIPTOR_BYTES = 32
+FP_GLOBAL_DIM = 8 * FP_DESCRIPTOR_BYTES
+FP_THRESHOLD = float(os.environ.get("FP_THRESHOLD", 0.4))
+FP_MATCH_DISTANCE = 64  # max Hamming distance (of 256 bits) for a descriptor match
+FP_SHORTLIST = int(os.environ.get("FP_SHORTLIST", 256))
+MATCH_BLOCK = 32  # candidates matched per vectorized step
+
+FP_RECORD = struct.Struct("<BqHH")
+OP_ADD = 1
+OP_REMOVE = 2
+
+
+def global_vector(descriptors):
+    """Centred, L2-normalised frequency of each descriptor bit."""
+    bits = np.unpackbits(descriptors, axis=1).astype(np.float32)
+    vector = bits.mean(axis=0) - 0.5
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def make_template(descriptors):
+    """Pack raw ORB descriptors into (descriptors[K, 32], count, global vector)."""
+    descriptors = np.asarray(descriptors, dtype=np.uint8)[:FP_DESCRIPTORS]
+    packed = np.zeros((FP_DESCRIPTORS, FP_DESCRIPTOR_BYTES), dtype=np.uint8)
+    packed[:len(descriptors)] = descriptors
+    return packed, len(descriptors), global_vector(descriptors).astype(np.float16)
+
+
+def match_scores(query, query_count, gallery, counts):
+    """
+    Share of query descriptors whose nearest gallery descriptor lies within
+    FP_MATCH_DISTANCE, for every template in `gallery` (n, K, 32).
+    """
+    # Compare 64 bits at a time: a descriptor is four uint64 words
+    q = np.ascontiguousarray(query[:query_count]).view(np.uint64)
+    gallery = np.ascontiguousarray(gallery).view(np.uint64)
+    scores = np.zeros(len(gallery), dtype=np.float32)
+    for start in range(0, len(gallery), MATCH_BLOCK):
+        block = gallery[start:start + MATCH_BLOCK]
+        # (n, K, q) Hamming distances, accumulated one 64-bit word at a time
+        distances = np.zeros((len(block), FP_DESCRIPTORS, len(q)), dtype=np.uint16)
+        for word in range(q.shape[1]):
+            distances += np.bitwise_count(block[:, :, None, word] ^ q[None, None, :, word])
+        valid = np.arange(FP_DESCRIPTORS)[None, :] < counts[start:start + MATCH_BLOCK, None]
+        distances[~valid] = np.iinfo(np.uint16).max
+        matched = (distances.min(axis=1) <= FP_MATCH_DISTANCE).sum(axis=1)
+        denominator = np.maximum(1, np.minimum(query_count, counts[start:start + MATCH_BLOCK]))
+        scores[start:start + len(block)] = matched / denominator
+    return scores
+
+
+class FingerprintIndex:
+    """Packed templates with a parallel voter_id array, swap-delete like FaceIndex."""
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.descriptors = np.zeros((capacity, FP_DESCRIPTORS, FP_DESCRIPTOR_BYTES), dtype=np.uint8)
+        self.counts = np.zeros(capacity, dtype=np.int16)
+        self.globals = np.zeros((capacity, FP_GLOBAL_DIM), dtype=np.float16)
+        self.partitions = np.zeros(capacity, dtype=np.int32)
+        self.voter_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+        self.partition_codes = {}  # (state, constituency) -> int
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, voter_id):
+        return voter_id in self.rows
+
+    def _grow(self):
+        capacity = 2 * len(self.voter_ids)
+        for name in ("descriptors", "counts", "globals", "partitions", "voter_ids"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, voter_id, template, key=("", "")):
+        descriptors, count, vector = template
+        row = self.rows.get(voter_id)
+        if row is None:
+            if self.size == len(self.voter_ids):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.rows[voter_id] = row
+            self.voter_ids[row] = voter_id
+        self.descriptors[row] = descriptors
+        self.counts[row] = count
+        self.globals[row] = vector
+        self.partitions[row] = self.partition_codes.setdefault(key, len(self.partition_codes))
+
+    def remove(self, voter_id):
+        row = self.rows.pop(voter_id, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            moved = int(self.voter_ids[last])
+            for name in ("descriptors", "counts", "globals", "partitions", "voter_ids"):
+                array = getattr(self, name)
+                array[row] = array[last]
+            self.rows[moved] = row
+        self.size = last
+        return True
+
+    def _partition_mask(self, state=None, constituency=None):
+        state_key, constituency_key = partition_key(state, constituency)
+        if not state_key and not constituency_key:
+            return None
+        codes = [code for (s, c), code in self.partition_codes.items()
+                 if (not state_key or s == state_key) and (not constituency_key or c == constituency_key)]
+        return np.isin(self.partitions[:self.size], codes)
+
+    def search(self, template, threshold=FP_THRESHOLD, state=None, constituency=None,
+               shortlist=FP_SHORTLIST):
+        """[(voter_id, score)] with score >= threshold, best first."""
+        descriptors, count, vector = template
+        if self.size == 0 or count == 0:
+            return []
+        coarse = self.globals[:self.size].astype(np.float32) @ vector.astype(np.float32)
+        mask = self._partition_mask(state, constituency)
+        if mask is not None:
+            coarse[~mask] = -np.inf
+        shortlist = min(shortlist, self.size)
+        rows = np.argpartition(-coarse, shortlist - 1)[:shortlist]
+        rows = rows[np.isfinite(coarse[rows])]
+        scores = match_scores(descriptors, count, self.descriptors[rows], self.counts[rows])
+        keep = scores >= threshold
+        matches = [(int(v), float(s)) for v, s in zip(self.voter_ids[rows[keep]], scores[keep])]
+        matches.sort(key=lambda m: -m[1])
+        return matches
+
+    def verify(self, voter_id, template):
+        """1:1 score against one stored template, None if not registered."""
+        row = self.rows.get(voter_id)
+        if row is None:
+            return None
+        descriptors, count, _ = template
+        return float(match_scores(descriptors, count, self.descriptors[row:row + 1],
+                                  self.counts[row:row + 1])[0])
+
+
+def encode_fingerprint_record(op, voter_id, key=("", ""), template=None):
+    if op == OP_REMOVE:
+        return FP_RECORD.pack(op, voter_id, 0, 0)
+    descriptors, count, vector = template
+    key_bytes = "\x1f".join(key).encode("utf-8")
+    return (FP_RECORD.pack(op, voter_id, len(key_bytes), count) + key_bytes
+            + descriptors.tobytes() + np.asarray(vector, dtype=np.float16).tobytes())
+
+
+def decode_fingerprint_record(payload):
+    op, voter_id, key_length, count = FP_RECORD.unpack_from(payload)
+    if op == OP_REMOVE:
+        return op, voter_id, None, None
+    start = FP_RECORD.size
+    key = tuple(payload[start:start + key_length].decode("utf-8").split("\x1f"))
+    start += key_length
+    size = FP_DESCRIPTORS * FP_DESCRIPTOR_BYTES
+    descriptors = np.frombuffer(payload, dtype=np.uint8, count=size, offset=start)
+    vector = np.frombuffer(payload, dtype=np.float16, offset=start + size)
+    return op, voter_id, key, (descriptors.reshape(FP_DESCRIPTORS, FP_DESCRIPTOR_BYTES), count, vector)
+
+
+class FingerprintStore:
+    """
+    FingerprintIndex persisted in an append-only log under the ML store, so
+    every worker sees the same gallery and a restart replays it without
+    re-extracting any image.
+    """
+
+    def __init__(self, root):
+        self.index = FingerprintIndex()
+        self.log = AppendLog(os.path.join(root, "fingerprints.log"))
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            for payload in self.log.read_new():
+                op, voter_id, key, template = decode_fingerprint_record(payload)
+                if op == OP_ADD:
+                    self.index.add(voter_id, template, key)
+                else:
+                    self.index.remove(voter_id)
+
+    def add(self, voter_id, template, state=None, constituency=None):
+        key = partition_key(state, constituency)
+        with self._lock:
+            self.refresh()
+            self.log.append(encode_fingerprint_record(OP_ADD, voter_id, key, template))
+            self.index.add(voter_id, template, key)
+
+    def remove(self, voter_id):
+        with self._lock:
+            self.refresh()
+            if voter_id not in self.index:
+                return False
+            self.log.append(encode_fingerprint_record(OP_REMOVE, voter_id))
+            return self.index.remove(voter_id)
+
+    def search(self, template, threshold=FP_THRESHOLD, state=None, constituency=None):
+        self.refresh()
+        with self._lock:
+            return self.index.search(template, threshold, state=state, constituency=constituency)
+
+    def verify(self, voter_id, template):
+        self.refresh()
+        with self._lock:
+            return self.index.verify(voter_id, template)
+
+    def __len__(self):
+        return len(self.index)
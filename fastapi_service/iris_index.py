@@ -0,0 +1,221 @@
+"""
+Iris-code matching with bit-packed masked Hamming distance.
+
+An iris code is IRIS_ROWS x IRIS_COLS bits (radius x angle), stored packed as
+uint64 words together with a mask of the bits that are usable (no eyelid,
+lash or reflection). The distance between two codes is
+
+    HD = popcount((a ^ b) & mask_a & mask_b) / popcount(mask_a & mask_b)
+
+taken as the minimum over circular shifts of the angle axis, which absorbs
+head tilt. 1:N search runs in two passes: a coarse pass over every template
+on the first rows only, then the full code on the survivors. Templates the
+coarse rows cannot judge (too few usable bits there, as when an eyelid
+covers the top of the iris) always go on to the full code.
+"""
+import os
+import struct
+import threading
+
+import numpy as np
+
+from embedding_store import AppendLog
+
+IRIS_ROWS = 8
+IRIS_COLS = 256
+IRIS_BITS = IRIS_ROWS * IRIS_COLS
+IRIS_BYTES = IRIS_BITS // 8
+IRIS_WORDS = IRIS_BITS // 64
+WORDS_PER_ROW = IRIS_COLS // 64
+
+IRIS_THRESHOLD = float(os.environ.get("IRIS_THRESHOLD", 0.32))
+IRIS_MAX_SHIFT = 8  # columns each way
+IRIS_MIN_BITS = 512  # fewer usable bits than this never counts as a match
+
+COARSE_ROWS = 2
+COARSE_MARGIN = 0.1
+SEARCH_BLOCK = 65536
+
+IRIS_RECORD = struct.Struct("<Bq")
+OP_ADD = 1
+OP_REMOVE = 2
+
+
+def parse_iris(data):
+    """
+    Raw upload -> (code, mask) as uint64 words. The body is the packed code
+    (IRIS_BYTES), optionally followed by the packed mask; without a mask
+    every bit counts.
+    """
+    if len(data) == IRIS_BYTES:
+        code, mask = data, b"\xff" * IRIS_BYTES
+    elif len(data) == 2 * IRIS_BYTES:
+        code, mask = data[:IRIS_BYTES], data[IRIS_BYTES:]
+    else:
+        raise ValueError(f"Iris template must be {IRIS_BYTES} or {2 * IRIS_BYTES} bytes, got {len(data)}")
+    return (np.frombuffer(code, dtype=np.uint64).copy(),
+            np.frombuffer(mask, dtype=np.uint64).copy())
+
+
+def shifted(words, shifts):
+    """Circularly shift the angle axis of packed codes -> (len(shifts), IRIS_WORDS)."""
+    bits = np.unpackbits(words.view(np.uint8)).reshape(IRIS_ROWS, IRIS_COLS)
+    rolled = np.stack([np.roll(bits, s, axis=1) for s in shifts])
+    return np.packbits(rolled.reshape(len(shifts), -1), axis=1).view(np.uint64)
+
+
+def masked_distances(codes, masks, query_codes, query_masks, unusable=1.0):
+    """
+    Minimum masked Hamming distance of every gallery column against a set of
+    shifted queries. codes/masks: (w, n) word-major; query_*: (s, w) -> (n,)
+    A comparison with too few usable bits scores `unusable`.
+    """
+    words, n = codes.shape
+    best = np.ones(n, dtype=np.float32)
+    differing = np.empty(n, dtype=np.uint16)
+    usable = np.empty(n, dtype=np.uint16)
+    valid = np.empty(n, dtype=np.uint64)
+    scratch = np.empty(n, dtype=np.uint64)
+    counts = np.empty(n, dtype=np.uint8)
+    min_bits = IRIS_MIN_BITS * words // IRIS_WORDS
+    for code, mask in zip(query_codes, query_masks):
+        differing[:] = 0
+        usable[:] = 0
+        # One contiguous 64-bit word of every template at a time, reusing buffers
+        for word in range(words):
+            np.bitwise_and(masks[word], mask[word], out=valid)
+            np.bitwise_xor(codes[word], code[word], out=scratch)
+            np.bitwise_and(scratch, valid, out=scratch)
+            differing += np.bitwise_count(scratch, out=counts)
+            usable += np.bitwise_count(valid, out=counts)
+        distance = np.where(usable >= min_bits, differing / np.maximum(usable, 1), unusable)
+        np.minimum(best, distance, out=best, casting="unsafe")
+    return best
+
+
+class IrisIndex:
+    """
+    Packed codes and masks with a parallel voter_id array, swap-delete like
+    FaceIndex. Stored word-major, (IRIS_WORDS, capacity), so each step of a
+    scan reads one contiguous word of every template.
+    """
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.codes = np.zeros((IRIS_WORDS, capacity), dtype=np.uint64)
+        self.masks = np.zeros((IRIS_WORDS, capacity), dtype=np.uint64)
+        self.voter_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, voter_id):
+        return voter_id in self.rows
+
+    def add(self, voter_id, code, mask):
+        row = self.rows.get(voter_id)
+        if row is None:
+            if self.size == len(self.voter_ids):
+                self.codes = np.concatenate([self.codes, np.zeros_like(self.codes)], axis=1)
+                self.masks = np.concatenate([self.masks, np.zeros_like(self.masks)], axis=1)
+                self.voter_ids = np.concatenate([self.voter_ids, np.zeros_like(self.voter_ids)])
+            row = self.size
+            self.size += 1
+            self.rows[voter_id] = row
+            self.voter_ids[row] = voter_id
+        self.codes[:, row] = code
+        self.masks[:, row] = mask
+
+    def remove(self, voter_id):
+        row = self.rows.pop(voter_id, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            moved = int(self.voter_ids[last])
+            self.codes[:, row] = self.codes[:, last]
+            self.masks[:, row] = self.masks[:, last]
+            self.voter_ids[row] = moved
+            self.rows[moved] = row
+        self.size = last
+        return True
+
+    def search(self, code, mask, threshold=IRIS_THRESHOLD, max_shift=IRIS_MAX_SHIFT):
+        """[(voter_id, distance)] with distance <= threshold, best first."""
+        if self.size == 0:
+            return []
+        shifts = range(-max_shift, max_shift + 1)
+        query_codes, query_masks = shifted(code, shifts), shifted(mask, shifts)
+        coarse = COARSE_ROWS * WORDS_PER_ROW
+
+        matches = []
+        for start in range(0, self.size, SEARCH_BLOCK):
+            stop = min(start + SEARCH_BLOCK, self.size)
+            # Unjudgeable in the coarse rows scores 0, so it is never pruned here
+            rough = masked_distances(self.codes[:coarse, start:stop], self.masks[:coarse, start:stop],
+                                     query_codes[:, :coarse], query_masks[:, :coarse], unusable=0.0)
+            rows = np.flatnonzero(rough <= threshold + COARSE_MARGIN) + start
+            if len(rows) == 0:
+                continue
+            exact = masked_distances(self.codes[:, rows], self.masks[:, rows], query_codes, query_masks)
+            keep = exact <= threshold
+            matches.extend(zip(self.voter_ids[rows[keep]].tolist(), exact[keep].tolist()))
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+    def verify(self, voter_id, code, mask, max_shift=IRIS_MAX_SHIFT):
+        """1:1 distance to one stored code, None if not registered."""
+        row = self.rows.get(voter_id)
+        if row is None:
+            return None
+        shifts = range(-max_shift, max_shift + 1)
+        return float(masked_distances(self.codes[:, row:row + 1], self.masks[:, row:row + 1],
+                                      shifted(code, shifts), shifted(mask, shifts))[0])
+
+
+class IrisStore:
+    """IrisIndex persisted in an append-only log, shared by every worker."""
+
+    def __init__(self, root):
+        self.index = IrisIndex()
+        self.log = AppendLog(os.path.join(root, "iris.log"))
+        self._lock = threading.RLock()
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            for payload in self.log.read_new():
+                op, voter_id = IRIS_RECORD.unpack_from(payload)
+                if op == OP_ADD:
+                    words = np.frombuffer(payload, dtype=np.uint64, offset=IRIS_RECORD.size)
+                    self.index.add(voter_id, words[:IRIS_WORDS], words[IRIS_WORDS:])
+                else:
+                    self.index.remove(voter_id)
+
+    def add(self, voter_id, code, mask):
+        with self._lock:
+            self.refresh()
+            self.log.append(IRIS_RECORD.pack(OP_ADD, voter_id) + code.tobytes() + mask.tobytes())
+            self.index.add(voter_id, code, mask)
+
+    def remove(self, voter_id):
+        with self._lock:
+            self.refresh()
+            if voter_id not in self.index:
+                return False
+            self.log.append(IRIS_RECORD.pack(OP_REMOVE, voter_id))
+            return self.index.remove(voter_id)
+
+    def search(self, code, mask, threshold=IRIS_THRESHOLD):
+        self.refresh()
+        with self._lock:
+            return self.index.search(code, mask, threshold)
+
+    def verify(self, voter_id, code, mask):
+        self.refresh()
+        with self._lock:
+            return self.index.verify(voter_id, code, mask)
+
+    def __len__(self):
+        return len(self.index)
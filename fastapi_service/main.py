@@ -1,11 +1,20 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Form, UploadFile
 import numpy as np
-import face_recognition
 from typing import List
 from fastapi.middleware.cors import CORSMiddleware
-from skimage.io import imread
-from skimage.metrics import structural_similarity as ssim
-import cv2
+from fastapi.responses import JSONResponse
+import os
+import asyncio
+import functools
+import tarfile
+import zipfile
+from embedding_store import FaceStore, SignatureRegistry
+from face_index import FACE_THRESHOLD
+from encoding import encode_face, extract_fingerprint, hash_signatures, load_signatures, prepare_signature, ssim_scores
+from executor import DeadlineExceeded, MLExecutor, Overloaded
+from fingerprint_index import FP_THRESHOLD, FingerprintStore
+from iris_index import IRIS_THRESHOLD, IrisStore, parse_iris
+from signature_index import SIGNATURE_THRESHOLD, SIGNATURE_TOP_K, SignatureIndex
 app = FastAPI(title="Voter ML Service")
 
 # Allow requests from Django frontend
@@ -16,107 +25,316 @@ app.add_middleware(
     allow_headers=["*"],
     )
 
-# In-memory "database" of embeddings for demo
-known_faces = {}
-known_signatures = {}
+# Embeddings live in an on-disk store shared by every worker (see embedding_store.py)
+# Faces are partitioned by state/constituency, each partition is an IVF index
+ML_STORE_DIR = os.environ.get("ML_STORE_DIR", os.path.join(os.path.dirname(__file__), "ml_store"))
+known_faces = FaceStore(
+    ML_STORE_DIR,
+    nprobe=int(os.environ.get("FACE_INDEX_NPROBE", 16)),
+    rerank=os.environ.get("FACE_INDEX_RERANK", "1") == "1",
+)
+known_signatures = SignatureRegistry(ML_STORE_DIR)
+# Perceptual hashes of every signature plus an LRU of normalized images
+signature_index = SignatureIndex()
+known_fingerprints = FingerprintStore(ML_STORE_DIR)
+# Bit-packed iris codes and masks, the whole gallery stays in memory
+known_irises = IrisStore(ML_STORE_DIR)
+
+# Image decoding, face encoding and SSIM run in a process pool, never on the event loop
+ML_POOL_WORKERS = int(os.environ.get("ML_POOL_WORKERS", os.cpu_count() or 1))
+ml_executor = MLExecutor(
+    workers=ML_POOL_WORKERS,
+    max_queue=int(os.environ.get("ML_MAX_QUEUE", 4 * ML_POOL_WORKERS)),
+    deadline=float(os.environ.get("ML_DEADLINE_SECONDS", 10)),
+)
+# Images a batch keeps in flight; bulk jobs wait for slots instead of being shed
+BATCH_WINDOW = ML_POOL_WORKERS
+# Background clustering of delta partitions that grew past MIN_TRAIN_SIZE
+face_training = None
+
+@app.on_event("shutdown")
+def shutdown_pool():
+    ml_executor.shutdown()
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc):
+    return JSONResponse({"error": "ML service busy, retry later"}, status_code=429, headers={"Retry-After": "1"})
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_handler(request, exc):
+    return JSONResponse({"error": "ML service could not finish in time"}, status_code=503, headers={"Retry-After": "2"})
+
+@app.get("/metrics/")
+async def metrics():
+    return {"executor": ml_executor.metrics(), "faces": len(known_faces), "signatures": len(known_signatures),
+            "fingerprints": len(known_fingerprints), "irises": len(known_irises),
+            "signature_cache": signature_index.cache.stats()}
 
 @app.post("/register_face/")
-async def register_face(voter_id: int, file: UploadFile = File(...)):
-    img = face_recognition.load_image_file(file.file)
-    encodings = face_recognition.face_encodings(img)
-    if len(encodings) == 0:
-        return {"error": "No face found"}
-    known_faces[voter_id] = encodings[0].tolist()
+async def register_face(voter_id: int, file: UploadFile = File(...), state: str = None, constituency: str = None):
+    vector, error = await ml_executor.run(encode_face, await file.read())
+    if error:
+        return {"error": error}
+    await ml_executor.run(known_faces.add, voter_id, vector, state, constituency, local=True)
+    train_faces_in_background()
     return {"status": "Face registered"}
 
+def train_faces_in_background():
+    # Clustering 20k+ faces takes seconds, the registration that crossed the line does not wait for it
+    global face_training
+    if (face_training is None or face_training.done()) and known_faces.needs_training():
+        face_training = asyncio.get_running_loop().run_in_executor(None, known_faces.train, True)
+
+def voter_id_from_name(name):
+    # Archive members and uploads are named <voter_id>.<ext>
+    stem = os.path.splitext(os.path.basename(name or ""))[0]
+    return int(stem) if stem.isdigit() else None
+
+def iter_archive(archive):
+    name = (archive.filename or "").lower()
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(archive.file) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, zf.read(info)
+    else:
+        # Streamed, so a large tar never has to be seekable or fully unpacked
+        with tarfile.open(fileobj=archive.file, mode="r|*") as tf:
+            for member in tf:
+                if member.isfile():
+                    yield member.name, tf.extractfile(member).read()
+
+async def iter_uploads(files, voter_ids):
+    for i, upload in enumerate(files):
+        voter_id = voter_ids[i] if voter_ids and i < len(voter_ids) else voter_id_from_name(upload.filename)
+        yield upload.filename, voter_id, await upload.read()
+
+def batch_source(files, voter_ids, archive):
+    if archive is not None:
+        async def items():
+            for name, data in iter_archive(archive):
+                yield name, voter_id_from_name(name), data
+        return items()
+    if files:
+        return iter_uploads(files, voter_ids)
+    return None
+
+async def run_batch(source, extract, register):
+    """
+    Feed (name, voter_id, bytes) items through `extract` in the pool, keeping
+    BATCH_WINDOW in flight, and call `register(voter_id, result)` (in a
+    thread) on success.
+    """
+    results = []
+    pending = []
+
+    async def drain(limit):
+        while len(pending) > limit:
+            name, voter_id, future = pending.pop(0)
+            try:
+                value, error = await future
+                if error is None:
+                    await ml_executor.run(register, voter_id, value, wait=True, local=True)
+            except DeadlineExceeded:
+                value, error = None, "Timed out"
+            if error is None:
+                results.append({"file": name, "voter_id": voter_id, "status": "registered"})
+            else:
+                results.append({"file": name, "voter_id": voter_id, "status": "failed", "error": error})
+
+    async for name, voter_id, data in source:
+        if voter_id is None:
+            results.append({"file": name, "voter_id": None, "status": "failed", "error": "No voter_id"})
+            continue
+        job = asyncio.ensure_future(ml_executor.run(extract, data, wait=True))
+        pending.append((name, voter_id, job))
+        await drain(BATCH_WINDOW)
+    await drain(0)
+
+    registered = sum(1 for r in results if r["status"] == "registered")
+    return {"registered": registered, "failed": len(results) - registered, "results": results}
+
+@app.post("/register_faces/")
+async def register_faces(files: List[UploadFile] = File(None), voter_ids: List[int] = Form(None),
+                         archive: UploadFile = File(None), state: str = None, constituency: str = None):
+    """
+    Register many faces in one call. Send either multipart `files` (with a
+    parallel `voter_ids` list, or files named <voter_id>.jpg) or a single
+    zip/tar `archive` whose members are named <voter_id>.<ext>.
+    """
+    source = batch_source(files, voter_ids, archive)
+    if source is None:
+        return {"error": "Send files or an archive"}
+    result = await run_batch(source, encode_face, lambda voter_id, vector: known_faces.add(
+        voter_id, vector, state=state, constituency=constituency))
+    train_faces_in_background()
+    return result
+
 @app.post("/check_duplicate/")
-async def check_duplicate(file: UploadFile = File(...)):
-    img = face_recognition.load_image_file(file.file)
-    encodings = face_recognition.face_encodings(img)
-    if len(encodings) == 0:
-        return {"error": "No face found"}
-    face_vector = encodings[0]
-    duplicates = []
-    for voter_id, known_vector in known_faces.items():
-        distance = np.linalg.norm(np.array(known_vector) - face_vector)
-        if distance < 0.6:
-            duplicates.append({"voter_id": voter_id, "distance": distance})
+async def check_duplicate(file: UploadFile = File(...), state: str = None, constituency: str = None,
+                          nprobe: int = None, rerank: bool = None):
+    # Leave state/constituency empty to check against the whole roll
+    vector, error = await ml_executor.run(encode_face, await file.read())
+    if error:
+        return {"error": error}
+    matches = await ml_executor.run(functools.partial(
+        known_faces.search, vector, state=state, constituency=constituency, nprobe=nprobe, rerank=rerank),
+        local=True)
+    duplicates = [{"voter_id": voter_id, "distance": distance} for voter_id, distance in matches]
     return {"duplicates": duplicates}
 
+@app.post("/verify_face/{voter_id}")
+async def verify_face(voter_id: int, file: UploadFile = File(...)):
+    # 1:1 against the voter's own embedding, independent of roll size
+    vector, error = await ml_executor.run(encode_face, await file.read())
+    if error:
+        return {"error": error, "match": False}
+    distance = await ml_executor.run(known_faces.verify, voter_id, vector, local=True)
+    if distance is None:
+        return {"error": "Face not registered", "match": False}
+    return {"match": distance < FACE_THRESHOLD, "voter_id": voter_id, "distance": distance}
+
+@app.delete("/faces/{voter_id}")
+async def delete_face(voter_id: int):
+    if not await ml_executor.run(known_faces.remove, voter_id, local=True):
+        return {"error": "Face not registered"}
+    return {"status": "Face deleted"}
+
+@app.get("/face_index/")
+async def face_index_stats():
+    return known_faces.stats()
+
+@app.post("/face_index/train/")
+async def train_face_index():
+    # Re-cluster this worker's delta; run `embedding_store.py compact` to fold it into the segment
+    await ml_executor.run(known_faces.train, local=True, wait=True, deadline=0)
+    return known_faces.stats()
+
 # Signature placeholder (similar logic)
+async def sync_signatures():
+    """Bring the hash index up to date with the registry log."""
+    changed = known_signatures.refresh()
+    if len(signature_index) == 0:
+        changed = list(known_signatures.paths)
+    unhashed = []
+    for voter_id in changed:
+        path = known_signatures.paths.get(voter_id)
+        if path is None:
+            signature_index.remove(voter_id)
+        elif known_signatures.hashes.get(voter_id) is None:
+            unhashed.append((voter_id, path))
+        else:
+            signature_index.add(voter_id, known_signatures.hashes[voter_id])
+    if unhashed:
+        # Registered before hashes were recorded: hash once and persist
+        for voter_id, signature_hash in await ml_executor.run(hash_signatures, unhashed, wait=True):
+            known_signatures.set(voter_id, known_signatures.paths[voter_id], signature_hash)
+            signature_index.add(voter_id, signature_hash)
+
 @app.post("/register_signature/")
 async def register_signature(voter_id:int, file: UploadFile = File(...)): 
-    known_signatures[voter_id] = file.filename
+    data = await file.read()
+    normalized, signature_hash = await ml_executor.run(prepare_signature, data)
+    known_signatures.add(voter_id, file.filename, data, phash=signature_hash)
+    signature_index.add(voter_id, signature_hash, normalized)
     return {"status":"Signature registered"}
 
 # for AI/ML
 @app.post("/check_duplicate_signature/")
-async def check_duplicate_signature(file: UploadFile = File(...)):
-    img = imread(file.file)
-    duplicates = []
-    for voter_id, known_file in known_signatures.items():
-        known_img = imread(known_file)
-        # Convert to grayscale
-        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        known_gray = cv2.cvtColor(known_img, cv2.COLOR_BGR2GRAY)
-        score, _ = ssim(img_gray, known_gray, full=True)
-        if score > 0.85:
-            duplicates.append({"voter_id": voter_id, "similarity": score})
+async def check_duplicate_signature(file: UploadFile = File(...), top_k: int = SIGNATURE_TOP_K):
+    await sync_signatures()
+    query, query_hash = await ml_executor.run(prepare_signature, await file.read())
+
+    # Hash prefilter, then SSIM only on the closest candidates
+    candidates = []
+    missing = []
+    for voter_id in signature_index.candidates(query_hash, top_k):
+        normalized = signature_index.cache.get(voter_id)
+        if normalized is None:
+            missing.append((voter_id, known_signatures.paths[voter_id]))
+        else:
+            candidates.append((voter_id, normalized))
+    if missing:
+        for voter_id, normalized, signature_hash in await ml_executor.run(load_signatures, missing):
+            signature_index.add(voter_id, signature_hash, normalized)
+            candidates.append((voter_id, normalized))
+
+    scores = await ml_executor.run(ssim_scores, query, candidates)
+    duplicates = [
+        {"voter_id": voter_id, "similarity": score}
+        for voter_id, score in sorted(scores, key=lambda s: -s[1])
+        if score > SIGNATURE_THRESHOLD
+    ]
     return {"duplicates": duplicates}
 
 
-@app.post("/check_duplicate_fingerprint/")
-async def check_duplicate_fingerprint(file: UploadFile = File(...), voter_id: int = None):
-    # Placeholder: compare fingerprint with known_fingerprints dict
-    if voter_id in known_fingerprints:
-        # simple byte comparison example
-        uploaded_bytes = await file.read()
-        known_bytes = known_fingerprints[voter_id]
-        match = uploaded_bytes == known_bytes
-        return {"match": match, "voter_id": voter_id}
-    return {"match": False}
+@app.post("/register_fingerprint/")
+async def register_fingerprint(voter_id: int, file: UploadFile = File(...), state: str = None, constituency: str = None):
+    template, error = await ml_executor.run(extract_fingerprint, await file.read())
+    if error:
+        return {"error": error}
+    await ml_executor.run(known_fingerprints.add, voter_id, template, state, constituency, local=True)
+    return {"status": "Fingerprint registered"}
 
+@app.post("/register_fingerprints/")
+async def register_fingerprints(files: List[UploadFile] = File(None), voter_ids: List[int] = Form(None),
+                                archive: UploadFile = File(None), state: str = None, constituency: str = None):
+    # Same upload formats as /register_faces/
+    source = batch_source(files, voter_ids, archive)
+    if source is None:
+        return {"error": "Send files or an archive"}
+    return await run_batch(source, extract_fingerprint, lambda voter_id, template: known_fingerprints.add(
+        voter_id, template, state=state, constituency=constituency))
 
-import requests
-from django.views.decorators.csrf import csrf_exempt
+@app.post("/check_duplicate_fingerprint/")
+async def check_duplicate_fingerprint(file: UploadFile = File(...), voter_id: int = None,
+                                      state: str = None, constituency: str = None):
+    # With voter_id: 1:1 check against that voter. Without: 1:N over the gallery.
+    template, error = await ml_executor.run(extract_fingerprint, await file.read())
+    if error:
+        return {"error": error, "match": False}
+    if voter_id is not None:
+        score = await ml_executor.run(known_fingerprints.verify, voter_id, template, local=True)
+        return {"match": score is not None and score >= FP_THRESHOLD, "voter_id": voter_id, "score": score}
+    matches = await ml_executor.run(functools.partial(
+        known_fingerprints.search, template, state=state, constituency=constituency), local=True)
+    duplicates = [{"voter_id": match_id, "score": score} for match_id, score in matches]
+    best = duplicates[0]["voter_id"] if duplicates else None
+    return {"match": bool(duplicates), "voter_id": best, "duplicates": duplicates}
 
-FASTAPI_URL = "http://127.0.0.1:8001"
+@app.post("/verify_fingerprint/{voter_id}")
+async def verify_fingerprint(voter_id: int, file: UploadFile = File(...)):
+    template, error = await ml_executor.run(extract_fingerprint, await file.read())
+    if error:
+        return {"error": error, "match": False}
+    score = await ml_executor.run(known_fingerprints.verify, voter_id, template, local=True)
+    if score is None:
+        return {"error": "Fingerprint not registered", "match": False}
+    return {"match": score >= FP_THRESHOLD, "voter_id": voter_id, "score": score}
 
-@csrf_exempt
-def verify_voter_pdf(request, voter_id):
-    """
-    Step 2: Verify OTP + optional face/fingerprint
-    """
-    voter = Voter.objects.get(id=voter_id)
-    input_otp = request.POST.get("otp")
-    cached_otp = cache.get(f"voter_otp_{voter.id}")
-
-    if str(input_otp) != str(cached_otp):
-        return HttpResponse("OTP Verification Failed", status=400)
-
-    # Optional: Face verification
-    face_file = request.FILES.get("face_image")
-    if face_file:
-        resp = requests.post(
-            f"{FASTAPI_URL}/check_duplicate_face/",
-            files={"file": face_file}
-        )
-        data = resp.json()
-        if not data.get("duplicates") or all(d["voter_id"] != voter.id for d in data["duplicates"]):
-            return HttpResponse("Face verification failed", status=400)
-
-    # Optional: Fingerprint verification
-    fingerprint_file = request.FILES.get("fingerprint")
-    if fingerprint_file:
-        resp = requests.post(
-            f"{FASTAPI_URL}/check_duplicate_fingerprint/",
-            files={"file": fingerprint_file}
-        )
-        data = resp.json()
-        if not data.get("match") or data.get("voter_id") != voter.id:
-            return HttpResponse("Fingerprint verification failed", status=400)
-
-    # OTP + biometric passed → Generate PDF
-    return generate_voter_pdf(request, voter.id)
 
+# Iris uploads are the packed code, optionally followed by the packed mask (see iris_index.py)
+@app.post("/register_iris/")
+async def register_iris(voter_id: int, file: UploadFile = File(...)):
+    try:
+        code, mask = parse_iris(await file.read())
+    except ValueError as e:
+        return {"error": str(e)}
+    await ml_executor.run(known_irises.add, voter_id, code, mask, local=True)
+    return {"status": "Iris registered"}
 
+@app.post("/check_duplicate_iris/")
+async def check_duplicate_iris(file: UploadFile = File(...), voter_id: int = None,
+                               threshold: float = IRIS_THRESHOLD):
+    try:
+        code, mask = parse_iris(await file.read())
+    except ValueError as e:
+        return {"error": str(e), "match": False}
+    if voter_id is not None:
+        distance = await ml_executor.run(known_irises.verify, voter_id, code, mask, local=True)
+        return {"match": distance is not None and distance <= threshold, "voter_id": voter_id,
+                "distance": distance}
+    matches = await ml_executor.run(known_irises.search, code, mask, threshold, local=True)
+    duplicates = [{"voter_id": match_id, "distance": distance} for match_id, distance in matches]
+    best = duplicates[0]["voter_id"] if duplicates else None
+    return {"match": bool(duplicates), "voter_id": best, "duplicates": duplicates}
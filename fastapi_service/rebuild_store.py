@@ -0,0 +1,102 @@
+"""
+Rebuild the embedding store from the voter roll.
+
+    python manage.py export_ml_manifest manifest.csv     (in voter_project/)
+    python rebuild_store.py manifest.csv --root ml_store
+
+The manifest has one row per voter: voter_id, state, constituency,
+photo_path, signature_path and, when exported with --biometrics-dir,
+fingerprint_path and iris_path. Photos are re-encoded across all cores and written
+straight into a new compacted generation; registrations that arrive while
+the rebuild runs are carried over. Fingerprint templates are extracted in
+the same pass and appended to the fingerprint log; iris codes are loaded
+as they are.
+"""
+import argparse
+import csv
+import os
+from collections import defaultdict
+from multiprocessing import Pool
+
+import face_recognition
+import numpy as np
+
+from embedding_store import FaceStore, SignatureRegistry, partition_key
+from encoding import extract_fingerprint, hash_signatures
+from fingerprint_index import FingerprintStore
+from iris_index import IrisStore, parse_iris
+
+
+def encode_row(row):
+    signature = row.get("signature_path")
+    if signature and os.path.exists(signature):
+        hashed = hash_signatures([(row["voter_id"], signature)])
+        row["signature_hash"] = hashed[0][1] if hashed else None
+    fingerprint = row.get("fingerprint_path")
+    if fingerprint and os.path.exists(fingerprint):
+        with open(fingerprint, "rb") as f:
+            row["fingerprint_template"], _ = extract_fingerprint(f.read())
+    path = row.get("photo_path")
+    if not path or not os.path.exists(path):
+        return row, None
+    try:
+        encodings = face_recognition.face_encodings(face_recognition.load_image_file(path))
+    except Exception:
+        return row, None
+    return row, encodings[0].astype(np.float32) if encodings else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest")
+    parser.add_argument("--root", default=os.environ.get("ML_STORE_DIR", "ml_store"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    store = FaceStore(args.root)
+    signatures = SignatureRegistry(args.root)
+    fingerprints = FingerprintStore(args.root)
+    irises = IrisStore(args.root)
+    carry_from = store.log.size()
+
+    with open(args.manifest, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    partitions = defaultdict(lambda: ([], []))
+    encoded = failed = 0
+    with Pool(args.workers) as pool:
+        for row, vector in pool.imap_unordered(encode_row, rows, chunksize=16):
+            voter_id = int(row["voter_id"])
+            signature = row.get("signature_path")
+            if signature and os.path.exists(signature):
+                with open(signature, "rb") as sig:
+                    signatures.add(voter_id, signature, sig.read(), phash=row.get("signature_hash"))
+            if row.get("fingerprint_template") is not None:
+                fingerprints.add(voter_id, row["fingerprint_template"],
+                                 state=row.get("state"), constituency=row.get("constituency"))
+            iris = row.get("iris_path")
+            if iris and os.path.exists(iris):
+                with open(iris, "rb") as f:
+                    try:
+                        irises.add(voter_id, *parse_iris(f.read()))
+                    except ValueError:
+                        pass
+            if vector is None:
+                failed += 1
+                continue
+            voter_ids, vectors = partitions[partition_key(row.get("state"), row.get("constituency"))]
+            voter_ids.append(voter_id)
+            vectors.append(vector)
+            encoded += 1
+
+    store.publish(
+        ((key, np.asarray(ids, dtype=np.int64), np.stack(vecs)) for key, (ids, vecs) in sorted(partitions.items())),
+        encoded,
+        carry_from,
+    )
+    print(f"encoded={encoded} failed={failed} generation={store.generation} signatures={len(signatures)} "
+          f"fingerprints={len(fingerprints)} irises={len(irises)}")
+
+
+if __name__ == "__main__":
+    main()
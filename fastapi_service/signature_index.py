@@ -0,0 +1,134 @@
+"""
+Signature matching without re-reading every stored image per request.
+
+Every signature is normalized once (grayscale, cropped to the ink, resized to
+SIGNATURE_SHAPE) and reduced to a 64-bit perceptual hash. A duplicate check
+ranks the whole gallery by Hamming distance between hashes, a vectorized
+XOR + popcount, and only runs SSIM on the top-K candidates. Normalized arrays
+are kept in an LRU cache with a memory cap.
+"""
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+SIGNATURE_SHAPE = (128, 256)  # rows, cols
+SIGNATURE_THRESHOLD = 0.85
+SIGNATURE_TOP_K = int(os.environ.get("SIGNATURE_TOP_K", 20))
+SIGNATURE_CACHE_BYTES = int(os.environ.get("SIGNATURE_CACHE_MB", 256)) * 1024 * 1024
+
+
+def normalize_signature(img):
+    """Grayscale uint8 array cropped to the ink and resized to SIGNATURE_SHAPE."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img[..., :3], cv2.COLOR_BGR2GRAY)
+    if img.dtype != np.uint8:
+        img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    _, ink = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    points = cv2.findNonZero(ink)
+    if points is not None:
+        x, y, w, h = cv2.boundingRect(points)
+        img = img[y:y + h, x:x + w]
+    return cv2.resize(img, SIGNATURE_SHAPE[::-1], interpolation=cv2.INTER_AREA)
+
+
+def phash(gray):
+    """64-bit DCT perceptual hash of a normalized signature."""
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+class SignatureCache:
+    """LRU of normalized signature arrays, bounded by total bytes."""
+
+    def __init__(self, max_bytes=SIGNATURE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.arrays = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, voter_id):
+        array = self.arrays.get(voter_id)
+        if array is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.arrays.move_to_end(voter_id)
+        return array
+
+    def put(self, voter_id, array):
+        self.discard(voter_id)
+        self.arrays[voter_id] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.max_bytes and len(self.arrays) > 1:
+            _, evicted = self.arrays.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def discard(self, voter_id):
+        array = self.arrays.pop(voter_id, None)
+        if array is not None:
+            self.nbytes -= array.nbytes
+
+    def stats(self):
+        return {"entries": len(self.arrays), "bytes": self.nbytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+
+class SignatureIndex:
+    """Packed uint64 hashes of every registered signature, swap-delete like FaceIndex."""
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.hashes = np.zeros(capacity, dtype=np.uint64)
+        self.voter_ids = np.zeros(capacity, dtype=np.int64)
+        self.rows = {}
+        self.cache = SignatureCache()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, voter_id):
+        return voter_id in self.rows
+
+    def add(self, voter_id, signature_hash, normalized=None):
+        row = self.rows.get(voter_id)
+        if row is None:
+            if self.size == len(self.hashes):
+                self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+                self.voter_ids = np.concatenate([self.voter_ids, np.zeros_like(self.voter_ids)])
+            row = self.size
+            self.size += 1
+            self.rows[voter_id] = row
+            self.voter_ids[row] = voter_id
+        self.hashes[row] = np.uint64(signature_hash)
+        if normalized is not None:
+            self.cache.put(voter_id, normalized)
+        else:
+            self.cache.discard(voter_id)
+
+    def remove(self, voter_id):
+        row = self.rows.pop(voter_id, None)
+        if row is None:
+            return False
+        last = self.size - 1
+        if row != last:
+            moved = int(self.voter_ids[last])
+            self.hashes[row] = self.hashes[last]
+            self.voter_ids[row] = moved
+            self.rows[moved] = row
+        self.size = last
+        self.cache.discard(voter_id)
+        return True
+
+    def candidates(self, signature_hash, k=SIGNATURE_TOP_K):
+        """voter_ids of the `k` stored hashes closest to `signature_hash`."""
+        if self.size == 0:
+            return []
+        distances = np.bitwise_count(self.hashes[:self.size] ^ np.uint64(signature_hash))
+        k = min(k, self.size)
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return self.voter_ids[nearest].tolist()
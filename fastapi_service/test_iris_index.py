@@ -0,0 +1,57 @@
+import unittest
+
+import numpy as np
+
+from iris_index import IRIS_BYTES, IRIS_COLS, IRIS_ROWS, IrisIndex
+
+
+def pack(bits):
+    return np.packbits(bits.reshape(-1)).view(np.uint64).copy()
+
+
+def occluded_mask(rows):
+    """A mask with the given radius rows covered (e.g. by the upper eyelid)."""
+    bits = np.ones((IRIS_ROWS, IRIS_COLS), dtype=np.uint8)
+    bits[list(rows)] = 0
+    return pack(bits)
+
+
+class IrisOcclusionRecallTests(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(7)
+        self.index = IrisIndex()
+        self.bits = {}
+        full = np.frombuffer(b"\xff" * IRIS_BYTES, dtype=np.uint64).copy()
+        for voter_id in range(1, 2001):
+            bits = self.rng.integers(0, 2, (IRIS_ROWS, IRIS_COLS), dtype=np.uint8)
+            self.bits[voter_id] = bits
+            self.index.add(voter_id, pack(bits), full)
+
+    def noisy(self, voter_id, flip=0.05):
+        bits = self.bits[voter_id].copy()
+        bits ^= (self.rng.random(bits.shape) < flip).astype(np.uint8)
+        return pack(bits)
+
+    def test_query_with_covered_coarse_rows_is_found(self):
+        for rows in [(0, 1), (0, 1, 2)]:
+            mask = occluded_mask(rows)
+            for voter_id in (5, 777, 2000):
+                code = self.noisy(voter_id)
+                self.assertLess(self.index.verify(voter_id, code, mask), 0.1)
+                found = dict(self.index.search(code, mask))
+                self.assertIn(voter_id, found, f"rows {rows} covered")
+                self.assertAlmostEqual(found[voter_id], self.index.verify(voter_id, code, mask), places=5)
+
+    def test_stored_template_with_covered_coarse_rows_is_found(self):
+        mask = occluded_mask((0, 1))
+        self.index.add(42, pack(self.bits[42]), mask)
+        full = np.frombuffer(b"\xff" * IRIS_BYTES, dtype=np.uint64).copy()
+        self.assertIn(42, dict(self.index.search(self.noisy(42), full)))
+
+    def test_unrelated_codes_do_not_match(self):
+        bits = self.rng.integers(0, 2, (IRIS_ROWS, IRIS_COLS), dtype=np.uint8)
+        self.assertEqual(self.index.search(pack(bits), occluded_mask((0, 1))), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
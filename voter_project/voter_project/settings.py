@@ -166,4 +166,30 @@ LOGGING = {
             "level": "INFO",
         },
     },
-}
\ No newline at end of file
+}
+
+# MaxMind GeoLite2/GeoIP2 City database for login geolocation (voters/geoip.py)
+GEOIP_PATH = BASE_DIR / 'geoip'
+GEOIP_CACHE_SIZE = 65536
+
+# Sidecar SQLite search index for VoterSearchAPI (voters/search_index.py)
+VOTER_SEARCH_INDEX = BASE_DIR / 'search_index.sqlite3'
+VOTER_SEARCH_LIMIT = 1000  # ids per index lookup; ?order=name|created sorts at most this many
+
+# Rendered voter PDFs (voters/pdf_cache.py)
+VOTER_PDF_CACHE_DIR = BASE_DIR / 'pdf_cache'
+VOTER_PDF_CACHE_MAX_BYTES = 2 * 1024 ** 3
+VOTER_PDF_WORKERS = 2
+
+# FastAPI ML service client (voters/ml_client.py); "BACKEND": "fake" runs without the service
+ML_SERVICE = {
+    "URL": "http://127.0.0.1:8001",
+    "CONNECT_TIMEOUT": 1.0,
+    "READ_TIMEOUT": 10.0,
+    "RETRIES": 2,
+    "POOL_SIZE": 20,
+    "BATCH_SIZE": 32,
+    "BATCH_WAIT": 0.05,
+    "BREAKER_FAILURES": 5,
+    "BREAKER_RESET": 30,
+}
@@ -2,11 +2,16 @@ from django.contrib import admin
 from .models import (Voter, State, Constituency, Booth,  AdminLog,
                     Address, BiometricData, FamilyRelation, DeathRecord, 
                     Notification, UpdateLog, DuplicateCheckLog, Localization,
-                    TempVoter, Localization, LoginLog, BlacklistedVoter, MigrationHistory)
+                    TempVoter, Localization, LoginLog, BlacklistedVoter, MigrationHistory, OutboxEvent,
+                    ImportBatch, RollJob, VoterStat)
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
 from django.contrib.admin import SimpleListFilter
+from django.db.models import F
+from django.http import StreamingHttpResponse
 from datetime import date
+from . import ages, exporter
+from .pagination import EstimatedCountPaginator
 
 # State AdminPanne;
 
@@ -82,9 +87,22 @@ class AgeYearFilter(SimpleListFilter):
     def queryset(self, request, queryset):
         if self.value():
             year = int(self.value())
-            # Example: filter voters born on or before target year
-            # This is just a sample; adjust logic as needed
-            return queryset.filter(dob__year__lte=year)
+            # Voters born on or before the target year, as a date range on the index
+            return queryset.filter(date_of_birth__lt=date(year + 1, 1, 1))
+        return queryset
+
+
+class AgeBandFilter(SimpleListFilter):
+    title = 'Age'
+    parameter_name = 'age'
+    BANDS = {'18-25': (18, 25), '26-40': (26, 40), '41-60': (41, 60), '61-80': (61, 80), '81+': (81, None)}
+
+    def lookups(self, request, model_admin):
+        return [(band, band) for band in self.BANDS]
+
+    def queryset(self, request, queryset):
+        if self.value() in self.BANDS:
+            return queryset.filter(**ages.dob_range(*self.BANDS[self.value()]))
         return queryset
         
 # Voter AdminPannel
@@ -101,13 +119,32 @@ class VoterAdmin(ImportExportModelAdmin):
     # These must be here, inside the Admin class
     list_display = ('id', 'name',"get_age_current_year", 'phone', 'epic_number', 'status')
     search_fields = ('name', 'phone', 'epic_number')
-    ordering = ('name', 'id','status','created_at')  
-    list_filter = ('status','created_at','gender',AgeYearFilter)
+    ordering = ('name', 'id')  # matches the (name, id) index; id is already unique
+    list_filter = ('status','created_at','gender',AgeBandFilter,AgeYearFilter)
     list_editable = ('status',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # no second COUNT(*) for "N total"
+
+    def get_queryset(self, request):
+        # Age computed by the database (not named `age`: that would shadow
+        # Voter.age()); the big columns are not needed for the list
+        return super().get_queryset(request).annotate(age_years=ages.age_expression()) \
+            .defer('address', 'aadhaar_encrypted')
     
     def get_age_current_year(self, obj):
-        return obj.age_on_year()  # default: current year
+        return obj.age_years
     get_age_current_year.short_description = "Age"
+    # Same order as age_years, but on the date_of_birth index
+    get_age_current_year.admin_order_field = F('date_of_birth').desc()
+
+    actions = ['export_roll_csv']
+
+    def export_roll_csv(self, request, queryset):
+        # Streams in chunks instead of building the file in memory like the import-export button
+        response = StreamingHttpResponse(exporter.stream_csv(queryset), content_type="text/csv")
+        response["Content-Disposition"] = 'attachment; filename="voters.csv"'
+        return response
+    export_roll_csv.short_description = "Export selected voters as CSV (streamed)"
     
 admin.site.register(Voter, VoterAdmin)
 
@@ -294,12 +331,52 @@ class TempVoterResource(resources.ModelResource):
     
     class Meta:
         model = TempVoter
+        exclude = ('aadhaar',)
         
 class TempVoterAdmin(ImportExportModelAdmin):
     resource_class = TempVoterResource
     
     # These must be here, inside the Admin class
-    list_display = ('batch_id', 'full_name', )
+    list_display = ('batch_id', 'row_number', 'full_name', 'is_valid', 'validation_error', )
+    list_filter = ('is_valid',)
     search_fields = ('batch_id', 'constituency_name',)
+    exclude = ('aadhaar',)
       
-admin.site.register(TempVoter, TempVoterAdmin)
\ No newline at end of file
+admin.site.register(TempVoter, TempVoterAdmin)
+
+# OutboxEvent AdminPannel
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'topic', 'aggregate_id', 'status', 'attempts', 'available_at', 'processed_at')
+    list_filter = ('status', 'topic')
+    search_fields = ('idempotency_key',)
+
+admin.site.register(OutboxEvent, OutboxEventAdmin)
+
+# ImportBatch AdminPannel (progress of `manage.py import_voters`)
+class ImportBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'source', 'status', 'staged_rows', 'valid_rows', 'invalid_rows', 'promoted_rows', 'updated_at')
+    list_filter = ('status',)
+    readonly_fields = ('validated_through', 'promoted_through', 'last_error')
+
+admin.site.register(ImportBatch, ImportBatchAdmin)
+
+# RollJob AdminPannel (progress of `manage.py generate_rolls`)
+class RollJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'state', 'level', 'status', 'units_done', 'units_total', 'pages', 'updated_at')
+    list_filter = ('status', 'level')
+    readonly_fields = ('archive', 'last_error')
+
+admin.site.register(RollJob, RollJobAdmin)
+
+# Voter statistics AdminPannel (read-only; `manage.py rebuild_voter_stats` recounts)
+class VoterStatAdmin(admin.ModelAdmin):
+    list_display = ('state_id', 'constituency_id', 'booth_id', 'gender', 'status', 'voters')
+    list_filter = ('status', 'gender')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+admin.site.register(VoterStat, VoterStatAdmin)
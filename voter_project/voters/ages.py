@@ -0,0 +1,54 @@
+"""
+Age arithmetic shared by models, serializers, views and reports.
+
+Callers that handle many voters take `today` once and pass it in, instead
+of calling date.today() per row.
+"""
+from datetime import date
+
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import ExtractYear
+
+
+def age_on(dob, on):
+    """Completed years between `dob` and the date `on`."""
+    return on.year - dob.year - ((on.month, on.day) < (dob.month, dob.day))
+
+
+def age_in_year(dob, year, today=None):
+    """Age on today's calendar day of `year` (Feb 29 birthdays count from Mar 1)."""
+    today = today or date.today()
+    return year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+
+
+def years_before(on, years):
+    """The same calendar day `years` earlier; Feb 29 falls back to Feb 28."""
+    try:
+        return on.replace(year=on.year - years)
+    except ValueError:
+        return on.replace(year=on.year - years, day=28)
+
+
+def dob_range(min_age=None, max_age=None, today=None, year=None):
+    """
+    date_of_birth lookups for voters aged min_age..max_age (inclusive) on
+    `today`, or as of `year` in the sense of age_in_year, so age filters
+    are index range scans instead of per-row math.
+    """
+    today = today or date.today()
+    shift = today.year - year if year is not None else 0
+    lookups = {}
+    if min_age is not None:
+        lookups["date_of_birth__lte"] = years_before(today, shift + min_age)
+    if max_age is not None:
+        lookups["date_of_birth__gt"] = years_before(today, shift + max_age + 1)
+    return lookups
+
+
+def age_expression(today=None, field="date_of_birth"):
+    """Age on `today` as a database expression, for annotate()."""
+    today = today or date.today()
+    birthday_ahead = Q(**{f"{field}__month__gt": today.month}) | \
+        Q(**{f"{field}__month": today.month, f"{field}__day__gt": today.day})
+    return Value(today.year) - ExtractYear(field) - Case(
+        When(birthday_ahead, then=Value(1)), default=Value(0), output_field=IntegerField())
@@ -0,0 +1,170 @@
+"""
+Allocators for voter identifiers that never collide and never retry.
+
+unique_code
+    The 8-digit code is a keyed permutation of a counter. The counter comes
+    from the "unique_code" Sequence row and is scrambled by a Feistel
+    network over 10^8 (two 4-digit halves), so distinct counters always give
+    distinct codes while consecutive voters get unrelated-looking ones.
+    Counters are reserved in blocks: a process pays one round trip per
+    UNIQUE_CODE_BLOCK codes, and `allocate(n)` hands a bulk import n codes
+    with one reservation.
+
+Blocks are only reserved in autocommit mode. A cached block reserved inside
+the caller's transaction would outlive a rollback of that transaction,
+which puts the counter back, and the same values would be handed out
+again by another process. So inside an atomic block an empty cache is not
+refilled: the value is reserved on its own in the caller's transaction and
+rolls back together with whatever used it.
+
+Identifiers issued before the allocators existed were random, so reserved
+values are checked against the Voter table and any already taken are
+skipped: unique codes with one IN query per chunk, EPIC blocks with a
+single range scan of the epic_number index. The permutation key defaults to
+SECRET_KEY; changing it (UNIQUE_CODE_KEY) only costs more skipped values.
+"""
+import hashlib
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import Sequence, Voter
+
+UNIQUE_CODE_DIGITS = 8
+UNIQUE_CODE_BLOCK = getattr(settings, "UNIQUE_CODE_BLOCK", 100)
+EPIC_DIGITS = 10
+EPIC_BLOCK = getattr(settings, "EPIC_BLOCK", 100)
+FEISTEL_ROUNDS = 8
+CHECK_CHUNK = 900  # stays under SQLite's default limit of 999 query parameters
+
+
+class SequenceExhausted(Exception):
+    pass
+
+
+def reserve(name, n):
+    """Atomically reserve `n` values of sequence `name`; returns the first."""
+    with transaction.atomic():
+        # The UPDATE takes the row lock, so concurrent reservations serialize here
+        if not Sequence.objects.filter(name=name).update(next_value=F("next_value") + n):
+            Sequence.objects.get_or_create(name=name)
+            Sequence.objects.filter(name=name).update(next_value=F("next_value") + n)
+        end = Sequence.objects.filter(name=name).values_list("next_value", flat=True).get()
+    return end - n
+
+
+class FeistelPermutation:
+    """A keyed bijection on [0, 10^digits) for an even number of digits."""
+
+    def __init__(self, key, digits=UNIQUE_CODE_DIGITS, rounds=FEISTEL_ROUNDS):
+        self.half = 10 ** (digits // 2)
+        self.size = self.half * self.half
+        key = hashlib.blake2b(key.encode(), digest_size=32).digest()
+        # Round functions as lookup tables: 10^4 entries per round, built once
+        self.tables = [
+            [int.from_bytes(hashlib.blake2b(b"%d:%d" % (r, x), key=key, digest_size=8).digest(), "big") % self.half
+             for x in range(self.half)]
+            for r in range(rounds)
+        ]
+
+    def __call__(self, value):
+        half = self.half
+        left, right = divmod(value, half)
+        for table in self.tables:
+            left, right = right, (left + table[right]) % half
+        return left * half + right
+
+
+class UniqueCodeAllocator:
+    def __init__(self, sequence="unique_code", block_size=UNIQUE_CODE_BLOCK, key=None):
+        self.sequence = sequence
+        self.block_size = block_size
+        self.key = key
+        self.block = deque()
+        self._permutation = None
+        self._lock = threading.Lock()
+
+    @property
+    def permutation(self):
+        if self._permutation is None:
+            self._permutation = FeistelPermutation(self.key or getattr(settings, "UNIQUE_CODE_KEY", settings.SECRET_KEY))
+        return self._permutation
+
+    def code(self, counter):
+        return f"{self.permutation(counter):0{UNIQUE_CODE_DIGITS}d}"
+
+    def allocate(self, n):
+        """`n` fresh codes, reserved in one block."""
+        codes = []
+        while len(codes) < n:
+            wanted = n - len(codes)
+            start = reserve(self.sequence, wanted)
+            if start + wanted > self.permutation.size:
+                raise SequenceExhausted(f"{self.sequence}: all {self.permutation.size} codes are used")
+            block = [self.code(counter) for counter in range(start, start + wanted)]
+            taken = set()
+            for i in range(0, len(block), CHECK_CHUNK):
+                chunk = block[i:i + CHECK_CHUNK]
+                taken.update(Voter.objects.filter(unique_code__in=chunk).values_list("unique_code", flat=True))
+            codes.extend(code for code in block if code not in taken)
+        return codes
+
+    def next(self):
+        with self._lock:
+            if self.block:
+                return self.block.popleft()
+            if not transaction.get_connection().in_atomic_block:
+                self.block.extend(self.allocate(self.block_size))
+                return self.block.popleft()
+        # Not under the lock: the sequence row stays locked until the caller commits
+        return self.allocate(1)[0]
+
+
+class EpicAllocator:
+    def __init__(self, block_size=EPIC_BLOCK):
+        self.block_size = block_size
+        self.blocks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sequence(state):
+        return f"epic:{state.pk}"
+
+    @staticmethod
+    def epic(prefix, number):
+        return f"{prefix}{number:0{EPIC_DIGITS}d}"
+
+    def allocate(self, state, n):
+        """`n` fresh EPIC numbers for `state`, in ascending order."""
+        prefix = state.epic_prefix.upper()
+        epics = []
+        while len(epics) < n:
+            wanted = n - len(epics)
+            first = reserve(self.sequence(state), wanted) + 1  # numbering starts at 1
+            last = first + wanted - 1
+            if last >= 10 ** EPIC_DIGITS:
+                raise SequenceExhausted(f"{self.sequence(state)}: no EPIC numbers left for {prefix}")
+            taken = set(
+                Voter.objects.filter(epic_number__gte=self.epic(prefix, first), epic_number__lte=self.epic(prefix, last))
+                .values_list("epic_number", flat=True)
+            )
+            epics.extend(epic for epic in (self.epic(prefix, i) for i in range(first, last + 1)) if epic not in taken)
+        return epics
+
+    def next(self, state):
+        with self._lock:
+            block = self.blocks.setdefault(state.pk, deque())
+            if block:
+                return block.popleft()
+            if not transaction.get_connection().in_atomic_block:
+                block.extend(self.allocate(state, self.block_size))
+                return block.popleft()
+        # See UniqueCodeAllocator.next
+        return self.allocate(state, 1)[0]
+
+
+unique_codes = UniqueCodeAllocator()
+epic_numbers = EpicAllocator()
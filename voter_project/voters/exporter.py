@@ -0,0 +1,178 @@
+"""
+Streaming voter roll export.
+
+Rows are read with VoterReadEncoder's single joined `.values()` query and
+`iterator(chunk_size)`, and each chunk is written out before the next is
+fetched, so memory stays at one chunk whatever the size of the roll.
+
+    csv       header row, then VoterReadEncoder.fields; gzip when compressed
+    ndjson    one JSON object per line, same as the search API's ?stream=1
+    parquet   one Arrow record batch per chunk, zstd when compressed
+
+With `shard_by` ("constituency" or "booth") the rows are ordered by that
+key and each value gets its own file, written one after the other so only
+one file is open at a time.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+
+from . import ages
+from .serializers import VoterReadEncoder
+
+CHUNK_SIZE = 10000
+COMPRESSLEVEL = 1  # gzip's fastest level keeps up with the disk; heavier levels are CPU bound
+SHARD_KEYS = {"constituency": "constituency_id", "booth": "booth_id"}
+FORMATS = ("csv", "ndjson", "parquet")
+
+
+def open_text(path, compress):
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=COMPRESSLEVEL)
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+class CsvWriter:
+    suffix = ".csv"
+
+    def __init__(self, path, encoder, compress):
+        self.encoder = encoder
+        self.file = open_text(path, compress)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(encoder.fields)
+
+    def write(self, rows):
+        fields = self.encoder.fields
+        self.writer.writerows([row[f] for f in fields] for row in self.encoder.encode(rows))
+
+    def close(self):
+        self.file.close()
+
+
+class NdjsonWriter:
+    suffix = ".ndjson"
+
+    def __init__(self, path, encoder, compress):
+        self.encoder = encoder
+        self.file = open_text(path, compress)
+
+    def write(self, rows):
+        self.file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in self.encoder.encode(rows)))
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    suffix = ".parquet"
+
+    def __init__(self, path, encoder, compress):
+        import pyarrow as pa  # only needed for Parquet exports
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.encoder = encoder
+        types = {"id": pa.int64(), "age": pa.int16(), "date_of_birth": pa.date32(),
+                 "created_at": pa.timestamp("us", tz="UTC"), "updated_at": pa.timestamp("us", tz="UTC")}
+        self.schema = pa.schema([(f, types.get(f, pa.string())) for f in encoder.fields])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd" if compress else "none")
+
+    def write(self, rows):
+        # Native types straight from .values(); only age and the joined names are derived
+        today = self.encoder.today
+        columns = {
+            f: [row[self.encoder.related.get(f, f)] for row in rows]
+            for f in self.encoder.fields if f != "age"
+        }
+        columns["age"] = [ages.age_on(dob, today) for dob in columns["date_of_birth"]]
+        self.writer.write_batch(self.pa.RecordBatch.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {"csv": CsvWriter, "ndjson": NdjsonWriter, "parquet": ParquetWriter}
+
+
+def file_name(prefix, writer, compress, shard=None):
+    name = prefix if shard is None else f"{prefix}-{shard}"
+    name += writer.suffix
+    if compress and writer is not ParquetWriter:
+        name += ".gz"
+    return name
+
+
+def export(queryset, directory, format="csv", shard_by=None, compress=True, prefix="voters",
+           chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Write `queryset` to `directory`; returns [(path, rows)] per file written.
+    Shard files are named <prefix>-<id> ("none" for voters without a booth).
+    """
+    writer_class = WRITERS[format]
+    encoder = VoterReadEncoder()
+    shard_key = SHARD_KEYS[shard_by] if shard_by else None
+    columns = encoder.columns + ([shard_key] if shard_key else [])
+    order = (shard_key, "id") if shard_key else ("id",)
+    rows = queryset.order_by(*order).values(*columns).iterator(chunk_size=chunk_size)
+    os.makedirs(directory, exist_ok=True)
+
+    written = []
+    writer = None
+    shard = object()
+
+    def open_file(value):
+        nonlocal writer
+        if writer is not None:
+            writer.close()
+        path = os.path.join(directory, file_name(prefix, writer_class, compress,
+                                                 None if shard_key is None else ("none" if value is None else value)))
+        writer = writer_class(path, encoder, compress)
+        written.append([path, 0])
+
+    def flush(chunk):
+        writer.write(chunk)
+        written[-1][1] += len(chunk)
+        if progress:
+            progress(*written[-1])
+
+    chunk = []
+    for row in rows:
+        value = row[shard_key] if shard_key else None
+        if value != shard:
+            if chunk:
+                flush(chunk)
+                chunk = []
+            open_file(value)
+            shard = value
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if writer is None and shard_key is None:
+        open_file(None)  # an empty roll still gets its (header-only) file
+    if chunk:
+        flush(chunk)
+    if writer is not None:
+        writer.close()
+    return [tuple(item) for item in written]
+
+
+def stream_csv(queryset, chunk_size=CHUNK_SIZE):
+    """CSV bytes for a StreamingHttpResponse, one chunk of rows at a time."""
+    encoder = VoterReadEncoder()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(encoder.fields)
+    chunk = []
+    for row in queryset.order_by("id").values(*encoder.columns).iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            writer.writerows([r[f] for f in encoder.fields] for r in encoder.encode(chunk))
+            chunk = []
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    writer.writerows([r[f] for f in encoder.fields] for r in encoder.encode(chunk))
+    yield buffer.getvalue().encode()
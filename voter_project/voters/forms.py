@@ -1,16 +1,5 @@
 from django import forms
 from .models import Voter
-import random
-
-def generate_unique_code(length=8):
-    """
-    Generate a globally unique numeric code of given length.
-    Checks existing codes in the DB to avoid collisions.
-    """
-    while True:
-        code = f"{random.randint(0, 10**length - 1):0{length}d}"  # zero-padded
-        if not Voter.objects.filter(unique_code=code).exists():
-            return code
 
 class VoterForm(forms.ModelForm):
     aadhaar = forms.CharField(
@@ -38,9 +27,8 @@ class VoterForm(forms.ModelForm):
         # Encrypt and set Aadhaar
         instance.set_aadhaar(self.cleaned_data['aadhaar'])
         
-        # Generate unique code automatically
-        instance.unique_code = generate_unique_code(length=8)
-        
+        # unique_code was assigned by the model default (voters/allocators.py)
+
         if commit:
             instance.save()
         return instance
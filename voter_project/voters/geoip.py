@@ -0,0 +1,91 @@
+"""
+Login geolocation from a local MaxMind database.
+
+Lookups go through django.contrib.gis.geoip2 against the city database in
+settings.GEOIP_PATH and are cached per network prefix (/24 for IPv4, /48
+for IPv6): city-level data does not differ inside a prefix, so a login
+storm from one office resolves once. When the database is not installed,
+`locate` returns None and the caller queues a "login.geolocate" outbox
+event, which resolves the address over HTTP off the request path.
+"""
+import ipaddress
+import logging
+import threading
+from functools import lru_cache
+
+import requests
+from django.conf import settings
+from django.contrib.gis.geoip2 import GeoIP2, GeoIP2Exception
+from geoip2.errors import AddressNotFoundError, GeoIP2Error
+from maxminddb import InvalidDatabaseError
+
+logger = logging.getLogger(__name__)
+
+GEOIP_CACHE_SIZE = getattr(settings, "GEOIP_CACHE_SIZE", 65536)
+ENRICHMENT_URL = "https://ipapi.co/{ip}/json/"
+ENRICHMENT_TIMEOUT = 3
+
+_reader = None
+_reader_failed = False
+_reader_lock = threading.Lock()
+
+
+def get_reader():
+    """The shared GeoIP2 reader, or None when no database is installed."""
+    global _reader, _reader_failed
+    if _reader is None and not _reader_failed:
+        with _reader_lock:
+            if _reader is None and not _reader_failed:
+                try:
+                    _reader = GeoIP2()
+                except (GeoIP2Exception, OSError, ValueError):
+                    _reader_failed = True
+    return _reader
+
+
+def prefix(ip):
+    """Cache key for `ip`, or None for private, loopback and malformed addresses."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if not address.is_global:
+        return None
+    length = 24 if address.version == 4 else 48
+    return str(ipaddress.ip_network(f"{address}/{length}", strict=False).network_address)
+
+
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def _locate_prefix(network_address):
+    """A prefix the database has no entry for is cached as None; errors raise and are not cached."""
+    try:
+        latitude, longitude = get_reader().lat_lon(network_address)
+    except AddressNotFoundError:
+        return None
+    return {"latitude": latitude, "longitude": longitude}
+
+
+def locate(ip):
+    """{'latitude', 'longitude'} for a public IP, from the local database only."""
+    key = prefix(ip or "")
+    if key is None or get_reader() is None:
+        return None
+    try:
+        return _locate_prefix(key)
+    except (GeoIP2Exception, GeoIP2Error, InvalidDatabaseError, OSError, ValueError):
+        # A damaged or unsuitable database must not fail the login; the next login retries
+        logger.exception("GeoIP lookup failed for %s", key)
+        return None
+
+
+def needs_enrichment(ip):
+    """True when `ip` could be located but the local database is missing."""
+    return prefix(ip or "") is not None and get_reader() is None
+
+
+def fetch_location(ip):
+    """Remote lookup used by the outbox handler only."""
+    response = requests.get(ENRICHMENT_URL.format(ip=ip), timeout=ENRICHMENT_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    return {"latitude": data.get("latitude"), "longitude": data.get("longitude")}
@@ -0,0 +1,336 @@
+"""
+Bulk voter import through the TempVoter staging table.
+
+An import is an ImportBatch that goes through three stages. Each stage
+works in chunks of CHUNK_SIZE rows, and each chunk commits together with
+the batch's checkpoint:
+
+    stage     stream the CSV/XLSX file into TempVoter with bulk_create
+    validate  check a chunk of staged rows in the database with one UPDATE
+              per check (age, phone, Aadhaar, choices); state/constituency
+              names are looked up once per distinct pair in the chunk
+    promote   bulk_create Voters from the valid rows, with unique codes and
+              EPIC numbers allocated per chunk (voters/allocators.py)
+
+`run(batch)` on a stopped import resumes after the last committed chunk of
+the stage it was in. bulk_create sends no post_save, so promotion updates
+the search index and queues the stats delta itself; imported voters have no photo, so there is no
+face registration to queue and nothing to audit.
+"""
+import csv
+import itertools
+import operator
+import os
+from datetime import date, datetime
+from functools import reduce
+
+from cryptography.fernet import Fernet
+from django.db import transaction
+from django.db.models import Case, F, Q, TextField, Value, When
+from django.db.models.functions import Concat, Length
+from django.db.models.lookups import GreaterThan
+
+from . import ages, outbox, search_index, stats
+from .allocators import epic_numbers, unique_codes
+from .models import Constituency, ImportBatch, State, TempVoter, Voter
+
+CHUNK_SIZE = 5000
+
+# TempVoter field -> accepted header names, case-insensitive
+COLUMNS = {
+    "full_name": ("name", "full_name"),
+    "state_name": ("state", "state_name"),
+    "constituency_name": ("constituency", "constituency_name"),
+    "dob": ("date_of_birth", "dob"),
+    "gender": ("gender",),
+    "phone": ("phone",),
+    "address": ("address",),
+    "aadhaar": ("aadhaar",),
+    "relation_type": ("relation_type",),
+    "relation_name": ("relative_name", "relation_name"),
+}
+REQUIRED_COLUMNS = ("full_name", "state_name", "constituency_name", "dob", "phone", "address")
+DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y")
+PHONE_PATTERN = r"^[0-9]{10}$"
+AADHAAR_PATTERN = r"^[0-9]{12}$"
+PAIRS_PER_UPDATE = 400  # unknown (state, constituency) pairs OR-ed into one UPDATE
+
+
+def choices(field):
+    return {value.lower(): value for value, _ in Voter._meta.get_field(field).choices}
+
+
+GENDERS = choices("gender")
+RELATION_TYPES = choices("relation_type")
+RELATIVE_NAME_LENGTH = Voter._meta.get_field("relative_name").max_length
+
+
+class ImportFileError(ValueError):
+    pass
+
+
+## Reading the source file
+
+def read_rows(path):
+    """The header row, then one tuple per data row, streamed from disk."""
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook  # only needed for Excel sources
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    else:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            yield from csv.reader(f)
+
+
+def column_map(header):
+    positions = {str(name).strip().lower(): i for i, name in enumerate(header or ()) if name is not None}
+    columns = {}
+    for field, names in COLUMNS.items():
+        for name in names:
+            if name in positions:
+                columns[field] = positions[name]
+                break
+    missing = [COLUMNS[field][0] for field in REQUIRED_COLUMNS if field not in columns]
+    if missing:
+        raise ImportFileError(f"Missing columns: {', '.join(missing)}")
+    return columns
+
+
+def text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # Excel stores phone and Aadhaar numbers as floats
+    return str(value).strip()
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    value = text(value)
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+
+## Stages
+
+def stage(batch, chunk_size=CHUNK_SIZE, progress=None):
+    rows = read_rows(batch.source)
+    columns = column_map(next(rows, None))
+    number = batch.staged_rows
+    rows = itertools.islice(rows, number, None)  # resume after the rows already staged
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        staged = []
+        for row in chunk:
+            number += 1
+            if not any(text(value) for value in row):
+                continue
+            values = {field: row[i] if i < len(row) else None for field, i in columns.items()}
+            staged.append(TempVoter(
+                batch_id=batch.pk,
+                row_number=number,
+                full_name=text(values["full_name"]),
+                state_name=text(values["state_name"]),
+                constituency_name=text(values["constituency_name"]),
+                dob=parse_date(values["dob"]),
+                gender=text(values.get("gender"))[:10],
+                phone=text(values["phone"])[:15],
+                address=text(values["address"]),
+                aadhaar=text(values.get("aadhaar"))[:12] or None,
+                relation_type=text(values.get("relation_type"))[:20] or None,
+                relation_name=text(values.get("relation_name")) or None,
+            ))
+        with transaction.atomic():
+            TempVoter.objects.bulk_create(staged)
+            ImportBatch.objects.filter(pk=batch.pk).update(staged_rows=number)
+        batch.staged_rows = number
+        if progress:
+            progress(batch, "stage")
+
+
+def constituency_map():
+    """{(state name, constituency name) lowercased: (state_id, constituency_id)}"""
+    rows = Constituency.objects.values_list("state__name", "name", "state_id", "id").order_by("-id")
+    return {(state.lower(), name.lower()): (state_id, pk) for state, name, state_id, pk in rows}
+
+
+def chunk_checks(chunk, constituencies, today):
+    """
+    (message, [conditions]) for each check, in the order the messages are
+    listed. A condition matches the staged rows in `chunk` that fail it; the
+    state/constituency check looks up the chunk's distinct name pairs once
+    and matches the unknown ones (in slices, to bound the statement size).
+    """
+    pairs = chunk.order_by().values_list("state_name", "constituency_name").distinct()
+    unknown = [Q(state_name=state, constituency_name=name) for state, name in pairs
+               if (state.lower(), name.lower()) not in constituencies]
+    return [
+        ("name is required", [Q(full_name="")]),
+        ("unknown state/constituency",
+         [reduce(operator.or_, unknown[i:i + PAIRS_PER_UPDATE]) for i in range(0, len(unknown), PAIRS_PER_UPDATE)]),
+        ("invalid date of birth", [Q(dob=None)]),
+        ("voter must be at least 18 years old", [Q(dob__gt=ages.years_before(today, 18))]),
+        ("phone number must be 10 digits", [~Q(phone__regex=PHONE_PATTERN)]),
+        ("Aadhaar must be 12 digits", [Q(aadhaar__isnull=False) & ~Q(aadhaar__regex=AADHAAR_PATTERN)]),
+        ("address is required", [Q(address="")]),
+        ("unknown gender", [~Q(gender="") & ~one_of("gender", GENDERS)]),
+        ("unknown relation type", [Q(relation_type__isnull=False) & ~one_of("relation_type", RELATION_TYPES)]),
+        (f"relative name longer than {RELATIVE_NAME_LENGTH} characters",
+         [Q(GreaterThan(Length("relation_name"), RELATIVE_NAME_LENGTH))]),
+    ]
+
+
+def one_of(field, values):
+    return reduce(operator.or_, (Q(**{f"{field}__iexact": value}) for value in values))
+
+
+def add_error(message):
+    """validation_error with `message` appended, "; "-separated."""
+    return Case(When(validation_error=None, then=Value(message)),
+                default=Concat("validation_error", Value(f"; {message}")), output_field=TextField())
+
+
+STAGED_FIELDS = ("id", "full_name", "state_name", "constituency_name", "dob", "gender", "phone",
+                 "address", "aadhaar", "relation_type", "relation_name")
+
+
+def validate(batch, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Check the staged rows a chunk at a time in the database: one UPDATE per
+    check marks every failing row of the chunk, so no row is read back.
+    """
+    constituencies = constituency_map()
+    today = date.today()
+    while True:
+        ids = list(
+            TempVoter.objects.filter(batch_id=batch.pk, id__gt=batch.validated_through)
+            .order_by("id").values_list("id", flat=True)[:chunk_size]
+        )
+        if not ids:
+            break
+        last = ids[-1]
+        chunk = TempVoter.objects.filter(batch_id=batch.pk, id__gt=batch.validated_through, id__lte=last)
+
+        with transaction.atomic():
+            chunk.update(is_valid=True, validation_error=None)
+            for message, conditions in chunk_checks(chunk, constituencies, today):
+                for condition in conditions:
+                    chunk.filter(condition).update(is_valid=False, validation_error=add_error(message))
+            invalid = chunk.filter(is_valid=False).count()
+            ImportBatch.objects.filter(pk=batch.pk).update(
+                validated_through=last,
+                valid_rows=F("valid_rows") + len(ids) - invalid,
+                invalid_rows=F("invalid_rows") + invalid,
+            )
+        batch.validated_through = last
+        batch.valid_rows += len(ids) - invalid
+        batch.invalid_rows += invalid
+        if progress:
+            progress(batch, "validate")
+
+
+def promote(batch, chunk_size=CHUNK_SIZE, progress=None):
+    constituencies = constituency_map()
+    states = State.objects.in_bulk()
+    fernet = Fernet(Voter.AES_KEY)
+    while True:
+        rows = list(
+            TempVoter.objects.filter(batch_id=batch.pk, is_valid=True, id__gt=batch.promoted_through)
+            .order_by("id").values(*STAGED_FIELDS)[:chunk_size]
+        )
+        if not rows:
+            break
+        last = rows[-1]["id"]
+
+        # Identifiers are reserved outside the transaction: a rolled back
+        # chunk only leaves a gap in the sequences
+        placed = [constituencies[row["state_name"].lower(), row["constituency_name"].lower()] for row in rows]
+        codes = iter(unique_codes.allocate(len(rows)))
+        per_state = {}
+        for state_id, _ in placed:
+            per_state[state_id] = per_state.get(state_id, 0) + 1
+        epics = {state_id: iter(epic_numbers.allocate(states[state_id], n)) for state_id, n in per_state.items()}
+
+        voters = []
+        for row, (state_id, constituency_id) in zip(rows, placed):
+            voter = Voter(
+                state_id=state_id,
+                constituency_id=constituency_id,
+                epic_number=next(epics[state_id]),
+                unique_code=next(codes),
+                name=row["full_name"],
+                date_of_birth=row["dob"],
+                phone=row["phone"],
+                address=row["address"],
+                aadhaar_encrypted=fernet.encrypt(row["aadhaar"].encode()) if row["aadhaar"] else None,
+            )
+            if row["gender"]:
+                voter.gender = GENDERS[row["gender"].lower()]
+            if row["relation_type"]:
+                voter.relation_type = RELATION_TYPES[row["relation_type"].lower()]
+            if row["relation_name"]:
+                voter.relative_name = row["relation_name"]
+            voters.append(voter)
+
+        with transaction.atomic():
+            created = Voter.objects.bulk_create(voters, batch_size=1000)
+            # bulk_create sends no post_save: one stats delta for the whole chunk
+            outbox.enqueue(outbox.event(stats.TOPIC, f"import:{batch.pk}:{last}", stats.created_delta(created)))
+            TempVoter.objects.filter(batch_id=batch.pk, id__gt=batch.promoted_through, id__lte=last) \
+                .update(aadhaar=None)
+            ImportBatch.objects.filter(pk=batch.pk).update(
+                promoted_through=last, promoted_rows=F("promoted_rows") + len(created))
+            transaction.on_commit(lambda: search_index.sync_voters(created))
+        batch.promoted_through = last
+        batch.promoted_rows += len(created)
+        if progress:
+            progress(batch, "promote")
+
+
+## Driver
+
+def start(path):
+    if not os.path.exists(path):
+        raise ImportFileError(f"No such file: {path}")
+    return ImportBatch.objects.create(source=os.path.abspath(path))
+
+
+def advance(batch, status):
+    ImportBatch.objects.filter(pk=batch.pk).update(status=status, last_error=None)
+    batch.status = status
+
+
+def run(batch, chunk_size=CHUNK_SIZE, promote_rows=True, progress=None):
+    """
+    Run `batch` from its current stage. With promote_rows=False it stops
+    after validation, leaving invalid rows to inspect before promoting.
+    """
+    try:
+        if batch.status == "staging":
+            stage(batch, chunk_size, progress)
+            advance(batch, "validating")
+        if batch.status == "validating":
+            validate(batch, chunk_size, progress)
+            advance(batch, "promoting")
+        if batch.status == "promoting" and promote_rows:
+            promote(batch, chunk_size, progress)
+            # Rows left behind are invalid ones; they keep everything but the Aadhaar
+            TempVoter.objects.filter(batch_id=batch.pk).exclude(aadhaar=None).update(aadhaar=None)
+            advance(batch, "done")
+    except Exception as exc:
+        ImportBatch.objects.filter(pk=batch.pk).update(last_error=repr(exc))
+        raise
+    return batch
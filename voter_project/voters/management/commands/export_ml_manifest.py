@@ -0,0 +1,61 @@
+import csv
+import os
+
+from django.core.management.base import BaseCommand
+
+from voters.models import BiometricData, Voter
+
+
+class Command(BaseCommand):
+    help = "Write the CSV manifest used by fastapi_service/rebuild_store.py to rebuild the ML embedding store"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Path of the CSV file to write")
+        parser.add_argument("--include-inactive", action="store_true",
+                            help="Also export voters whose status is not 'active'")
+        parser.add_argument("--biometrics-dir",
+                            help="Dump BiometricData blobs here and list them in the manifest")
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def dump_biometrics(self, directory, field, suffix, chunk_size):
+        """Write the latest `field` blob of every voter to <dir>/<voter_id>.<suffix>."""
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        rows = (
+            BiometricData.objects.exclude(**{field: None})
+            .order_by("voter_id", "-updated_at")
+            .values_list("voter_id", field)
+        )
+        for voter_id, blob in rows.iterator(chunk_size=chunk_size):
+            if voter_id in paths or not blob:
+                continue
+            path = os.path.join(directory, f"{voter_id}.{suffix}")
+            with open(path, "wb") as f:
+                f.write(blob)
+            paths[voter_id] = path
+        return paths
+
+    def handle(self, *args, **options):
+        qs = Voter.objects.all()
+        if not options["include_inactive"]:
+            qs = qs.filter(status="active")
+        rows = qs.order_by("id").values_list(
+            "id", "state__name", "constituency__name", "photo_url", "signature_url"
+        )
+
+        fingerprints = irises = {}
+        if options["biometrics_dir"]:
+            fingerprints = self.dump_biometrics(options["biometrics_dir"], "fingerprint_data", "fp",
+                                                options["chunk_size"])
+            irises = self.dump_biometrics(options["biometrics_dir"], "iris_scan_data", "iris",
+                                          options["chunk_size"])
+
+        count = 0
+        with open(options["output"], "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["voter_id", "state", "constituency", "photo_path", "signature_path",
+                             "fingerprint_path", "iris_path"])
+            for row in rows.iterator(chunk_size=options["chunk_size"]):
+                writer.writerow(row + (fingerprints.get(row[0], ""), irises.get(row[0], "")))
+                count += 1
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} voters to {options['output']}"))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from voters import exporter
+from voters.models import Voter
+
+
+class Command(BaseCommand):
+    help = "Export voter rolls to CSV, NDJSON or Parquet files in bounded memory (see voters/exporter.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory")
+        parser.add_argument("--format", choices=exporter.FORMATS, default="csv")
+        parser.add_argument("--state", type=int, metavar="STATE_ID")
+        parser.add_argument("--constituency", type=int, metavar="CONSTITUENCY_ID")
+        parser.add_argument("--status", default="active", help='Voter status to export, or "all"')
+        parser.add_argument("--shard-by", choices=sorted(exporter.SHARD_KEYS),
+                            help="One file per constituency or booth")
+        parser.add_argument("--no-compress", action="store_true")
+        parser.add_argument("--prefix", default="voters")
+        parser.add_argument("--chunk-size", type=int, default=exporter.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        queryset = Voter.objects.all()
+        if options["status"] != "all":
+            queryset = queryset.filter(status=options["status"])
+        if options["state"]:
+            queryset = queryset.filter(state_id=options["state"])
+        if options["constituency"]:
+            queryset = queryset.filter(constituency_id=options["constituency"])
+
+        try:
+            files = exporter.export(
+                queryset, options["directory"], options["format"], options["shard_by"],
+                compress=not options["no_compress"], prefix=options["prefix"], chunk_size=options["chunk_size"],
+            )
+        except ImportError as exc:
+            raise CommandError(f"{options['format']} export needs an extra package: {exc}")
+        for path, rows in files:
+            self.stdout.write(f"  {path}: {rows} rows")
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {sum(rows for _, rows in files)} voters to {len(files)} file(s)"))
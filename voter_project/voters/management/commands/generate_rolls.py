@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from voters import rolls
+from voters.models import RollJob, State
+from voters.pdf_cache import PDF_WORKERS
+
+
+class Command(BaseCommand):
+    help = "Generate booth- or constituency-wise electoral roll PDFs for a state into a ZIP (see voters/rolls.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--state", help="State id or EPIC prefix")
+        parser.add_argument("--level", choices=["booth", "constituency"], default="booth")
+        parser.add_argument("--output", help="Directory for the unit PDFs and the ZIP")
+        parser.add_argument("--resume", type=int, metavar="JOB_ID",
+                            help="Continue a stopped job, skipping the rolls already written")
+        parser.add_argument("--workers", type=int, default=PDF_WORKERS)
+
+    def handle(self, *args, **options):
+        if options["resume"]:
+            try:
+                job = RollJob.objects.select_related("state").get(pk=options["resume"])
+            except RollJob.DoesNotExist:
+                raise CommandError(f"No roll job {options['resume']}")
+        else:
+            if not options["state"] or not options["output"]:
+                raise CommandError("Give --state and --output, or --resume JOB_ID")
+            lookup = {"pk": options["state"]} if options["state"].isdigit() else \
+                {"epic_prefix__iexact": options["state"]}
+            try:
+                state = State.objects.get(**lookup)
+            except State.DoesNotExist:
+                raise CommandError(f"No state {options['state']}")
+            job = rolls.start(state, options["level"], options["output"])
+        self.stdout.write(f"Roll job {job.pk}: {job.state} by {job.level} into {job.output_dir}")
+
+        def progress(job, unit):
+            self.stdout.write(f"  {unit.name}.pdf ({job.units_done}/{job.units_total} rolls, {job.pages} pages)")
+
+        rolls.run(job, options["workers"], progress)
+        self.stdout.write(self.style.SUCCESS(f"Roll job {job.pk} done: {job.units_total} rolls in {job.archive}"))
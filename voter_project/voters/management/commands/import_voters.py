@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from voters import importer
+from voters.models import ImportBatch
+
+
+class Command(BaseCommand):
+    help = "Bulk import voters from a CSV/XLSX file through TempVoter staging (see voters/importer.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", help="CSV or XLSX file with a header row")
+        parser.add_argument("--resume", type=int, metavar="BATCH_ID",
+                            help="Continue a stopped import instead of starting a new one")
+        parser.add_argument("--chunk-size", type=int, default=importer.CHUNK_SIZE)
+        parser.add_argument("--no-promote", action="store_true",
+                            help="Stop after validation; promote later with --resume")
+
+    def handle(self, *args, **options):
+        if options["resume"]:
+            try:
+                batch = ImportBatch.objects.get(pk=options["resume"])
+            except ImportBatch.DoesNotExist:
+                raise CommandError(f"No import batch {options['resume']}")
+        elif options["path"]:
+            try:
+                batch = importer.start(options["path"])
+            except importer.ImportFileError as exc:
+                raise CommandError(str(exc))
+        else:
+            raise CommandError("Give a file to import or --resume BATCH_ID")
+        self.stdout.write(f"Import batch {batch.pk}: {batch.source}")
+
+        def progress(batch, stage):
+            self.stdout.write(
+                f"  {stage}: staged {batch.staged_rows}, valid {batch.valid_rows}, "
+                f"invalid {batch.invalid_rows}, promoted {batch.promoted_rows}")
+
+        try:
+            importer.run(batch, options["chunk_size"], not options["no_promote"], progress)
+        except importer.ImportFileError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(
+            f"Import batch {batch.pk} {batch.status}: {batch.promoted_rows} voters created, "
+            f"{batch.invalid_rows} rows invalid (see TempVoter.validation_error)"))
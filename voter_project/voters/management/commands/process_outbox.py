@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from voters import outbox
+
+
+class Command(BaseCommand):
+    help = "Run the handlers for pending OutboxEvent rows (see voters/outbox.py)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=outbox.BATCH_SIZE)
+        parser.add_argument("--max-attempts", type=int, default=outbox.MAX_ATTEMPTS)
+        parser.add_argument("--sleep", type=float, default=1.0,
+                            help="Seconds to wait when there is nothing to do")
+        parser.add_argument("--once", action="store_true",
+                            help="Drain what is due now and exit instead of polling")
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            claimed = outbox.process_batch(options["batch_size"], options["max_attempts"])
+            processed += claimed
+            if claimed:
+                continue
+            if options["once"]:
+                break
+            time.sleep(options["sleep"])
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} outbox events"))
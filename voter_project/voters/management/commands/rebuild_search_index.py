@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from voters.models import Voter
+from voters.search_index import index
+
+FIELDS = ("id", "name", "phone", "epic_number", "unique_code")
+
+
+def load(voter_ids):
+    # Current rows of voters saved or deleted while the rebuild runs
+    return Voter.objects.filter(id__in=voter_ids, status="active").values_list(*FIELDS)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the voter search index (voters/search_index.py) from the voters table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        rows = (
+            Voter.objects.filter(status="active")
+            .order_by("id")
+            .values_list(*FIELDS)
+            .iterator(chunk_size=options["chunk_size"])
+        )
+        count = index.rebuild(rows, batch_size=options["chunk_size"], load=load)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} voters (generation {index.generation()})"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from voters import stats
+
+
+class Command(BaseCommand):
+    help = "Recount the voter statistics tables (voters/stats.py) from the voters table"
+
+    def handle(self, *args, **options):
+        result = stats.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {result['groups']} groups, {result['age_groups']} age groups and {result['days']} days; "
+            f"superseded {result['superseded']} pending deltas"))
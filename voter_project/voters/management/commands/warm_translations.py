@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from voters.models import Booth, Constituency, State, Voter
+from voters.translation import memory
+
+
+class Command(BaseCommand):
+    help = "Pre-translate common values (states, constituencies, booths, choice labels) into the translation memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200,
+                            help="Strings sent to the translator per call")
+
+    def handle(self, *args, **options):
+        texts = set()
+        for model in (State, Constituency, Booth):
+            texts.update(model.objects.values_list("name", flat=True).distinct())
+        for field in ("gender", "relation_type", "status"):
+            texts.update(str(label) for value, label in Voter._meta.get_field(field).choices)
+            texts.update(value for value, label in Voter._meta.get_field(field).choices)
+
+        texts = sorted(texts)
+        translated = 0
+        for start in range(0, len(texts), options["batch_size"]):
+            translated += len(memory.lookup_many(texts[start:start + options["batch_size"]]))
+        self.stdout.write(self.style.SUCCESS(f"Translation memory holds {translated} of {len(texts)} values"))
@@ -0,0 +1,292 @@
+"""
+Client for the FastAPI ML service.
+
+One client per process (see get_ml_client) holds a keep-alive connection
+pool, bounded timeouts and retries for idempotent calls, and a circuit
+breaker: after repeated failures calls fail fast with MLServiceUnavailable
+instead of tying up the Django worker until the ML service recovers.
+Face registrations are queued and sent in batches to /register_faces/
+from a background thread, so saving a voter never waits on the ML service.
+
+Settings (all optional) live in settings.ML_SERVICE, see DEFAULTS. Set
+"BACKEND": "fake" to use FakeMLBackend, an in-process stand-in for tests
+and benchmarks.
+"""
+import hashlib
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "BACKEND": "http",
+    "URL": "http://127.0.0.1:8001",
+    "CONNECT_TIMEOUT": 1.0,
+    "READ_TIMEOUT": 10.0,
+    "RETRIES": 2,
+    "POOL_SIZE": 20,
+    "BATCH_SIZE": 32,       # registrations per /register_faces/ call
+    "BATCH_WAIT": 0.05,     # seconds to wait for a batch to fill
+    "BREAKER_FAILURES": 5,  # consecutive failures that open the circuit
+    "BREAKER_RESET": 30,    # seconds before a trial call is let through
+}
+
+
+class MLServiceUnavailable(Exception):
+    """The ML service failed, timed out, or the circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls pass. After `failures` consecutive errors it opens and
+    every call fails fast; after `reset_timeout` seconds one trial call is
+    let through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.max_failures or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class HTTPBackend:
+    """Talks to the FastAPI service over a pooled requests.Session."""
+
+    def __init__(self, url, connect_timeout, read_timeout, retries, pool_size):
+        self.url = url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # Every endpoint is keyed by voter_id or read-only, so POSTs are safe to retry
+        retry = Retry(total=retries, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                      allowed_methods=None, respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, path, timeout=None, **kwargs):
+        resp = self.session.post(f"{self.url}{path}", timeout=timeout or self.timeout, **kwargs)
+        resp.raise_for_status()
+        return resp.json()
+
+    def register_face(self, voter_id, data, state=None, constituency=None):
+        return self.post("/register_face/", params={"voter_id": voter_id, "state": state,
+                                                    "constituency": constituency},
+                         files={"file": (f"{voter_id}.jpg", data)})
+
+    def register_faces(self, items, state=None, constituency=None):
+        """items: [(voter_id, bytes)]"""
+        return self.post("/register_faces/", params={"state": state, "constituency": constituency},
+                         data={"voter_ids": [voter_id for voter_id, _ in items]},
+                         files=[("files", (f"{voter_id}.jpg", data)) for voter_id, data in items])
+
+    def check_duplicate(self, data, state=None, constituency=None):
+        return self.post("/check_duplicate/", params={"state": state, "constituency": constituency},
+                         files={"file": ("face.jpg", data)})
+
+    def verify(self, kind, voter_id, data, timeout=None):
+        return self.post(f"/verify_{kind}/{voter_id}", timeout=timeout, files={"file": (kind, data)})
+
+
+class FakeMLBackend:
+    """
+    In-process stand-in for the ML service: a sample "matches" a stored one
+    when the bytes are identical. `latency` adds a fixed delay per call.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.templates = {}  # (kind, voter_id) -> digest
+        self.partitions = {}  # voter_id -> (state, constituency)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def register_face(self, voter_id, data, state=None, constituency=None):
+        self._call()
+        with self._lock:
+            self.templates["face", voter_id] = hashlib.sha256(data).digest()
+            self.partitions[voter_id] = (state, constituency)
+        return {"status": "Face registered"}
+
+    def register_faces(self, items, state=None, constituency=None):
+        self._call()
+        with self._lock:
+            for voter_id, data in items:
+                self.templates["face", voter_id] = hashlib.sha256(data).digest()
+                self.partitions[voter_id] = (state, constituency)
+        return {"registered": len(items), "failed": 0,
+                "results": [{"file": f"{voter_id}.jpg", "voter_id": voter_id, "status": "registered"}
+                            for voter_id, _ in items]}
+
+    def check_duplicate(self, data, state=None, constituency=None):
+        self._call()
+        digest = hashlib.sha256(data).digest()
+        with self._lock:
+            duplicates = [
+                {"voter_id": voter_id, "distance": 0.0}
+                for (kind, voter_id), stored in self.templates.items()
+                if kind == "face" and stored == digest
+                and (state is None or self.partitions.get(voter_id, (None, None))[0] == state)
+                and (constituency is None or self.partitions.get(voter_id, (None, None))[1] == constituency)
+            ]
+        return {"duplicates": duplicates}
+
+    def verify(self, kind, voter_id, data, timeout=None):
+        self._call()
+        with self._lock:
+            stored = self.templates.get((kind, voter_id))
+        if stored is None:
+            return {"error": f"{kind.capitalize()} not registered", "match": False}
+        return {"match": stored == hashlib.sha256(data).digest(), "voter_id": voter_id}
+
+
+class MLClient:
+    def __init__(self, backend, breaker, batch_size=32, batch_wait=0.05):
+        self.backend = backend
+        self.breaker = breaker
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._pending = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def call(self, method, *args, **kwargs):
+        if not self.breaker.allow():
+            raise MLServiceUnavailable("ML service circuit is open")
+        try:
+            result = getattr(self.backend, method)(*args, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.failure()
+            raise MLServiceUnavailable(str(e)) from e
+        self.breaker.success()
+        return result
+
+    def check_duplicate(self, data, state=None, constituency=None):
+        return self.call("check_duplicate", data, state=state, constituency=constituency)
+
+    def verify(self, kind, voter_id, data, timeout=None):
+        """1:1 check; kind is "face" or "fingerprint"."""
+        return self.call("verify", kind, voter_id, data, timeout=timeout)
+
+    def register_face(self, voter_id, data, state=None, constituency=None):
+        """Register synchronously, bypassing the batch queue."""
+        return self.call("register_face", voter_id, data, state=state, constituency=constituency)
+
+    def submit_face(self, voter_id, data, state=None, constituency=None):
+        """Queue a registration for the next batch; returns a Future of the per-voter result."""
+        future = Future()
+        self._pending.put((voter_id, data, state, constituency, future))
+        self._ensure_worker()
+        return future
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_batches, name="ml-face-batcher", daemon=True)
+                self._worker.start()
+
+    def _next_batch(self):
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batches(self):
+        while True:
+            groups = {}
+            for voter_id, data, state, constituency, future in self._next_batch():
+                groups.setdefault((state, constituency), []).append((voter_id, data, future))
+            # /register_faces/ takes one partition per call
+            for (state, constituency), items in groups.items():
+                self._send_batch(items, state, constituency)
+
+    def _send_batch(self, items, state, constituency):
+        try:
+            response = self.call("register_faces", [(voter_id, data) for voter_id, data, _ in items],
+                                 state=state, constituency=constituency)
+        except Exception as e:
+            for _, _, future in items:
+                future.set_exception(e)
+            return
+        results = {r.get("voter_id"): r for r in response.get("results", [])}
+        for voter_id, _, future in items:
+            future.set_result(results.get(voter_id, {"voter_id": voter_id, "status": "failed"}))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def build_ml_client(options=None):
+    options = {**DEFAULTS, **getattr(settings, "ML_SERVICE", {}), **(options or {})}
+    if options["BACKEND"] == "fake":
+        backend = FakeMLBackend()
+    else:
+        backend = HTTPBackend(options["URL"], options["CONNECT_TIMEOUT"], options["READ_TIMEOUT"],
+                              options["RETRIES"], options["POOL_SIZE"])
+    breaker = CircuitBreaker(options["BREAKER_FAILURES"], options["BREAKER_RESET"])
+    return MLClient(backend, breaker, options["BATCH_SIZE"], options["BATCH_WAIT"])
+
+
+def get_ml_client():
+    """The process-wide client, created on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = build_ml_client()
+    return _client
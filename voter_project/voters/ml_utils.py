@@ -1,15 +1,9 @@
-import requests
+from .ml_client import get_ml_client
 
-FASTAPI_URL = "http://127.0.0.1:8001"
-
-def register_face(voter_id, file_path):
+def register_face(voter_id, file_path, state=None, constituency=None):
     with open(file_path, "rb") as f:
-        files = {"file": f}
-        resp = requests.post(f"{FASTAPI_URL}/register_face/", data={"voter_id": voter_id}, files=files)
-        return resp.json()
+        return get_ml_client().register_face(voter_id, f.read(), state=state, constituency=constituency)
 
-def check_duplicate(file_path):
+def check_duplicate(file_path, state=None, constituency=None):
     with open(file_path, "rb") as f:
-        files = {"file": f}
-        resp = requests.post(f"{FASTAPI_URL}/check_duplicate/", files=files)
-        return resp.json()
+        return get_ml_client().check_duplicate(f.read(), state=state, constituency=constituency)
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
@@ -6,15 +6,14 @@ from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from cryptography.fernet import Fernet  # Example AES encryption
 from datetime import date
+from . import ages
 
 ##=================================================
     # Functional Code For Unique Code Generate
 ##=================================================
 def generate_unique_code():
-    while True:
-        code = f"{random.randint(0, 99999999):08d}"  # 8 digits with leading zeros
-        if not Voter.objects.filter(unique_code=code).exists():
-            return code
+    from .allocators import unique_codes
+    return unique_codes.next()
 class State(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=100, unique=True)
@@ -86,30 +85,45 @@ class Voter(models.Model):
 
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Keyset pagination orders (voters/pagination.py)
+        indexes = [
+            models.Index(fields=["name", "id"]),
+            models.Index(fields=["created_at", "id"]),
+            # Age filters are date_of_birth ranges (ages.dob_range)
+            models.Index(fields=["date_of_birth"]),
+            models.Index(fields=["constituency", "date_of_birth"]),
+            models.Index(fields=["booth", "date_of_birth"]),
+        ]
     
     def __str__(self):
         return f"{self.name} ({self.epic_number})"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Remember the loaded values so post_save can diff without another query
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def changed_fields(self):
+        """{attname: (old, new)} for fields changed since the row was loaded."""
+        loaded = getattr(self, "_loaded_values", None)
+        if loaded is None:
+            return {}
+        changes = {}
+        for name, old in loaded.items():
+            new = getattr(self, name)
+            if old != new:
+                changes[name] = (old, new)
+        return changes
     
     ## Generate EPIC Number
     def generate_epic_number(self):
-        # 10 digit random number
-        random_digits = ''.join([str(random.randint(0, 9)) for _ in range(10)])
-        epic_prefix = self.state.code.upper()
-
-        return f"{epic_prefix}{random_digits}"
-
-    def save(self, *args, **kwargs):
-        # Generate EPIC only once when new voter is created
-        if not self.epic_number:
-            epic = self.generate_epic_number()
-
-            # ensure uniqueness
-            while Voter.objects.filter(epic_number=epic).exists():
-                epic = self.generate_epic_number()
-
-            self.epic_number = epic
-
-        super().save(*args, **kwargs)
+        # <epic_prefix><10 digits> from the state's sequence (voters/allocators.py)
+        from .allocators import epic_numbers
+        return epic_numbers.next(self.state)
     
     ## Check Voter's Age
     def age_on_year(self, year=None):
@@ -117,25 +131,14 @@ class Voter(models.Model):
         Returns age on a given year.
         If year is None, use current year.
         """
-        if year is None:
-            year = date.today().year
-
-        # Compute birthday in the target year
-        birth_month_day = self.date_of_birth.strftime('%m-%d')
-        target_date = date(year, self.date_of_birth.month, self.date_of_birth.day)
-        age = year - self.date_of_birth.year
-
-        # Adjust if birthday hasn't happened yet in the target year
-        if target_date > date(year, date.today().month, date.today().day):
-            age -= 1
-        return age
+        today = date.today()
+        return ages.age_in_year(self.date_of_birth, year or today.year, today)
 
     age_on_year.short_description = "Age"
     
     ## If Voter is above 100 year Soft Delete
     def age(self):
-        today = date.today()
-        return today.year - self.dob.year - ((today.month, today.day) < (self.dob.month, self.dob.day))
+        return ages.age_on(self.date_of_birth, date.today())
 
     def soft_delete_if_over_100(self, admin_id=None):
         """
@@ -169,7 +172,16 @@ class Voter(models.Model):
 
     def save(self, *args, **kwargs):
         self.clean()  # validate age before saving
-        super().save(*args, **kwargs)
+        # Generate EPIC only once when new voter is created
+        if not self.epic_number:
+            self.epic_number = self.generate_epic_number()
+        # post_save writes outbox events; keep them in the same transaction as the row
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+        # Deferred fields stay out: reading them here would cost a query each
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {f.attname: getattr(self, f.attname) for f in self._meta.concrete_fields
+                               if f.attname not in deferred}
     
     ## Validate Adhaar Number must be 12 Digit Only
     def clean(self):
@@ -422,14 +434,16 @@ class LoginLog(models.Model):
 
 # TempVoters table
 class TempVoter(models.Model):
-    batch_id = models.IntegerField()
+    batch_id = models.IntegerField()  # ImportBatch id; 0 for copies of saved voters
+    row_number = models.PositiveIntegerField(default=0)  # 1-based data row in the source file
     state_name = models.CharField(max_length=100)
     constituency_name = models.CharField(max_length=255)
     full_name = models.CharField(max_length=255)
-    dob = models.DateField()
+    dob = models.DateField(null=True, blank=True)  # None when the file's value did not parse
     gender = models.CharField(max_length=10)
     phone = models.CharField(max_length=15)
     address = models.TextField()
+    aadhaar = models.CharField(max_length=12, blank=True, null=True)  # cleared once promoted
 
     relation_type = models.CharField(max_length=20, blank=True, null=True)
     relation_name = models.CharField(max_length=255, blank=True, null=True)
@@ -437,5 +451,149 @@ class TempVoter(models.Model):
     is_valid = models.BooleanField(default=False)
     validation_error = models.TextField(blank=True, null=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["batch_id", "id"])]
+
     def __str__(self):
         return self.full_name
+
+
+# One bulk import (voters/importer.py). status is the stage to run next,
+# staged_rows the file rows consumed and the *_through fields the last
+# TempVoter id each stage has committed, so a stopped import resumes there.
+class ImportBatch(models.Model):
+    STATUS_CHOICES = [
+        ('staging', 'Staging'),
+        ('validating', 'Validating'),
+        ('promoting', 'Promoting'),
+        ('done', 'Done'),
+    ]
+
+    source = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='staging')
+    staged_rows = models.PositiveIntegerField(default=0)
+    valid_rows = models.PositiveIntegerField(default=0)
+    invalid_rows = models.PositiveIntegerField(default=0)
+    promoted_rows = models.PositiveIntegerField(default=0)
+    validated_through = models.BigIntegerField(default=0)
+    promoted_through = models.BigIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Import {self.id} ({self.source}): {self.status}"
+
+
+# Outbox: side effects of a save, written in the same transaction and
+# drained by `manage.py process_outbox` (see voters/outbox.py)
+class OutboxEvent(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    topic = models.CharField(max_length=100)
+    aggregate_id = models.IntegerField(blank=True, null=True)  # e.g. voter id
+    payload = models.JSONField(default=dict, blank=True)
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "available_at", "id"])]
+
+    def __str__(self):
+        return f"{self.topic} ({self.idempotency_key})"
+
+
+# Named counters behind the identifier allocators (see voters/allocators.py)
+class Sequence(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    next_value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} = {self.next_value}"
+
+
+# A bulk electoral roll run (voters/rolls.py). Finished units are the PDFs
+# already in <output_dir>/units, so a stopped job resumes from the disk.
+class RollJob(models.Model):
+    LEVEL_CHOICES = [
+        ('booth', 'Booth'),
+        ('constituency', 'Constituency'),
+    ]
+    STATUS_CHOICES = [
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    state = models.ForeignKey(State, on_delete=models.CASCADE)
+    level = models.CharField(max_length=20, choices=LEVEL_CHOICES, default='booth')
+    output_dir = models.CharField(max_length=500)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='running')
+    units_total = models.PositiveIntegerField(default=0)
+    units_done = models.PositiveIntegerField(default=0)
+    pages = models.PositiveIntegerField(default=0)
+    archive = models.CharField(max_length=500, blank=True)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Rolls {self.id} ({self.state}, {self.level}): {self.status}"
+
+
+# Aggregates behind the analytics API (see voters/stats.py), kept up to date
+# from "stats.delta" outbox events and rebuilt by `manage.py rebuild_voter_stats`.
+# Plain id columns instead of foreign keys: booth 0 means "no booth", and a
+# stats row never blocks deleting a state, constituency or booth.
+class VoterStat(models.Model):
+    state_id = models.IntegerField()
+    constituency_id = models.IntegerField()
+    booth_id = models.IntegerField(default=0)
+    gender = models.CharField(max_length=10)
+    status = models.CharField(max_length=20)
+    voters = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["state_id", "constituency_id", "booth_id", "gender", "status"],
+                                    name="voter_stat_group"),
+        ]
+
+
+# Birth year rather than age band, so the rows never go stale; bands are
+# summed from birth years when read. Per constituency to stay small.
+class VoterAgeStat(models.Model):
+    state_id = models.IntegerField()
+    constituency_id = models.IntegerField()
+    gender = models.CharField(max_length=10)
+    birth_year = models.SmallIntegerField()
+    status = models.CharField(max_length=20)
+    voters = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["state_id", "constituency_id", "gender", "birth_year", "status"],
+                                    name="voter_age_stat_group"),
+        ]
+
+
+# Current voters per registration day (created_at), for the creation trend
+class VoterDailyStat(models.Model):
+    day = models.DateField()
+    state_id = models.IntegerField()
+    created = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["day", "state_id"], name="voter_daily_stat_group"),
+        ]
@@ -0,0 +1,118 @@
+"""
+Transactional outbox for side effects of saving a Voter.
+
+Signal receivers only call `enqueue`, which inserts OutboxEvent rows in the
+same transaction as the save. `manage.py process_outbox` drains them:
+
+    claim a batch   -> lease the oldest due events (attempts += 1)
+    run handlers    -> one call per topic with the whole batch, outside any
+                       transaction (they may call the ML service or GeoIP)
+    settle          -> done, or back to pending with exponential backoff,
+                       or failed after MAX_ATTEMPTS
+
+Each event carries a unique idempotency key, so enqueueing the same fact
+twice is a no-op, and handlers must be safe to run again for an event whose
+outcome was lost (a crash between the side effect and marking it done).
+
+Handlers are registered per topic and receive a list of events. They return
+{event_id: error} for the events that failed; raising fails the batch.
+Handlers that only write to the database register with atomic=True: they
+run in the transaction that settles their events, so their writes commit
+exactly once, together with the events' status.
+"""
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+LEASE = timedelta(minutes=5)  # a crashed worker's claim expires after this
+MAX_BACKOFF = timedelta(hours=1)
+
+handlers = {}
+atomic_topics = set()
+
+
+def handler(topic, atomic=False):
+    """Register `fn(events) -> {event_id: error}` for `topic`."""
+    def register(fn):
+        handlers[topic] = fn
+        if atomic:
+            atomic_topics.add(topic)
+        else:
+            atomic_topics.discard(topic)
+        return fn
+    return register
+
+
+def event(topic, key, payload=None, aggregate_id=None):
+    return OutboxEvent(topic=topic, idempotency_key=f"{topic}:{key}", payload=payload or {},
+                       aggregate_id=aggregate_id)
+
+
+def enqueue(*events):
+    """Insert events in the caller's transaction; duplicate keys are ignored."""
+    OutboxEvent.objects.bulk_create(events, ignore_conflicts=True)
+
+
+def backoff(attempts):
+    return min(MAX_BACKOFF, timedelta(seconds=2 ** attempts))
+
+
+def claim(batch_size=BATCH_SIZE):
+    """Lease up to `batch_size` due events to this worker."""
+    now = timezone.now()
+    with transaction.atomic():
+        qs = OutboxEvent.objects.filter(status="pending", available_at__lte=now).order_by("id")
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+        events = list(qs[:batch_size])
+        for e in events:
+            e.attempts += 1
+            e.available_at = now + LEASE
+        OutboxEvent.objects.bulk_update(events, ["attempts", "available_at"])
+    return events
+
+
+def settle(events, errors, max_attempts=MAX_ATTEMPTS):
+    now = timezone.now()
+    for e in events:
+        error = errors.get(e.id)
+        if error is None:
+            e.status, e.processed_at, e.last_error = "done", now, None
+        elif e.attempts >= max_attempts:
+            e.status, e.processed_at, e.last_error = "failed", now, error
+        else:
+            e.available_at, e.last_error = now + backoff(e.attempts), error
+    with transaction.atomic():
+        OutboxEvent.objects.bulk_update(events, ["status", "processed_at", "last_error", "available_at"])
+
+
+def process_batch(batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+    """Claim and run one batch; returns the number of events claimed."""
+    events = claim(batch_size)
+    by_topic = {}
+    for e in events:
+        by_topic.setdefault(e.topic, []).append(e)
+
+    for topic, batch in by_topic.items():
+        fn = handlers.get(topic)
+        if fn is None:
+            errors = {e.id: f"No handler for {topic}" for e in batch}
+            settle(batch, errors, max_attempts)
+            continue
+        try:
+            if topic in atomic_topics:
+                # Database side effects commit together with the events' status
+                with transaction.atomic():
+                    settle(batch, fn(batch) or {}, max_attempts)
+                continue
+            # No transaction (and no locks) held while a handler waits on remote calls
+            errors = fn(batch) or {}
+        except Exception as exc:
+            errors = {e.id: repr(exc) for e in batch}
+        settle(batch, errors, max_attempts)
+    return len(events)
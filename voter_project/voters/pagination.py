@@ -0,0 +1,187 @@
+"""
+Keyset pagination for voter listings.
+
+Pages are addressed by the last row's sort key instead of an offset, so
+page 10,000 costs the same as page 1 and rows inserted meanwhile never
+shift a page. Supported orderings (?order=):
+
+    name     (name, id)
+    created  (created_at, id)
+    id       (id)            default
+
+The cursor is opaque to clients: urlsafe base64 of the ordering and the
+last row's key values. `paginate_ids` is the id-order variant for results
+whose ids come from the search index.
+
+EstimatedCountPaginator is the Django (admin) counterpart for offset pages:
+it avoids an exact COUNT(*) over the whole voters table.
+"""
+import base64
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+ORDERINGS = {
+    "name": ("name", "id"),
+    "created": ("created_at", "id"),
+    "id": ("id",),
+}
+DATETIME_FIELDS = {"created_at"}
+
+
+def encode_cursor(order, values):
+    raw = json.dumps([order, [v.isoformat() if hasattr(v, "isoformat") else v for v in values]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        order, values = json.loads(raw)
+        fields = ORDERINGS[order]
+        if len(values) != len(fields):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        raise NotFound("Invalid cursor")
+    return order, [parse_datetime(v) if f in DATETIME_FIELDS else v for f, v in zip(fields, values)]
+
+
+def after(fields, values):
+    """Rows strictly after `values` in (fields...) order: a lexicographic tuple comparison."""
+    condition = Q()
+    for i in reversed(range(len(fields))):
+        step = Q(**{f"{fields[i]}__gt": values[i]})
+        if i < len(fields) - 1:
+            step |= Q(**{fields[i]: values[i]}) & condition
+        condition = step
+    return condition
+
+
+class KeysetPagination(BasePagination):
+    page_size = 100
+    max_page_size = 1000
+
+    def get_ordering(self, request):
+        order = request.query_params.get("order", "id")
+        return order if order in ORDERINGS else "id"
+
+    def order_queryset(self, queryset, request):
+        return queryset.order_by(*ORDERINGS[self.get_ordering(request)])
+
+    def get_page_size(self, request):
+        try:
+            size = min(int(request.query_params.get("page_size", self.page_size)), self.max_page_size)
+        except ValueError:
+            size = self.page_size
+        return max(size, 1)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        order = self.get_ordering(request)
+        fields = ORDERINGS[order]
+        size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*fields)
+        cursor = request.query_params.get("cursor")
+        if cursor:
+            cursor_order, values = decode_cursor(cursor)
+            if cursor_order != order:
+                raise NotFound("Cursor does not match the requested order")
+            queryset = queryset.filter(after(fields, values))
+
+        rows = list(queryset[:size + 1])
+        self.next_cursor = None
+        if len(rows) > size:
+            rows = rows[:size]
+            last = rows[-1]
+            key = last.get if isinstance(last, dict) else lambda f: getattr(last, f)  # .values() rows
+            self.next_cursor = encode_cursor(order, [key(f) for f in fields])
+        return rows
+
+    def paginate_ids(self, search, fetch, request):
+        """
+        A page in id order of a result whose ids come from an external
+        index: `search(after, limit)` returns ascending ids above `after`
+        and `fetch(ids)` the rows for those that pass the other filters.
+        """
+        self.request = request
+        size = self.get_page_size(request)
+        after = 0
+        cursor = request.query_params.get("cursor")
+        if cursor:
+            order, values = decode_cursor(cursor)
+            if order != "id":
+                raise NotFound("Cursor does not match the requested order")
+            after = values[0]
+
+        rows = []
+        while len(rows) <= size:
+            ids = search(after, size + 1)
+            rows.extend(fetch(ids))
+            if len(ids) <= size:
+                break
+            after = ids[-1]
+        self.next_cursor = None
+        if len(rows) > size:
+            rows = rows[:size]
+            self.next_cursor = encode_cursor("id", [rows[-1]["id"]])
+        return rows
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), "cursor", self.next_cursor)
+
+    def get_paginated_response(self, data):
+        response = {"next": self.get_next_link(), "results": data}
+        if getattr(self, "truncated", False):
+            response["truncated"] = True
+        return Response(response)
+
+
+ESTIMATE_ABOVE = 100000  # tables smaller than this are counted exactly
+COUNT_CAP = 100000  # filtered lists count at most this many rows
+
+
+def estimated_rows(model, using="default"):
+    """Cheap row estimate for `model`'s table from the database's own statistics, or None."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == "mysql":
+            cursor.execute("SELECT table_rows FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() AND table_name = %s", [table])
+        elif connection.vendor == "sqlite":
+            # max(rowid) is an index lookup; deleted rows make it an overestimate
+            cursor.execute(f"SELECT max(rowid) FROM {connection.ops.quote_name(table)}")
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Unfiltered lists of a big table use the planner's row estimate; filtered
+    ones count up to COUNT_CAP rows, so later pages past the cap are not
+    offered. Small tables are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_rows(queryset.model, queryset.db)
+            if estimate is not None and estimate > ESTIMATE_ABOVE:
+                return estimate
+        return queryset.order_by().values("pk")[:COUNT_CAP].count()
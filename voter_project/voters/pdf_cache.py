@@ -0,0 +1,180 @@
+"""
+On-disk cache of rendered voter PDFs, and the process pool that renders them.
+
+A PDF is stored as
+
+    VOTER_PDF_CACHE_DIR/<voter id % 256>/<voter id>-<lang>-<digest>.pdf
+
+where the digest is a hash of the rendered HTML. Anything that changes the
+page (an edit to the voter, a birthday changing the age, a renamed
+constituency or booth, the template itself) gives a new digest and makes
+the old file unreachable; saving or deleting a voter also removes its
+files (signals.py). A repeat download renders the HTML again, which is
+cheap, and is a FileResponse of the cached file.
+
+The HTML is rendered in the request (it needs the database); on a miss
+xhtml2pdf runs in a pool of VOTER_PDF_WORKERS processes. Concurrent misses
+for the same PDF share one render, and at most QUEUE_PER_WORKER renders per
+worker may be waiting; past that `PdfBusy` is raised instead of piling up
+request threads.
+
+The directory is trimmed to VOTER_PDF_CACHE_MAX_BYTES by removing the least
+recently sent files first (a hit refreshes the file's mtime).
+"""
+import glob
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from django.conf import settings
+
+PDF_CACHE_DIR = getattr(settings, "VOTER_PDF_CACHE_DIR", settings.BASE_DIR / "pdf_cache")
+PDF_CACHE_MAX_BYTES = getattr(settings, "VOTER_PDF_CACHE_MAX_BYTES", 2 * 1024 ** 3)
+PDF_WORKERS = getattr(settings, "VOTER_PDF_WORKERS", 2)
+QUEUE_PER_WORKER = 8
+QUEUE_TIMEOUT = 2  # seconds to wait for a render slot before giving up
+RENDER_TIMEOUT = 30
+TRIM_TO = 0.9  # trimming stops at this fraction of the limit
+SHARDS = 256
+
+
+class PdfBusy(Exception):
+    pass
+
+
+class PdfRenderError(Exception):
+    pass
+
+
+def html_to_pdf(html):
+    """Runs in a worker process."""
+    from xhtml2pdf import pisa
+
+    pdf_file = BytesIO()
+    pisa_status = pisa.CreatePDF(html, dest=pdf_file)
+    if pisa_status.err:
+        raise PdfRenderError("PDF generation failed")
+    return pdf_file.getvalue()
+
+
+class PdfCache:
+    def __init__(self, root=PDF_CACHE_DIR, max_bytes=PDF_CACHE_MAX_BYTES, workers=PDF_WORKERS):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(workers * QUEUE_PER_WORKER)
+        self._inflight = {}
+        self._size = None  # bytes on disk as this process knows it; rescanned when trimming
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # spawn, not fork: the web process is multithreaded
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def directory(self, voter_id):
+        return os.path.join(self.root, f"{voter_id % SHARDS:02x}")
+
+    def path(self, voter, lang, html):
+        digest = hashlib.sha1(html.encode()).hexdigest()[:16]
+        return os.path.join(self.directory(voter.id), f"{voter.id}-{lang}-{digest}.pdf")
+
+    def get(self, voter, lang, html):
+        """Path of the PDF of `html` for the voter, rendered in the pool on a miss."""
+        path = self.path(voter, lang, html)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            pending = self._inflight.get(path)
+            if pending is None:
+                pending = self._inflight[path] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return pending.result(timeout=RENDER_TIMEOUT)
+
+        try:
+            self.store(path, self.render(html))
+            pending.set_result(path)
+        except BaseException as exc:
+            pending.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[path]
+        return path
+
+    def render(self, html):
+        if not self._slots.acquire(timeout=QUEUE_TIMEOUT):
+            raise PdfBusy("Too many PDFs being rendered; try again shortly")
+        try:
+            future = self.pool.submit(html_to_pdf, html)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot stays taken until the worker is really done, even if we stop waiting
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            self._pool = None  # a worker died; start a fresh pool for the next render
+            raise
+
+    def store(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.files())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self.trim()
+
+    def files(self):
+        found = []
+        for path in glob.glob(os.path.join(self.root, "*", "*.pdf")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((stat.st_mtime, stat.st_size, path))
+        return found
+
+    def trim(self):
+        files = sorted(self.files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes * TRIM_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def invalidate(self, voter_id):
+        for path in glob.glob(os.path.join(self.directory(voter_id), f"{voter_id}-*.pdf")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+cache = PdfCache()
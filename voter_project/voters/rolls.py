@@ -0,0 +1,212 @@
+"""
+Bulk electoral roll generation: one multi-page PDF per booth or per
+constituency of a state, packed into one ZIP.
+
+For each unit the active voters are streamed in id order and cut into
+batches of PAGES_PER_BATCH pages of PAGE_ROWS voters. Each batch's HTML is
+rendered here and turned into PDF by a pool of worker processes
+(pdf_cache.html_to_pdf). At most WINDOW_PER_WORKER batches per worker are
+in flight, across unit boundaries, so the workers stay busy while memory
+stays bounded. Each finished batch is written straight to
+<output_dir>/units/<unit>.<n>.part; once a unit's last batch is back, its
+parts are merged from disk with pypdf into <output_dir>/units/<unit>.pdf,
+written atomically, and deleted.
+
+A finished unit file is the job's progress: rerunning a RollJob skips the
+units already on disk. The ZIP is built last, streaming the unit files
+from disk, and stored uncompressed because PDF content is compressed
+already. In booth mode, voters without a booth get a per-constituency
+"unassigned" roll.
+"""
+import multiprocessing
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from django.db.models import F
+from django.template.loader import render_to_string
+from pypdf import PdfWriter
+
+from . import ages
+from .models import Booth, Constituency, RollJob, Voter
+from .pdf_cache import PDF_WORKERS, html_to_pdf
+
+PAGE_ROWS = 30
+PAGES_PER_BATCH = 10
+WINDOW_PER_WORKER = 2
+TEMPLATE = "voters/roll_pages.html"
+ROLL_FIELDS = ("id", "name", "relative_name", "relation_type", "gender", "date_of_birth", "house_number",
+               "epic_number")
+
+
+class Unit:
+    def __init__(self, constituency_id, booth_id=None, unassigned=False):
+        self.constituency_id = constituency_id
+        self.booth_id = booth_id
+        self.unassigned = unassigned
+
+    @property
+    def name(self):
+        if self.booth_id is not None:
+            return f"{self.constituency_id}-{self.booth_id}"
+        if self.unassigned:
+            return f"{self.constituency_id}-unassigned"
+        return str(self.constituency_id)
+
+    def voters(self, state):
+        qs = Voter.objects.filter(state=state, status="active", constituency_id=self.constituency_id)
+        if self.booth_id is not None:
+            qs = qs.filter(booth_id=self.booth_id)
+        elif self.unassigned:
+            qs = qs.filter(booth__isnull=True)
+        return qs
+
+
+def units(state, level):
+    """The units with at least one active voter, in a stable order (one query)."""
+    voters = Voter.objects.filter(state=state, status="active")
+    if level == "constituency":
+        ids = voters.values_list("constituency_id", flat=True).distinct().order_by("constituency_id")
+        return [Unit(constituency_id) for constituency_id in ids]
+    pairs = voters.values_list("constituency_id", "booth_id").distinct() \
+        .order_by("constituency_id", F("booth_id").asc(nulls_first=True))
+    return [Unit(constituency_id, booth_id, unassigned=booth_id is None) for constituency_id, booth_id in pairs]
+
+
+class RollGenerator:
+    def __init__(self, job, workers=PDF_WORKERS, progress=None):
+        self.job = job
+        self.state = job.state
+        self.workers = workers
+        self.progress = progress
+        self.today = date.today()
+        self.unit_dir = os.path.join(job.output_dir, "units")
+        self.constituencies = dict(Constituency.objects.filter(state=self.state).values_list("id", "name"))
+        self.booths = dict(Booth.objects.filter(state=self.state).values_list("id", "name"))
+
+    def unit_path(self, unit):
+        return os.path.join(self.unit_dir, f"{unit.name}.pdf")
+
+    def batches(self, unit):
+        """HTML for each batch of pages of `unit`."""
+        heading = {
+            "state": self.state.name,
+            "constituency": self.constituencies.get(unit.constituency_id, ""),
+            "booth": self.booths.get(unit.booth_id, "Unassigned" if unit.unassigned else ""),
+        }
+        batch_rows = PAGE_ROWS * PAGES_PER_BATCH
+        rows = unit.voters(self.state).order_by("id").values(*ROLL_FIELDS).iterator(chunk_size=batch_rows)
+        serial = 0
+        page_number = 0
+        pages = []
+        page = []
+        for row in rows:
+            serial += 1
+            row["serial"] = serial
+            row["age"] = ages.age_on(row["date_of_birth"], self.today)
+            page.append(row)
+            if len(page) == PAGE_ROWS:
+                page_number += 1
+                pages.append({"number": page_number, "voters": page})
+                page = []
+                if len(pages) == PAGES_PER_BATCH:
+                    yield len(pages), render_to_string(TEMPLATE, {**heading, "pages": pages})
+                    pages = []
+        if page:
+            page_number += 1
+            pages.append({"number": page_number, "voters": page})
+        if pages:
+            yield len(pages), render_to_string(TEMPLATE, {**heading, "pages": pages})
+
+    def part_path(self, unit, number):
+        return os.path.join(self.unit_dir, f"{unit.name}.{number}.part")
+
+    def write_part(self, unit, number, pdf):
+        with open(self.part_path(unit, number), "wb") as f:
+            f.write(pdf)
+
+    def write_unit(self, unit, count):
+        """Merge the unit's `count` parts into its PDF, then remove them."""
+        paths = [self.part_path(unit, number) for number in range(count)]
+        writer = PdfWriter()
+        for path in paths:
+            writer.append(path)
+        tmp = self.unit_path(unit) + ".tmp"
+        with open(tmp, "wb") as f:
+            writer.write(f)
+        os.replace(tmp, self.unit_path(unit))
+        for path in paths:
+            os.remove(path)
+
+    def run(self):
+        job = self.job
+        os.makedirs(self.unit_dir, exist_ok=True)
+        todo = units(self.state, job.level)
+        pending_units = [unit for unit in todo if not os.path.exists(self.unit_path(unit))]
+        RollJob.objects.filter(pk=job.pk).update(status="running", units_total=len(todo),
+                                                 units_done=len(todo) - len(pending_units))
+        job.status, job.units_total, job.units_done = "running", len(todo), len(todo) - len(pending_units)
+
+        in_flight = deque()  # (unit, pages, future) in submission order
+        parts = {}  # unit name -> parts written to disk so far
+        submitted = {}  # unit name -> batch count, once all its batches are queued
+
+        def finish_if_complete(unit):
+            if submitted.get(unit.name) == parts.get(unit.name, 0) and submitted[unit.name]:
+                self.write_unit(unit, parts.pop(unit.name))
+                RollJob.objects.filter(pk=job.pk).update(units_done=F("units_done") + 1)
+                job.units_done += 1
+                if self.progress:
+                    self.progress(job, unit)
+
+        def drain(limit):
+            while len(in_flight) > limit:
+                unit, pages, future = in_flight.popleft()
+                number = parts.get(unit.name, 0)
+                self.write_part(unit, number, future.result())
+                parts[unit.name] = number + 1
+                RollJob.objects.filter(pk=job.pk).update(pages=F("pages") + pages)
+                job.pages += pages
+                finish_if_complete(unit)
+
+        window = self.workers * WINDOW_PER_WORKER
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for unit in pending_units:
+                count = 0
+                for pages, html in self.batches(unit):
+                    in_flight.append((unit, pages, pool.submit(html_to_pdf, html)))
+                    count += 1
+                    drain(window)
+                submitted[unit.name] = count
+                finish_if_complete(unit)
+            drain(0)
+
+        job.archive = self.write_archive(todo)
+        RollJob.objects.filter(pk=job.pk).update(status="done", archive=job.archive, last_error=None)
+        job.status = "done"
+        return job
+
+    def write_archive(self, todo):
+        path = os.path.join(self.job.output_dir, f"rolls-{self.state.epic_prefix}-{self.job.level}.zip")
+        tmp = path + ".tmp"
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for unit in todo:
+                if os.path.exists(self.unit_path(unit)):
+                    archive.write(self.unit_path(unit), f"{unit.name}.pdf")
+        os.replace(tmp, path)
+        return path
+
+
+def start(state, level, output_dir):
+    return RollJob.objects.create(state=state, level=level, output_dir=os.path.abspath(output_dir))
+
+
+def run(job, workers=PDF_WORKERS, progress=None):
+    try:
+        return RollGenerator(job, workers, progress).run()
+    except Exception as exc:
+        RollJob.objects.filter(pk=job.pk).update(status="failed", last_error=repr(exc))
+        job.status = "failed"
+        raise
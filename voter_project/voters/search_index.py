@@ -0,0 +1,408 @@
+"""
+Search index for VoterSearchAPI.
+
+A sidecar SQLite database (settings.VOTER_SEARCH_INDEX) answers searches
+with voter ids before the ORM fetches anything:
+
+    voter_names  voter_id -> name
+    voter_text   FTS5 index over voter_names with the trigram tokenizer, so a
+                 case-insensitive substring search is an index lookup
+    key_text     FTS5 trigram index over epic, code and phone, for
+                 substring searches of three characters or more
+    voter_keys   (kind, value, voter_id) for epic, code and phone; a full
+                 unique code or phone number is an exact lookup on the
+                 primary key
+
+Every term matches as a case-insensitive substring, as the ORM's
+__icontains did. A query is driven by its most selective term and the
+other terms are checked row by row, in id order, so it stops as soon as
+`limit` ids are found. Callers page through a larger result with `after`
+(keyset on voter_id) instead of the result being cut off.
+
+Only active voters are indexed, which is what search serves. The index is
+updated after each Voter commit (see signals.py) and rebuilt in bulk with
+`manage.py rebuild_search_index`, which writes a new generation file
+(<path>.<n>) and atomically repoints the <path> symlink at it; open
+connections notice and reconnect. While a rebuild runs, <path>.building
+names the new file and every live update or removal also queues its voter
+ids in that file's `pending` table; the rebuild re-reads those voters from
+the database before and after the switch, so nothing saved or deleted
+meanwhile is lost. Until it has been built once (or, for
+epic/code/phone terms, rebuilt since key_text was added), `search` returns
+None and callers fall back to the ORM.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SEARCH_LIMIT = getattr(settings, "VOTER_SEARCH_LIMIT", 1000)
+MIN_TRIGRAM = 3
+DRIVER_MAX = 50000  # a term matching fewer voters than this drives the query
+KEY_LENGTHS = {"code": 8, "phone": 10}  # a term this long can only match exactly
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS voter_names (voter_id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS voter_text USING fts5(
+    name, content='voter_names', content_rowid='voter_id', tokenize='trigram'
+);
+CREATE TABLE IF NOT EXISTS voter_keys (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    voter_id INTEGER NOT NULL,
+    PRIMARY KEY (kind, value, voter_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS voter_keys_voter ON voter_keys (voter_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS key_text USING fts5(epic, code, phone, tokenize='trigram');
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS pending (voter_id INTEGER PRIMARY KEY);
+"""
+
+KEY_NORMALIZERS = {
+    "epic": lambda v: (v or "").strip().upper(),
+    "code": lambda v: (v or "").strip(),
+    "phone": lambda v: re.sub(r"\D", "", v or ""),
+}
+
+
+def index_row(voter_id, name, phone, epic, code):
+    return voter_id, name or "", {
+        "epic": KEY_NORMALIZERS["epic"](epic),
+        "code": KEY_NORMALIZERS["code"](code),
+        "phone": KEY_NORMALIZERS["phone"](phone),
+    }
+
+
+def like_pattern(text):
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def match_phrase(column, text):
+    return '%s : "%s"' % (column, text.replace('"', '""'))
+
+
+class Term:
+    """
+    One search term. `table`/`where` select its matching ids from an index
+    (table is None when the term is too short for one) and `check` tests a
+    single candidate id, with {id} standing for the id column. Checks alias
+    their table so they never correlate with a driver on the same table.
+    """
+
+    def __init__(self, table, id_column, where, where_params, check, check_params):
+        self.table = table
+        self.id_column = id_column
+        self.where = where
+        self.where_params = where_params
+        self.check = check
+        self.check_params = check_params
+
+
+def name_term(text):
+    check = "(SELECT n.name FROM voter_names n WHERE n.voter_id = {id}) LIKE ? ESCAPE '\\'"
+    if len(text) < MIN_TRIGRAM:
+        return Term(None, None, None, [], check, [like_pattern(text)])
+    return Term("voter_text", "rowid", "voter_text MATCH ?", [match_phrase("name", text)],
+                check, [like_pattern(text)])
+
+
+def key_term(kind, text):
+    if len(text) == KEY_LENGTHS.get(kind):
+        return Term("voter_keys", "voter_id", "kind = ? AND value = ?", [kind, text],
+                    "EXISTS (SELECT 1 FROM voter_keys k WHERE k.voter_id = {id} AND k.kind = ? AND k.value = ?)",
+                    [kind, text])
+    check = f"(SELECT k.{kind} FROM key_text k WHERE k.rowid = {{id}}) LIKE ? ESCAPE '\\'"
+    if len(text) < MIN_TRIGRAM:
+        return Term(None, None, None, [], check, [like_pattern(text)])
+    return Term("key_text", "rowid", "key_text MATCH ?", [match_phrase(kind, text)], check, [like_pattern(text)])
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class VoterSearchIndex:
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def generation(self):
+        """Number of the generation <path> points at, 0 if none yet."""
+        try:
+            return int(os.readlink(self.path).rsplit(".", 1)[1])
+        except (FileNotFoundError, IndexError, ValueError):
+            return 0
+
+    def _point_at(self, generation):
+        link = f"{self.path}.link"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(f"{self.path}.{generation}"), link)
+        os.replace(link, self.path)
+
+    def conn(self):
+        # One connection per thread, reopened when a rebuild repoints the link
+        if not os.path.lexists(self.path):
+            connect(f"{self.path}.1").close()
+            try:
+                self._point_at(1)
+            except FileExistsError:
+                pass
+        target = os.path.realpath(self.path)
+        local = self._local
+        if getattr(local, "target", None) != target:
+            local.conn = connect(target)
+            local.target = target
+        return local.conn
+
+    def built(self):
+        """Which parts are built: "built" (names) and "keys_built" (key_text)."""
+        return {row[0] for row in self.conn().execute("SELECT key FROM meta WHERE key IN ('built', 'keys_built')")}
+
+    def _delete(self, conn, voter_ids):
+        # External-content FTS needs the old text to remove its entries
+        placeholders = ",".join("?" * len(voter_ids))
+        old = conn.execute(f"SELECT voter_id, name FROM voter_names WHERE voter_id IN ({placeholders})",
+                           voter_ids).fetchall()
+        conn.executemany("INSERT INTO voter_text (voter_text, rowid, name) VALUES ('delete', ?, ?)", old)
+        conn.executemany("DELETE FROM voter_names WHERE voter_id = ?", [(i,) for i in voter_ids])
+        conn.executemany("DELETE FROM voter_keys WHERE voter_id = ?", [(i,) for i in voter_ids])
+        conn.executemany("DELETE FROM key_text WHERE rowid = ?", [(i,) for i in voter_ids])
+
+    def _insert(self, conn, rows, text=True):
+        conn.executemany("INSERT INTO voter_names VALUES (?, ?)", [(i, name) for i, name, _ in rows])
+        if text:
+            conn.executemany("INSERT INTO voter_text (rowid, name) VALUES (?, ?)",
+                             [(i, name) for i, name, _ in rows])
+        conn.executemany("INSERT OR IGNORE INTO voter_keys VALUES (?, ?, ?)",
+                         [(kind, value, i) for i, _, keys in rows for kind, value in keys.items() if value])
+        conn.executemany("INSERT INTO key_text (rowid, epic, code, phone) VALUES (?, ?, ?, ?)",
+                         [(i, keys["epic"], keys["code"], keys["phone"]) for i, _, keys in rows])
+
+    def _note_pending(self, voter_ids):
+        # Queued before the change is applied, see rebuild()
+        try:
+            with open(f"{self.path}.building") as f:
+                building = f.read().strip()
+        except FileNotFoundError:
+            return
+        conn = connect(building)
+        try:
+            conn.executemany("INSERT OR IGNORE INTO pending VALUES (?)", [(i,) for i in voter_ids])
+        finally:
+            conn.close()
+
+    def update(self, voters):
+        """Index active voters and drop everything else from the index."""
+        self._note_pending([v.id for v in voters])
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._delete(conn, [v.id for v in voters])
+            self._insert(conn, [index_row(v.id, v.name, v.phone, v.epic_number, v.unique_code)
+                                for v in voters if v.status == "active"])
+
+    def remove(self, voter_ids):
+        voter_ids = list(voter_ids)
+        self._note_pending(voter_ids)
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._delete(conn, list(voter_ids))
+
+    def plan(self, name=None, phone=None, epic=None, code=None):
+        """
+        The Terms for a search, [] when no voter can match, None when no
+        term is given or the index cannot serve the terms yet.
+        """
+        terms = []
+        impossible = False
+        name = (name or "").strip()
+        if name:
+            terms.append(name_term(name))
+        for kind, term in (("epic", epic), ("code", code), ("phone", phone)):
+            if term and term.strip():
+                text = KEY_NORMALIZERS[kind](term)
+                if text:
+                    terms.append(key_term(kind, text))
+                else:
+                    impossible = True  # e.g. a phone term without digits
+        if not terms and not impossible:
+            return None
+        keyed = impossible or len(terms) > bool(name)
+        built = self.built()
+        if "built" not in built or (keyed and "keys_built" not in built):
+            return None
+        return [] if impossible else terms
+
+    def serves(self, **terms):
+        return self.plan(**terms) is not None
+
+    def search(self, name=None, phone=None, epic=None, code=None, after=0, limit=SEARCH_LIMIT):
+        """
+        Ids above `after` of active voters containing every given term,
+        ascending, at most `limit`. None when `plan` is None.
+        """
+        terms = self.plan(name, phone, epic, code)
+        if not terms:
+            return terms
+        conn = self.conn()
+
+        # The term matching the fewest voters (counted up to DRIVER_MAX) drives
+        indexed = [term for term in terms if term.table]
+        if len(indexed) == 1:
+            driver = indexed[0]
+        elif indexed:
+            counts = [
+                conn.execute(f"SELECT count(*) FROM (SELECT 1 FROM {term.table} WHERE {term.where} LIMIT ?)",
+                             term.where_params + [DRIVER_MAX]).fetchone()[0]
+                for term in indexed
+            ]
+            driver = indexed[min(range(len(indexed)), key=counts.__getitem__)]
+        else:
+            # Only short terms: most voters match, scan in id order until `limit`
+            driver = Term("voter_names", "voter_id", "1", [], None, [])
+
+        column = f"{driver.table}.{driver.id_column}"
+        sql = f"SELECT {column} FROM {driver.table} WHERE {driver.where} AND {column} > ?"
+        params = driver.where_params + [after or 0]
+        for term in terms:
+            if term is not driver:
+                sql += " AND " + term.check.format(id=column)
+                params += term.check_params
+        sql += f" ORDER BY {column} LIMIT ?"
+        return [row[0] for row in conn.execute(sql, params + [limit])]
+
+    def search_all(self, chunk_size=SEARCH_LIMIT, **terms):
+        """Chunks of `search` ids, keyset-paged on voter_id to the end of the result."""
+        after = 0
+        while True:
+            ids = self.search(after=after, limit=chunk_size, **terms)
+            if ids:
+                yield ids
+            if not ids or len(ids) < chunk_size:
+                return
+            after = ids[-1]
+
+    def _catch_up(self, conn, load):
+        """Re-read the voters queued in `pending` and index their current rows."""
+        while True:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                voter_ids = [row[0] for row in conn.execute("SELECT voter_id FROM pending LIMIT 10000")]
+                conn.executemany("DELETE FROM pending WHERE voter_id = ?", [(i,) for i in voter_ids])
+            if not voter_ids:
+                return
+            # Dequeued before reading: a change committed after this read is queued again
+            rows = [index_row(*row) for row in load(voter_ids)]
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._delete(conn, voter_ids)
+                self._insert(conn, rows)
+
+    def rebuild(self, rows, batch_size=10000, load=None):
+        """
+        Build a new generation from `rows` of (id, name, phone, epic_number,
+        unique_code) for active voters and switch readers over to it.
+
+        `load(voter_ids)` returns the same tuples for those of `voter_ids`
+        that are active now. With it, voters updated or removed while the
+        rebuild runs are re-read into the new generation; without it they
+        may be missing until the next rebuild.
+        """
+        previous = self.generation()
+        generation = previous + 1
+        path = f"{self.path}.{generation}"
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        conn = connect(path)
+        conn.execute("PRAGMA synchronous=OFF")
+        marker = f"{self.path}.building"
+        if load is not None:
+            with open(f"{marker}.tmp", "w") as f:
+                f.write(path)
+            os.replace(f"{marker}.tmp", marker)
+        try:
+            count = self._fill(conn, rows, batch_size)
+            if load is not None:
+                self._catch_up(conn, load)
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._point_at(generation)
+            if load is not None:
+                # Writers that resolved the old generation just before the switch
+                self._catch_up(conn, load)
+        finally:
+            if load is not None and os.path.exists(marker):
+                os.remove(marker)
+        if load is not None:
+            # Writers that saw the marker just before it went
+            self._catch_up(conn, load)
+        conn.close()
+
+        # Readers of the previous generation have had a whole rebuild to move on
+        for old in range(1, previous):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(f"{self.path}.{old}{suffix}"):
+                    os.remove(f"{self.path}.{old}{suffix}")
+        return count
+
+    def _fill(self, conn, rows, batch_size):
+        count = 0
+        batch = []
+
+        def flush():
+            with conn:
+                conn.execute("BEGIN")
+                self._insert(conn, batch, text=False)
+            batch.clear()
+
+        for row in rows:
+            batch.append(index_row(*row))
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        # Build the trigram index from voter_names in one pass
+        conn.execute("INSERT INTO voter_text (voter_text) VALUES ('rebuild')")
+        conn.execute("INSERT INTO voter_text (voter_text) VALUES ('optimize')")
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', datetime('now'))")
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('keys_built', datetime('now'))")
+        return count
+
+
+index = VoterSearchIndex(getattr(settings, "VOTER_SEARCH_INDEX", settings.BASE_DIR / "search_index.sqlite3"))
+
+
+def sync_voter(voter):
+    try:
+        index.update([voter])
+    except sqlite3.Error:
+        logger.exception("Search index update failed for voter %s; run rebuild_search_index", voter.id)
+
+
+def sync_voters(voters, batch_size=5000):
+    for i in range(0, len(voters), batch_size):
+        try:
+            index.update(voters[i:i + batch_size])
+        except sqlite3.Error:
+            logger.exception("Search index update failed for %d voters; run rebuild_search_index",
+                             len(voters[i:i + batch_size]))
+
+
+def unindex_voter(voter_id):
+    try:
+        index.remove([voter_id])
+    except sqlite3.Error:
+        logger.exception("Search index delete failed for voter %s; run rebuild_search_index", voter_id)
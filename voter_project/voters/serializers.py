@@ -1,18 +1,9 @@
 from rest_framework import serializers
+from django.utils import timezone
 from .models import Voter
-import random
+from . import ages
 from datetime import date
 
-def generate_unique_code(length=8):
-    """
-    Generate a globally unique numeric code of given length.
-    Checks existing codes in the DB to avoid collisions.
-    """
-    while True:
-        code = f"{random.randint(0, 10**length - 1):0{length}d}"  # zero-padded
-        if not Voter.objects.filter(unique_code=code).exists():
-            return code
-
 class VoterSerializer(serializers.ModelSerializer):
     aadhaar = serializers.CharField(
         write_only=True,  # Never expose Aadhaar in API
@@ -27,6 +18,7 @@ class VoterSerializer(serializers.ModelSerializer):
     class Meta: 
         model = Voter 
         fields = '__all__'
+        read_only_fields = ('unique_code',)  # always allocated, never client-chosen
     
     def validate_aadhaar(self, value):
         if not value.isdigit():
@@ -37,7 +29,7 @@ class VoterSerializer(serializers.ModelSerializer):
         aadhaar = validated_data.pop('aadhaar')
         voter = Voter(**validated_data)
         voter.set_aadhaar(aadhaar)  # Encrypt before saving
-        voter.unique_code = generate_unique_code(length=8)
+        # unique_code comes from the model default (voters/allocators.py)
         voter.save()
         return voter
     
@@ -48,4 +40,70 @@ class VoterSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
     
     def get_age(self, obj):
-        return obj.age_on_year(date.today().year)
+        # One date.today() per serializer (and per list), not per row
+        today = self.context.setdefault("today", date.today())
+        return ages.age_on(obj.date_of_birth, today)
+
+
+class VoterReadEncoder:
+    """
+    Fast read path producing the same JSON as VoterSerializer: one
+    `.values()` query with the related names joined in, and age computed
+    against a single `today`. Listing N voters is one query, not 3N+1.
+
+    aadhaar_encrypted is left out: the ciphertext is of no use to clients
+    and Aadhaar itself is already write-only.
+    """
+
+    related = {"state": "state__name", "constituency": "constituency__name", "booth": "booth__name"}
+    fields = (
+        "id", "age", "state", "constituency", "booth", "epic_number", "unique_code", "pan_number",
+        "name", "date_of_birth", "gender", "relative_name", "relation_type", "address",
+        "house_number", "phone", "photo_url", "signature_url", "status", "created_at", "updated_at",
+    )
+
+    def __init__(self, today=None):
+        self.today = today or date.today()
+        self.tz = timezone.get_current_timezone()
+        self.columns = [self.related.get(f, f) for f in self.fields if f != "age"]
+
+    def values(self, queryset):
+        return queryset.values(*self.columns)
+
+    def datetime(self, value):
+        # Same representation as DRF's DateTimeField
+        if value is None:
+            return None
+        if value.tzinfo is not None:
+            value = value.astimezone(self.tz)
+        value = value.isoformat()
+        return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+    def encode_row(self, row):
+        dob = row["date_of_birth"]
+        return {
+            "id": row["id"],
+            "age": ages.age_on(dob, self.today),
+            "state": row["state__name"],
+            "constituency": row["constituency__name"],
+            "booth": row["booth__name"],
+            "epic_number": row["epic_number"],
+            "unique_code": row["unique_code"],
+            "pan_number": row["pan_number"],
+            "name": row["name"],
+            "date_of_birth": dob.isoformat(),
+            "gender": row["gender"],
+            "relative_name": row["relative_name"],
+            "relation_type": row["relation_type"],
+            "address": row["address"],
+            "house_number": row["house_number"],
+            "phone": row["phone"],
+            "photo_url": row["photo_url"],
+            "signature_url": row["signature_url"],
+            "status": row["status"],
+            "created_at": self.datetime(row["created_at"]),
+            "updated_at": self.datetime(row["updated_at"]),
+        }
+
+    def encode(self, rows):
+        return [self.encode_row(row) for row in rows]
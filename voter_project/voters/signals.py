@@ -1,35 +1,106 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from .models import Voter, TempVoter
 import requests
 from django.contrib.auth.signals import user_logged_in
 from django.utils import timezone
-from django.contrib.gis.geoip2 import GeoIP2
 from django.forms.models import model_to_dict
-from .models import AdminLog, LoginLog
+from .models import AdminLog, LoginLog, OutboxEvent
 from django.contrib.auth.models import User
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth.signals import user_logged_in
 from django.dispatch import receiver
 from django.utils.timezone import now
+from django.db import transaction
+from . import geoip, outbox, search_index, stats
+from .pdf_cache import cache as pdf_cache
+from .ml_client import MLServiceUnavailable, get_ml_client
 
-FASTAPI_URL = "http://127.0.0.1:8001"
-
-## Save Voter Details in TempTable
+## Voter side effects go through the outbox (voters/outbox.py): the receiver
+## only writes events, `manage.py process_outbox` runs the handlers below
 @receiver(post_save, sender=Voter)
-def save_voter_to_temp(sender, instance, created, **kwargs):
+def enqueue_voter_events(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    events = []
     if created:
-        TempVoter.objects.create(
-            batch_id=1,
-            state_name=instance.state.name if instance.state else '',
-            constituency_name=instance.constituency.name if instance.constituency else '',
-            full_name=instance.name,
-            dob=instance.dob,
-            gender=instance.gender,
-            phone=instance.phone,
-            address=instance.address,
+        events.append(outbox.event("voter.temp_copy", instance.id, aggregate_id=instance.id))
+        if instance.photo_url:
+            events.append(outbox.event("voter.register_face", instance.id,
+                                       {"photo_url": instance.photo_url}, instance.id))
+    else:
+        changes = [
+            f"{field}: {old} -> {new}"
+            for field, (old, new) in instance.changed_fields().items()
+            if field != "updated_at"
+        ]
+        if changes:
+            events.append(outbox.event("voter.audit", f"{instance.id}:{instance.updated_at.isoformat()}",
+                                       {"changes": changes}, instance.id))
+    if events:
+        outbox.enqueue(*events)
+
+## Move the voter between stats groups (voters/stats.py)
+@receiver(post_save, sender=Voter)
+def enqueue_stats_delta(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    payload = stats.save_delta(instance, created)
+    if payload:
+        outbox.enqueue(outbox.event(stats.TOPIC, f"{instance.id}:{instance.updated_at.isoformat()}",
+                                    payload, instance.id))
+
+@receiver(post_delete, sender=Voter)
+def enqueue_stats_removal(sender, instance, **kwargs):
+    outbox.enqueue(outbox.event(stats.TOPIC, f"{instance.id}:deleted:{timezone.now().isoformat()}",
+                                stats.delete_delta(instance), instance.id))
+
+@outbox.handler(stats.TOPIC, atomic=True)
+def apply_stats_deltas(events):
+    # A rebuild may have superseded some of these since they were claimed
+    live = set(OutboxEvent.objects.select_for_update()
+               .filter(id__in=[e.id for e in events], status="pending").values_list("id", flat=True))
+    stats.apply(e.payload for e in events if e.id in live)
+
+## Keep the search index in step once the row is committed
+@receiver(post_save, sender=Voter)
+def index_voter(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: search_index.sync_voter(instance))
+
+@receiver(post_delete, sender=Voter)
+def unindex_voter(sender, instance, **kwargs):
+    voter_id = instance.id
+    transaction.on_commit(lambda: search_index.unindex_voter(voter_id))
+
+## Cached PDFs of a changed voter can never be sent again; free the disk
+@receiver(post_save, sender=Voter)
+@receiver(post_delete, sender=Voter)
+def invalidate_voter_pdfs(sender, instance, raw=False, created=False, **kwargs):
+    if raw or created:
+        return
+    voter_id = instance.id
+    transaction.on_commit(lambda: pdf_cache.invalidate(voter_id))
+
+## Save Voter Details in TempTable
+@outbox.handler("voter.temp_copy", atomic=True)
+def save_voters_to_temp(events):
+    voters = Voter.objects.select_related("state", "constituency").in_bulk([e.aggregate_id for e in events])
+    TempVoter.objects.bulk_create([
+        TempVoter(
+            batch_id=0,  # not an import batch (voters/importer.py)
+            state_name=voter.state.name if voter.state else '',
+            constituency_name=voter.constituency.name if voter.constituency else '',
+            full_name=voter.name,
+            dob=voter.date_of_birth,
+            gender=voter.gender,
+            phone=voter.phone,
+            address=voter.address,
             is_valid=True
         )
+        for voter in (voters.get(e.aggregate_id) for e in events)
+        if voter is not None  # deleted before the worker got to it
+    ])
 
 ## Save User Info
 #@receiver(user_logged_in)
@@ -52,8 +123,7 @@ def save_voter_to_temp(sender, instance, created, **kwargs):
 #        latitude = None
 #        longitude = None
 #        # Example: use geolocation API like ipstack or GeoIP2
-#        # from django.contrib.gis.geoip2 import GeoIP2
-#        # g = GeoIP2()
+#        # #        # g = GeoIP2()
 #        # try:
 #        #     location = g.city(ip)
 #        #     latitude = location['latitude']
@@ -75,7 +145,7 @@ def save_voter_to_temp(sender, instance, created, **kwargs):
 @receiver(user_logged_in)
 def log_user_login(sender, request, user, **kwargs):
     ip = get_client_ip(request)
-    location = get_location(ip)
+    location = geoip.locate(ip)
     latitude = location.get('latitude') if location else None
     longitude = location.get('longitude') if location else None
 
@@ -86,7 +156,7 @@ def log_user_login(sender, request, user, **kwargs):
     if user.is_staff:
         admin_log, _ = AdminLog.objects.get_or_create(admin=user)
 
-    LoginLog.objects.create(
+    login_log = LoginLog.objects.create(
         admin = admin_log,
         user=user,
         role=role,
@@ -97,6 +167,9 @@ def log_user_login(sender, request, user, **kwargs):
         action=request.path,  # store which page they accessed
         login_time=now()
     )
+    # No local GeoIP database: locate later, never on the login request
+    if location is None and geoip.needs_enrichment(ip):
+        outbox.enqueue(outbox.event("login.geolocate", login_log.id, {"ip": ip}, login_log.id))
 
 def get_client_ip(request):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -107,51 +180,63 @@ def get_client_ip(request):
     return ip
 
 
-def get_location(ip):
-    # ignore localhost
-    if ip.startswith("127.") or ip == "localhost":
-        return None
-
-    try:
-        response = requests.get(f"https://ipapi.co/{ip}/json/")
-        if response.status_code == 200:
-            data = response.json()
-            return {
-                'latitude': data.get('latitude'),
-                'longitude': data.get('longitude'),
-            }
-    except:
-        pass
-
-    return None
+@outbox.handler("login.geolocate")
+def geolocate_logins(events):
+    """Fill in LoginLog coordinates when no local GeoIP database is installed."""
+    errors = {}
+    located = {}
+    for e in events:
+        ip = e.payload["ip"]
+        try:
+            if ip not in located:
+                located[ip] = geoip.fetch_location(ip)
+        except (requests.RequestException, ValueError) as exc:
+            errors[e.id] = str(exc)
+            continue
+        LoginLog.objects.filter(id=e.aggregate_id).update(**located[ip])
+    return errors
  
-@receiver(post_save, sender=Voter)
-def register_voter_face(sender, instance, created, **kwargs):
-    if created and instance.photo_url:  # If new voter and photo uploaded
+@outbox.handler("voter.register_face")
+def register_voter_faces(events):
+    voters = Voter.objects.select_related("state", "constituency").in_bulk([e.aggregate_id for e in events])
+    errors = {}
+    groups = {}
+    for e in events:
+        voter = voters.get(e.aggregate_id)
+        if voter is None:
+            continue
         try:
-            with open(instance.photo_url, "rb") as f:
-                files = {"file": f}
-                resp = requests.post(f"{FASTAPI_URL}/register_face/", data={"voter_id": instance.id}, files=files)
-                print(resp.json())
-        except Exception as e:
-            print("Face registration failed:", e)
+            with open(e.payload["photo_url"], "rb") as f:
+                data = f.read()
+        except OSError as exc:
+            errors[e.id] = str(exc)
+            continue
+        key = (voter.state.name if voter.state else None,
+               voter.constituency.name if voter.constituency else None)
+        groups.setdefault(key, []).append((e, data))
 
+    client = get_ml_client()
+    for (state, constituency), items in groups.items():
+        try:
+            response = client.call("register_faces", [(e.aggregate_id, data) for e, data in items],
+                                   state=state, constituency=constituency)
+        except MLServiceUnavailable as exc:
+            errors.update((e.id, str(exc)) for e, _ in items)
+            continue
+        results = {r.get("voter_id"): r for r in response.get("results", [])}
+        for e, _ in items:
+            result = results.get(e.aggregate_id, {})
+            if result.get("status") != "registered":
+                errors[e.id] = result.get("error", "Not registered")
+    return errors
 
-@receiver(post_save, sender=Voter)
-def log_voter_changes(sender, instance, created, **kwargs):
+
+@outbox.handler("voter.audit", atomic=True)
+def log_voter_changes(events):
     user = User.objects.first()  # Replace with request.user in views
-    old_data = getattr(instance, "_old_data", {})
-    new_data = model_to_dict(instance)
-    if not created:
-        changes = []
-        for field in new_data:
-            old = old_data.get(field)
-            new = new_data.get(field)
-            if old != new:
-                changes.append(f"{field}: {old} -> {new}")
-        if changes:
-            AdminLog.objects.create(
-                admin=user,
-                action="Voter Updated",
-                details="; ".join(changes)
-            )
+    if user is None:
+        return {}
+    AdminLog.objects.bulk_create([
+        AdminLog(admin=user, action="Voter Updated", details="; ".join(e.payload["changes"]))
+        for e in events
+    ])
@@ -0,0 +1,264 @@
+"""
+Voter statistics kept in small aggregate tables, so the analytics API reads
+one row per group instead of grouping the voters table.
+
+    VoterStat       state, constituency, booth, gender, status
+    VoterAgeStat    state, constituency, gender, birth year, status
+    VoterDailyStat  current voters per registration day (created_at) and state
+
+A voter save or delete enqueues a "stats.delta" outbox event in the same
+transaction (signals.py; the importer sends one per promoted chunk). Its
+payload moves the voter out of its old group and into the new one:
+
+    {"groups": [[state, constituency, booth, gender, birth_year, status, +1/-1], ...],
+     "created": [[day, state, n], ...]}
+
+The handler sums a whole batch of events and applies one UPDATE per
+touched group. Writes that skip signals (QuerySet.update, raw SQL) are not
+seen; `manage.py rebuild_voter_stats` recounts everything from the voters
+table and supersedes the pending deltas.
+
+Ages come from birth years: a voter's age here is the age reached during
+the year (year - birth year), which never goes stale as time passes. Exact
+cohorts to the day are what search/age/bands/ is for.
+"""
+from collections import Counter
+from datetime import date, timedelta
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractYear, TruncDate
+from django.utils import timezone
+
+from .models import (Booth, Constituency, OutboxEvent, State, Voter, VoterAgeStat, VoterDailyStat,
+                     VoterStat)
+
+TOPIC = "stats.delta"
+GROUP_FIELDS = ("state_id", "constituency_id", "booth_id", "gender", "date_of_birth", "status", "created_at")
+DIMENSIONS = ("state", "constituency", "booth", "gender", "status", "age_band")
+NAMED = {"state": State, "constituency": Constituency, "booth": Booth}
+UNDERAGE = 18
+SENIOR = 100  # README: senior voters are those over 100
+TREND_DAYS = 7
+
+
+class StatsQueryError(ValueError):
+    pass
+
+
+## Deltas
+
+def group(values):
+    """The stats group of a voter from its field values (a dict of attnames)."""
+    dob = values["date_of_birth"]
+    birth_year = dob.year if hasattr(dob, "year") else int(str(dob)[:4])
+    return [values["state_id"], values["constituency_id"], values["booth_id"] or 0, values["gender"],
+            birth_year, values["status"]]
+
+
+def registered(values):
+    """The voter's [day, state] in VoterDailyStat."""
+    return [timezone.localdate(values["created_at"]).isoformat(), values["state_id"]]
+
+
+def current(voter):
+    return {name: getattr(voter, name) for name in GROUP_FIELDS}
+
+
+def stored(voter):
+    """The voter's values as last read from or written to the database."""
+    loaded = getattr(voter, "_loaded_values", None) or {}
+    return {name: loaded.get(name, getattr(voter, name)) for name in GROUP_FIELDS}
+
+
+def save_delta(voter, created):
+    """Payload for a saved voter, or None when its group did not change."""
+    if created:
+        return created_delta([voter])
+    if getattr(voter, "_loaded_values", None) is None:
+        return None  # old values unknown; left to rebuild_voter_stats
+    old, new = stored(voter), current(voter)
+    payload = {"groups": [], "created": []}
+    if group(old) != group(new):
+        payload["groups"] = [group(old) + [-1], group(new) + [1]]
+    if registered(old) != registered(new):
+        payload["created"] = [registered(old) + [-1], registered(new) + [1]]
+    return payload if payload["groups"] or payload["created"] else None
+
+
+def delete_delta(voter):
+    old = stored(voter)
+    return {"groups": [group(old) + [-1]], "created": [registered(old) + [-1]]}
+
+
+def created_delta(voters):
+    """Payload for newly inserted voters (a save or a bulk_create)."""
+    groups = Counter(tuple(group(current(voter))) for voter in voters)
+    days = Counter(tuple(registered(current(voter))) for voter in voters)
+    return {"groups": [list(key) + [n] for key, n in groups.items()],
+            "created": [[day, state_id, n] for (day, state_id), n in days.items()]}
+
+
+def bump(model, key, delta, field):
+    if model.objects.filter(**key).update(**{field: F(field) + delta}):
+        return
+    try:
+        # In a savepoint: another worker may create the same new group first
+        with transaction.atomic():
+            model.objects.create(**key, **{field: delta})
+    except IntegrityError:
+        model.objects.filter(**key).update(**{field: F(field) + delta})
+
+
+def apply(payloads):
+    """Add up the payloads and apply them, one statement per touched group."""
+    voters, aged, created = Counter(), Counter(), Counter()
+    for payload in payloads:
+        for state_id, constituency_id, booth_id, gender, birth_year, status, n in payload["groups"]:
+            voters[state_id, constituency_id, booth_id, gender, status] += n
+            aged[state_id, constituency_id, gender, birth_year, status] += n
+        for day, state_id, n in payload["created"]:
+            created[day, state_id] += n
+
+    for (state_id, constituency_id, booth_id, gender, status), n in voters.items():
+        if n:
+            bump(VoterStat, {"state_id": state_id, "constituency_id": constituency_id, "booth_id": booth_id,
+                             "gender": gender, "status": status}, n, "voters")
+    for (state_id, constituency_id, gender, birth_year, status), n in aged.items():
+        if n:
+            bump(VoterAgeStat, {"state_id": state_id, "constituency_id": constituency_id, "gender": gender,
+                                "birth_year": birth_year, "status": status}, n, "voters")
+    for (day, state_id), n in created.items():
+        if n:
+            bump(VoterDailyStat, {"day": day, "state_id": state_id}, n, "created")
+
+
+## Rebuild
+
+def rebuild():
+    """
+    Recount all three tables from the voters table in one transaction.
+    Deltas pending at that point are already part of the count and are
+    marked done; on PostgreSQL the transaction is REPEATABLE READ so the
+    count and the pending events are read from the same snapshot.
+    """
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        superseded = OutboxEvent.objects.filter(topic=TOPIC, status="pending").update(
+            status="done", processed_at=timezone.now(), last_error="Superseded by rebuild_voter_stats")
+
+        voters = Voter.objects.order_by()
+        VoterStat.objects.all().delete()
+        VoterStat.objects.bulk_create([
+            VoterStat(booth_id=row.pop("booth_id") or 0, **row)
+            for row in voters.values("state_id", "constituency_id", "booth_id", "gender", "status")
+            .annotate(voters=Count("id")).iterator()
+        ], batch_size=5000)
+        VoterAgeStat.objects.all().delete()
+        VoterAgeStat.objects.bulk_create([
+            VoterAgeStat(**row)
+            for row in voters.values("state_id", "constituency_id", "gender", "status",
+                                     birth_year=ExtractYear("date_of_birth"))
+            .annotate(voters=Count("id")).iterator()
+        ], batch_size=5000)
+        VoterDailyStat.objects.all().delete()
+        VoterDailyStat.objects.bulk_create([
+            VoterDailyStat(**row)
+            for row in voters.values("state_id", day=TruncDate("created_at")).annotate(created=Count("id")).iterator()
+        ], batch_size=5000)
+    return {"groups": VoterStat.objects.count(), "age_groups": VoterAgeStat.objects.count(),
+            "days": VoterDailyStat.objects.count(), "superseded": superseded}
+
+
+## Reads
+
+def band_of(age, bands):
+    for low, high in bands:
+        if age >= low and (high is None or age <= high):
+            return f"{low}-{'' if high is None else high}"
+    return None
+
+
+def counts(group_by, filters=None, bands=None, year=None):
+    """
+    Voters per combination of `group_by` dimensions (see DIMENSIONS), largest
+    first. `filters` are exact matches on state_id, constituency_id,
+    booth_id, gender or status. Grouping by age_band needs `bands`, as
+    [(low, high or None)], and is not available per booth.
+    """
+    filters = dict(filters or {})
+    unknown = set(group_by) - set(DIMENSIONS)
+    if unknown:
+        raise StatsQueryError(f"Unknown dimension: {', '.join(sorted(unknown))}")
+    by_age = "age_band" in group_by
+    if by_age and ("booth" in group_by or "booth_id" in filters):
+        raise StatsQueryError("Age bands are kept per constituency, not per booth")
+    year = year or date.today().year
+
+    fields = [f"{d}_id" if d in NAMED else d for d in group_by if d != "age_band"]
+    model = VoterAgeStat if by_age else VoterStat
+    rows = model.objects.filter(**filters).order_by() \
+        .values(*fields, *(["birth_year"] if by_age else [])).annotate(total=Sum("voters"))
+
+    totals = Counter()
+    for row in rows:
+        key = [row[f] for f in fields]
+        if by_age:
+            band = band_of(year - row["birth_year"], bands)
+            if band is None:
+                continue
+            key.append(band)
+        totals[tuple(key)] += row["total"]
+
+    keys = fields + (["age_band"] if by_age else [])
+    result = [dict(zip(keys, key), voters=n) for key, n in totals.most_common() if n]
+    add_names(result)
+    return result
+
+
+def add_names(rows):
+    """state_name / constituency_name / booth_name next to each id (one query per kind)."""
+    for dimension, model in NAMED.items():
+        field = f"{dimension}_id"
+        ids = {row[field] for row in rows if row.get(field)}
+        if not ids:
+            continue
+        names = dict(model.objects.filter(id__in=ids).values_list("id", "name"))
+        for row in rows:
+            if field in row:
+                row[f"{dimension}_name"] = names.get(row[field], "")
+
+
+def trend(days=TREND_DAYS, state_id=None):
+    """Voters registered on each of the last `days` days, today included."""
+    today = timezone.localdate()
+    first = today - timedelta(days=days - 1)
+    qs = VoterDailyStat.objects.filter(day__gte=first)
+    if state_id is not None:
+        qs = qs.filter(state_id=state_id)
+    per_day = dict(qs.order_by().values_list("day").annotate(Sum("created")))
+    return [{"day": first + timedelta(days=i), "created": per_day.get(first + timedelta(days=i), 0)}
+            for i in range(days)]
+
+
+def summary(status="active", year=None):
+    """The README's dashboard figures, from the aggregate tables."""
+    year = year or date.today().year
+    by_status = {row["status"]: row["voters"] for row in counts(["status"])}
+    states = counts(["state"], {"status": status})
+    constituencies = counts(["constituency"], {"status": status})
+    ages = VoterAgeStat.objects.filter(status=status).order_by()
+    return {
+        "status": status,
+        "voters": by_status.get(status, 0),
+        "by_status": by_status,
+        "underage": ages.filter(birth_year__gt=year - UNDERAGE).aggregate(n=Sum("voters"))["n"] or 0,
+        "senior": ages.filter(birth_year__lt=year - SENIOR).aggregate(n=Sum("voters"))["n"] or 0,
+        "state_max": states[0] if states else None,
+        "state_min": states[-1] if states else None,
+        "constituency_max": constituencies[0] if constituencies else None,
+        "constituency_min": constituencies[-1] if constituencies else None,
+        "created_last_7_days": trend(),
+    }
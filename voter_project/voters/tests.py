@@ -1,3 +1,637 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from geoip2.errors import AddressNotFoundError
+from maxminddb import InvalidDatabaseError
+from pypdf import PdfReader, PdfWriter
+import requests
+from rest_framework.test import APIRequestFactory
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet exports are optional
+    pq = None
+
+from . import ages, geoip, importer, ml_client, outbox, rolls, search_index, stats, views
+from .allocators import EpicAllocator, UniqueCodeAllocator
+from .management.commands import rebuild_search_index
+from .ml_client import CircuitBreaker, FakeMLBackend, MLClient, MLServiceUnavailable
+from .models import (Booth, Constituency, ImportBatch, OutboxEvent, RollJob, State, TempVoter, Voter,
+                     VoterAgeStat, VoterDailyStat, VoterStat)
+from .pdf_cache import PdfCache
+from .serializers import VoterReadEncoder
+from .views import (AgeBandCountsAPI, VoterAgeSearchAPI, VoterCountsAPI, VoterDownloadAPI, VoterGetAPI,
+                    VoterSearchAPI, VoterSummaryAPI)
+
+
+class Rollback(Exception):
+    pass
+
+
+class UniqueCodeAllocatorTests(TransactionTestCase):
+    def test_rolled_back_reservation_is_not_handed_out_twice(self):
+        first = UniqueCodeAllocator(key="test")
+        try:
+            with transaction.atomic():
+                first.next()
+                raise Rollback
+        except Rollback:
+            pass
+
+        second = UniqueCodeAllocator(key="test")
+        codes = [first.next() for _ in range(150)]
+        other = [second.next() for _ in range(150)]
+        self.assertEqual(len(set(codes)), 150)
+        self.assertFalse(set(codes) & set(other))
+
+
+class EpicAllocatorTests(TransactionTestCase):
+    def test_rolled_back_reservation_is_not_handed_out_twice(self):
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        first = EpicAllocator()
+        try:
+            with transaction.atomic():
+                first.next(state)
+                raise Rollback
+        except Rollback:
+            pass
+
+        second = EpicAllocator()
+        epics = [first.next(state) for _ in range(150)]
+        other = [second.next(state) for _ in range(150)]
+        self.assertEqual(len(set(epics)), 150)
+        self.assertFalse(set(epics) & set(other))
+
+
+class AgeParamTests(TestCase):
+    def get(self, view, **params):
+        return view.as_view()(APIRequestFactory().get("/", params))
+
+    def test_out_of_range_year_is_a_bad_request(self):
+        for view, params in [(VoterAgeSearchAPI, {"min_age": 18}), (AgeBandCountsAPI, {}),
+                             (VoterCountsAPI, {}), (VoterSummaryAPI, {})]:
+            for year in (99999, 1899):
+                self.assertEqual(self.get(view, year=year, **params).status_code, 400, (view.__name__, year))
+            self.assertEqual(self.get(view, year=2030, **params).status_code, 200, view.__name__)
+
+    def test_out_of_range_ages_are_a_bad_request(self):
+        self.assertEqual(self.get(VoterAgeSearchAPI, max_age=99999).status_code, 400)
+        self.assertEqual(self.get(AgeBandCountsAPI, bands="18-99999").status_code, 400)
+        self.assertEqual(self.get(AgeBandCountsAPI, bands="99999-").status_code, 400)
+
+
+class OutboxTests(TransactionTestCase):
+    def setUp(self):
+        self.seen = []
+        self.addCleanup(outbox.handlers.pop, "test.remote", None)
+        self.addCleanup(outbox.handlers.pop, "test.db", None)
+        self.addCleanup(outbox.atomic_topics.discard, "test.db")
+
+    def test_handlers_run_outside_a_transaction_unless_atomic(self):
+        @outbox.handler("test.remote")
+        def remote(events):
+            self.seen.append(("remote", connection.in_atomic_block))
+
+        @outbox.handler("test.db", atomic=True)
+        def db(events):
+            self.seen.append(("db", connection.in_atomic_block))
+
+        outbox.enqueue(outbox.event("test.remote", 1), outbox.event("test.db", 1))
+        outbox.process_batch()
+        self.assertEqual(sorted(self.seen), [("db", True), ("remote", False)])
+        self.assertEqual(set(OutboxEvent.objects.values_list("status", flat=True)), {"done"})
+
+    def test_failed_atomic_handler_leaves_no_writes(self):
+        @outbox.handler("test.db", atomic=True)
+        def db(events):
+            State.objects.create(name="Goa", epic_prefix="GA")
+            raise RuntimeError("boom")
+
+        outbox.enqueue(outbox.event("test.db", 1))
+        outbox.process_batch()
+        self.assertFalse(State.objects.exists())
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), ("pending", 1))
+        self.assertIn("boom", event.last_error)
+
+
+class VoterReadQueryTests(TestCase):
+    """Reads are a fixed number of queries, however many voters they return."""
+
+    @classmethod
+    def setUpTestData(cls):
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        constituency = Constituency.objects.create(name="Patna", state=state)
+        booth = Booth.objects.create(name="B1", constituency=constituency, state=state)
+        Voter.objects.bulk_create([
+            Voter(state=state, constituency=constituency, booth=booth, name=f"Ram {i}",
+                  date_of_birth=date(1990, 1, 1), address="a", phone=f"98765{i:05d}",
+                  epic_number=f"BR{i:08d}", unique_code=f"{i:08d}")
+            for i in range(30)
+        ])
+        cls.voter = Voter.objects.order_by("id").first()
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.index = search_index.VoterSearchIndex(Path(tmp.name) / "search_index.sqlite3")
+        patcher = mock.patch.object(search_index, "index", self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build_index(self):
+        self.index.rebuild(Voter.objects.values_list("id", "name", "phone", "epic_number", "unique_code"))
+
+    def get(self, view, pk=None, **params):
+        kwargs = {} if pk is None else {"pk": pk}
+        response = view.as_view()(APIRequestFactory().get("/", params), **kwargs)
+        if hasattr(response, "render"):
+            response.render()
+        return response
+
+    def search(self, **params):
+        with self.assertNumQueries(1):
+            response = self.get(VoterSearchAPI, page_size=10, **params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 10)
+        self.assertEqual(response.data["results"][0]["booth"], "B1")
+
+    def stream(self, **params):
+        with self.assertNumQueries(1):
+            response = self.get(VoterSearchAPI, stream="1", **params)
+            lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 30)
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            response = self.get(VoterGetAPI, self.voter.pk)
+        self.assertEqual((response.data["name"], response.data["state"]), ("Ram 0", "Bihar"))
+
+    def test_search_page_and_stream(self):
+        self.search(name="Ram")
+        self.stream(name="Ram")
+
+    def test_indexed_search_page_and_stream(self):
+        self.build_index()
+        self.assertTrue(self.index.serves(name="Ram"))
+        self.search(name="Ram")
+        self.stream(name="Ram")
+
+    def test_phone_terms_match_the_same_voters_with_and_without_the_index(self):
+        for phone, count in [("98-765 00001", 1), ("00001", 1), ("--", 0)]:
+            for built in (False, True):
+                if built:
+                    self.build_index()
+                response = self.get(VoterSearchAPI, phone=phone)
+                self.assertEqual(len(response.data["results"]), count, (phone, built))
+
+    def test_download_json(self):
+        with self.assertNumQueries(1):
+            response = self.get(VoterDownloadAPI, self.voter.pk, format="json")
+        self.assertEqual((response.data["name"], response.data["constituency"], response.data["booth"]),
+                         ("Ram 0", "Patna", "B1"))
+        with self.assertNumQueries(1):
+            response = self.get(VoterDownloadAPI, 0, epic=self.voter.epic_number, format="json")
+        self.assertEqual(response.data["id"], self.voter.pk)
+
+
+class VoterPdfCacheTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = PdfCache(root=tmp.name)
+        self.rendered = []
+        self.cache.render = lambda html: self.rendered.append(html) or b"%PDF"
+        patcher = mock.patch.object(views, "pdf_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        constituency = Constituency.objects.create(name="Patna", state=state)
+        self.voter = Voter.objects.create(state=state, constituency=constituency, name="Sita",
+                                          date_of_birth=date(1990, 1, 1), address="a", phone="9876500000",
+                                          epic_number="BR00000001", unique_code="00000001")
+
+    def download(self, age):
+        request = APIRequestFactory().get("/")
+        request.user = AnonymousUser()
+        with mock.patch.object(views, "get_age", return_value=age):
+            views.generate_voter_pdf(request, self.voter).close()
+
+    def test_pdf_is_rendered_again_when_the_age_changes(self):
+        self.download(35)
+        self.download(35)
+        self.assertEqual(len(self.rendered), 1)
+        self.download(36)
+        self.assertEqual(len(self.rendered), 2)
+        self.assertIn("36", self.rendered[1])
+
+
+class SearchIndexRebuildTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.index = search_index.VoterSearchIndex(Path(tmp.name) / "search_index.sqlite3")
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        self.constituency = Constituency.objects.create(name="Patna", state=state)
+        self.voters = [self.voter(i, f"Ram {i}") for i in range(4)]
+
+    def voter(self, i, name):
+        return Voter.objects.create(state=self.constituency.state, constituency=self.constituency, name=name,
+                                    date_of_birth=date(1990, 1, 1), address="a", phone=f"98765{i:05d}",
+                                    epic_number=f"BR{i:08d}", unique_code=f"{i:08d}")
+
+    def test_changes_during_a_rebuild_reach_the_new_generation(self):
+        self.index.rebuild(rebuild_search_index.load([v.id for v in self.voters]))
+        renamed, deleted = self.voters[1], self.voters[2]
+        snapshot = list(rebuild_search_index.load([v.id for v in self.voters]))
+
+        def rows():
+            yield snapshot[0]
+            # Saved and deleted after the snapshot was read, synced to the live generation
+            renamed.name = "Shyam"
+            renamed.save()
+            self.index.update([renamed])
+            deleted.delete()
+            self.index.remove([deleted.id])
+            added = self.voter(9, "Ram 9")
+            self.index.update([added])
+            self.added = added
+            yield from snapshot[1:]
+
+        self.index.rebuild(rows(), load=rebuild_search_index.load)
+        self.assertEqual(self.index.search(name="Shyam"), [renamed.id])
+        self.assertEqual(self.index.search(name="Ram"), [self.voters[0].id, self.voters[3].id, self.added.id])
+        self.assertFalse(os.path.exists(f"{self.index.path}.building"))
+
+
+class VoterAdminTests(TestCase):
+    def setUp(self):
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        constituency = Constituency.objects.create(name="Patna", state=state)
+        self.voter = Voter.objects.create(state=state, constituency=constituency, name="Sita",
+                                          date_of_birth=date(1990, 1, 1), address="a", phone="9876500000",
+                                          epic_number="BR00000001", unique_code="00000001")
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        self.model_admin = admin.site._registry[Voter]
+
+    def test_list_editable_save_does_not_load_deferred_fields(self):
+        request = APIRequestFactory().post("/admin/voters/voter/", {
+            "form-TOTAL_FORMS": "1", "form-INITIAL_FORMS": "1",
+            "form-0-id": str(self.voter.pk), "form-0-status": "migrated", "_save": "Save",
+        })
+        request.user = self.user
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        # Changelist count and rows, the formset's pk lookup, the save with its
+        # outbox events, the admin log; none of them for address or aadhaar_encrypted
+        with self.assertNumQueries(13):
+            response = self.model_admin.changelist_view(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Voter.objects.get(pk=self.voter.pk).status, "migrated")
+
+
+class StatsApplyTests(TestCase):
+    payload = {"groups": [[1, 2, 0, "Female", 1990, "active", 1]], "created": [["2026-01-05", 1, 1]]}
+
+    def test_new_groups_are_created_then_added_to(self):
+        stats.apply([self.payload])
+        stats.apply([self.payload, self.payload])
+        self.assertEqual(VoterStat.objects.get().voters, 3)
+        self.assertEqual(VoterAgeStat.objects.get().voters, 3)
+        self.assertEqual(VoterDailyStat.objects.get().created, 3)
+
+    def test_group_created_by_another_worker_meanwhile_is_added_to(self):
+        update = QuerySet.update
+        raced = []
+
+        def racing_update(queryset, **kwargs):
+            updated = update(queryset, **kwargs)
+            if not updated and not raced:
+                # Another worker inserts the same new group between our UPDATE and INSERT
+                raced.append(VoterStat.objects.create(state_id=1, constituency_id=2, booth_id=0, gender="Female",
+                                                      status="active", voters=5))
+            return updated
+
+        with mock.patch.object(QuerySet, "update", racing_update):
+            stats.apply([self.payload])
+        self.assertEqual(VoterStat.objects.get().voters, 6)
+        self.assertEqual(VoterAgeStat.objects.get().voters, 1)
+
+
+class ImportRoundTripTests(TestCase):
+    rows = [
+        "name,state,constituency,dob,gender,phone,address,aadhaar,relation_type,relative_name",
+        "Ram,Bihar,Patna,1980-01-01,male,9876500001,a,,father,Dashrath",
+        "Sita,Bihar,Patna,02-03-1985,Female,9876500002,a,123412341234,,",
+        "Mohan,Bihar,Gaya,1980-01-01,,98765,a,,,%s" % ("x" * (importer.RELATIVE_NAME_LENGTH + 1)),
+        "Gita,bihar,PATNA,1990-05-05,,9876500004,a,,,",
+        ",,,,,,,,,",
+        "Hari,Bihar,Patna,2020-01-01,robot,9876500005,,12,,",
+        "Lata,Bihar,Patna,1975-07-07,F,9876500006,a,,uncle,",
+    ]
+
+    def setUp(self):
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        Constituency.objects.create(name="Patna", state=state)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "voters.csv")
+        Path(self.path).write_text("\n".join(self.rows) + "\n")
+
+    def test_stage_validate_promote(self):
+        batch = importer.run(importer.start(self.path), chunk_size=2)
+
+        batch = ImportBatch.objects.get(pk=batch.pk)
+        self.assertEqual((batch.status, batch.staged_rows), ("done", 7))
+        self.assertEqual((batch.valid_rows, batch.invalid_rows, batch.promoted_rows), (3, 3, 3))
+        errors = dict(TempVoter.objects.filter(batch_id=batch.pk, is_valid=False)
+                      .values_list("full_name", "validation_error"))
+        self.assertEqual(errors, {
+            "Mohan": "unknown state/constituency; phone number must be 10 digits; "
+                     f"relative name longer than {importer.RELATIVE_NAME_LENGTH} characters",
+            "Hari": "voter must be at least 18 years old; Aadhaar must be 12 digits; address is required; "
+                    "unknown gender",
+            "Lata": "unknown gender; unknown relation type",
+        })
+        voters = Voter.objects.order_by("name")
+        self.assertEqual([(v.name, v.gender, v.constituency.name) for v in voters],
+                         [("Gita", "Male", "Patna"), ("Ram", "Male", "Patna"), ("Sita", "Female", "Patna")])
+        self.assertEqual(voters.get(name="Sita").date_of_birth, date(1985, 3, 2))
+        self.assertEqual((voters.get(name="Ram").relation_type, voters.get(name="Ram").relative_name),
+                         ("Father", "Dashrath"))
+        self.assertFalse(TempVoter.objects.exclude(aadhaar=None).exists())
+
+    def test_stopped_promotion_resumes_after_the_last_committed_chunk(self):
+        batch = importer.run(importer.start(self.path), chunk_size=2, promote_rows=False)
+        with mock.patch.object(importer.outbox, "enqueue", side_effect=[None, RuntimeError("stopped")]):
+            with self.assertRaises(RuntimeError):
+                importer.run(batch, chunk_size=1)
+        batch = ImportBatch.objects.get(pk=batch.pk)
+        self.assertEqual((batch.status, batch.promoted_rows), ("promoting", 1))
+        self.assertEqual(batch.promoted_through, TempVoter.objects.get(full_name="Ram").pk)
+        self.assertIn("stopped", batch.last_error)
+
+        importer.run(batch, chunk_size=1)
+        self.assertEqual(sorted(Voter.objects.values_list("name", flat=True)), ["Gita", "Ram", "Sita"])
+        self.assertEqual(ImportBatch.objects.get(pk=batch.pk).promoted_rows, 3)
+
+
+class ExportRoundTripTests(TestCase):
+    def setUp(self):
+        state = State.objects.create(name="Bihar", epic_prefix="BR")
+        patna = Constituency.objects.create(name="Patna", state=state)
+        gaya = Constituency.objects.create(name="Gaya", state=state)
+        self.shards = {patna.id: ["Ram", "Sita", "Gita"], gaya.id: ["Mohan", "Lata"]}
+        people = [(patna, "Ram"), (gaya, "Mohan"), (patna, "Sita"), (patna, "Gita"), (gaya, "Lata"), (gaya, "Hari")]
+        for i, (constituency, name) in enumerate(people):
+            Voter.objects.create(state=state, constituency=constituency, name=name, date_of_birth=date(1990, 1, 1),
+                                 address="a", phone=f"987650000{i}", epic_number=f"BR0000000{i}",
+                                 unique_code=f"0000000{i}", status="dead" if name == "Hari" else "active")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def read(self, path):
+        if path.endswith(".parquet"):
+            return pq.read_table(path).to_pylist()
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            if ".csv" in path:
+                return list(csv.DictReader(f))
+            return [json.loads(line) for line in f]
+
+    def export(self, format):
+        out = io.StringIO()
+        # Three Patna voters with chunks of two: a chunk boundary inside a shard
+        call_command("export_voters", os.path.join(self.directory, format), format=format,
+                     shard_by="constituency", chunk_size=2, stdout=out)
+        self.assertIn("Exported 5 voters to 2 file(s)", out.getvalue())
+        return sorted(Path(self.directory, format).iterdir())
+
+    def assert_round_trip(self, format, suffix):
+        paths = self.export(format)
+        self.assertEqual([p.name for p in paths], sorted(f"voters-{pk}{suffix}" for pk in self.shards))
+        for pk, names in self.shards.items():
+            rows = self.read(os.path.join(self.directory, format, f"voters-{pk}{suffix}"))
+            self.assertEqual([row["name"] for row in rows], names)
+            self.assertEqual({str(row["age"]) for row in rows}, {str(ages.age_on(date(1990, 1, 1), date.today()))})
+            self.assertEqual({row["constituency"] for row in rows}, {Constituency.objects.get(pk=pk).name})
+        return rows
+
+    def test_csv(self):
+        rows = self.assert_round_trip("csv", ".csv.gz")
+        self.assertEqual(list(rows[0]), list(VoterReadEncoder.fields))
+        self.assertEqual(rows[0]["date_of_birth"], "1990-01-01")
+
+    def test_ndjson(self):
+        rows = self.assert_round_trip("ndjson", ".ndjson.gz")
+        encoder = VoterReadEncoder()
+        self.assertEqual(rows, encoder.encode(encoder.values(Voter.objects.filter(name__in=["Mohan", "Lata"]).order_by("id"))))
+
+    @skipUnless(pq, "pyarrow is not installed")
+    def test_parquet(self):
+        rows = self.assert_round_trip("parquet", ".parquet")
+        self.assertEqual(list(rows[0]), list(VoterReadEncoder.fields))
+        self.assertEqual(rows[0]["date_of_birth"], date(1990, 1, 1))
+
+
+def blank_pdf(pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+@mock.patch.object(rolls, "PAGES_PER_BATCH", 2)
+@mock.patch.object(rolls, "PAGE_ROWS", 1)
+@mock.patch.object(rolls, "ProcessPoolExecutor", lambda workers, mp_context: ThreadPoolExecutor(workers))
+class RollGeneratorTests(TestCase):
+    def setUp(self):
+        self.state = State.objects.create(name="Bihar", epic_prefix="BR")
+        patna = Constituency.objects.create(name="Patna", state=self.state)
+        gaya = Constituency.objects.create(name="Gaya", state=self.state)
+        self.units = {"Patna": str(patna.id), "Gaya": str(gaya.id)}
+        for i, constituency in enumerate([patna, patna, patna, gaya]):
+            Voter.objects.create(state=self.state, constituency=constituency, name=f"Voter {i}",
+                                 date_of_birth=date(1990, 1, 1), address="a", phone=f"987650000{i}",
+                                 epic_number=f"BR0000000{i}", unique_code=f"0000000{i}")
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.job = rolls.start(self.state, "constituency", directory.name)
+        self.rendered = []
+
+    def html_to_pdf(self, html):
+        self.rendered.append(html)
+        return blank_pdf(html.count("Electoral Roll:"))
+
+    def pages(self, constituency):
+        path = os.path.join(self.job.output_dir, "units", f"{self.units[constituency]}.pdf")
+        return len(PdfReader(path).pages)
+
+    def test_batches_are_merged_per_unit(self):
+        with mock.patch.object(rolls, "html_to_pdf", self.html_to_pdf):
+            job = rolls.run(self.job, workers=1)
+
+        # Patna's three voters make batches of two pages and one, then Gaya's
+        # batch follows in the same window of in-flight batches
+        self.assertEqual([html.count("Electoral Roll:") for html in self.rendered], [2, 1, 1])
+        self.assertEqual((self.pages("Patna"), self.pages("Gaya")), (3, 1))
+        self.assertFalse([name for name in os.listdir(os.path.join(job.output_dir, "units")) if name.endswith(".part")])
+        job = RollJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.units_done, job.units_total, job.pages), ("done", 2, 2, 4))
+        with zipfile.ZipFile(job.archive) as archive:
+            self.assertEqual(sorted(archive.namelist()), sorted(f"{name}.pdf" for name in self.units.values()))
+
+    def test_failed_job_resumes_with_the_unfinished_units(self):
+        def failing_on_gaya(html):
+            if "Gaya" in html:
+                raise RuntimeError("renderer crashed")
+            return self.html_to_pdf(html)
+
+        with mock.patch.object(rolls, "html_to_pdf", failing_on_gaya), self.assertRaises(RuntimeError):
+            rolls.run(self.job, workers=1)
+        job = RollJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.status, job.units_done), ("failed", 1))
+        self.assertIn("renderer crashed", job.last_error)
+        self.assertEqual(self.pages("Patna"), 3)
+
+        self.rendered.clear()
+        with mock.patch.object(rolls, "html_to_pdf", self.html_to_pdf):
+            rolls.run(job, workers=1)
+        self.assertEqual(len(self.rendered), 1)
+        self.assertIn("Gaya", self.rendered[0])
+        self.assertEqual(self.pages("Gaya"), 1)
+        job = RollJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.units_done, job.last_error), ("done", 2, None))
+
+
+class RecordingBackend(FakeMLBackend):
+    def __init__(self):
+        super().__init__()
+        self.down = False
+        self.batches = []
+
+    def _call(self):
+        super()._call()
+        if self.down:
+            raise requests.ConnectionError("ML service down")
+
+    def register_faces(self, items, state=None, constituency=None):
+        self.batches.append(([voter_id for voter_id, _ in items], state, constituency))
+        return super().register_faces(items, state, constituency)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(ml_client.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = RecordingBackend()
+        self.client = MLClient(self.backend, CircuitBreaker(failures=2, reset_timeout=30))
+
+    def fail(self, times):
+        self.backend.down = True
+        for _ in range(times):
+            with self.assertRaises(MLServiceUnavailable):
+                self.client.check_duplicate(b"face")
+
+    def test_opens_after_consecutive_failures_and_fails_fast(self):
+        self.fail(1)
+        self.assertEqual(self.client.breaker.state, "closed")
+        self.fail(1)
+        self.assertEqual(self.client.breaker.state, "open")
+
+        self.backend.down = False
+        with self.assertRaisesMessage(MLServiceUnavailable, "circuit is open"):
+            self.client.check_duplicate(b"face")
+        self.assertEqual(self.backend.calls, 2)
+
+    def test_half_open_lets_one_trial_call_through(self):
+        self.fail(2)
+        self.now += 30
+        self.assertEqual(self.client.breaker.state, "half-open")
+        self.assertTrue(self.client.breaker.allow())
+        self.assertFalse(self.client.breaker.allow())  # only one trial at a time
+        self.client.breaker.failure()
+        self.assertEqual(self.client.breaker.state, "open")  # a failed trial re-opens for another timeout
+
+        self.now += 30
+        self.backend.down = False
+        self.assertEqual(self.client.check_duplicate(b"face"), {"duplicates": []})
+        self.assertEqual(self.client.breaker.state, "closed")
+        self.assertEqual(self.client.breaker.failures, 0)
+
+
+class FaceBatchingTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = RecordingBackend()
+        # A batch closes when full; the long wait keeps the five submissions together
+        self.client = MLClient(self.backend, CircuitBreaker(), batch_size=5, batch_wait=5)
+
+    def submit(self):
+        partitions = [("Bihar", "Patna"), ("Bihar", "Gaya"), ("Bihar", "Patna"), ("Bihar", "Gaya"), ("Bihar", "Patna")]
+        return [self.client.submit_face(voter_id, b"face-%d" % voter_id, state, constituency)
+                for voter_id, (state, constituency) in enumerate(partitions, 1)]
+
+    def test_one_register_faces_call_per_partition(self):
+        results = [future.result(timeout=5) for future in self.submit()]
+        self.assertEqual(self.backend.batches, [([1, 3, 5], "Bihar", "Patna"), ([2, 4], "Bihar", "Gaya")])
+        self.assertEqual([result["status"] for result in results], ["registered"] * 5)
+        self.assertEqual(self.backend.partitions[4], ("Bihar", "Gaya"))
+
+    def test_failed_call_fails_every_future_of_its_batch(self):
+        self.backend.down = True
+        for future in self.submit():
+            with self.assertRaises(MLServiceUnavailable):
+                future.result(timeout=5)
+
+
+class GeoipLocateTests(SimpleTestCase):
+    def setUp(self):
+        self.reader = mock.Mock()
+        patcher = mock.patch.object(geoip, "get_reader", return_value=self.reader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        geoip._locate_prefix.cache_clear()
+        self.addCleanup(geoip._locate_prefix.cache_clear)
+
+    def test_addresses_in_one_prefix_are_looked_up_once(self):
+        self.reader.lat_lon.return_value = (25.6, 85.1)
+        self.assertEqual(geoip.locate("8.8.8.8"), {"latitude": 25.6, "longitude": 85.1})
+        self.assertEqual(geoip.locate("8.8.8.9"), {"latitude": 25.6, "longitude": 85.1})
+        self.reader.lat_lon.assert_called_once_with("8.8.8.0")
+
+    def test_unknown_prefix_is_cached_as_not_found(self):
+        self.reader.lat_lon.side_effect = AddressNotFoundError("not in database")
+        self.assertIsNone(geoip.locate("8.8.8.8"))
+        self.assertIsNone(geoip.locate("8.8.8.8"))
+        self.assertEqual(self.reader.lat_lon.call_count, 1)
+
+    def test_failed_lookup_is_not_cached(self):
+        self.reader.lat_lon.side_effect = [InvalidDatabaseError("corrupt search tree"), (25.6, 85.1)]
+        with self.assertLogs("voters.geoip", "ERROR"):
+            self.assertIsNone(geoip.locate("8.8.8.8"))
+        self.assertEqual(geoip.locate("8.8.8.8"), {"latitude": 25.6, "longitude": 85.1})
+
+    def test_unexpected_errors_propagate(self):
+        self.reader.lat_lon.side_effect = KeyError("latitude")
+        with self.assertRaises(KeyError):
+            geoip.locate("8.8.8.8")
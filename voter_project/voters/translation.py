@@ -0,0 +1,133 @@
+"""
+Translation memory for Hindi API responses.
+
+Strings are looked up in three tiers:
+
+    1. an in-process LRU (TRANSLATION_CACHE_SIZE entries)
+    2. the Localization table, keyed "tm:<sha1 of the English text>"
+    3. googletrans, called once per response with every remaining string;
+       results are written back to Localization for every worker
+
+Only fields listed in TRANSLATABLE_FIELDS are translated, so identifiers
+such as epic_number, unique_code or phone are returned untouched. Common
+values (states, constituencies, booths, choice labels) can be loaded ahead
+of time with `manage.py warm_translations`.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from googletrans import Translator
+
+from .models import Localization
+
+TRANSLATABLE_FIELDS = {
+    "name", "relative_name", "relation_type", "gender", "address", "status",
+    "state", "constituency", "booth",
+}
+TRANSLATION_CACHE_SIZE = getattr(settings, "TRANSLATION_CACHE_SIZE", 100000)
+TRANSLATE_TIMEOUT = 5
+KEY_PREFIX = "tm:"
+
+
+def memory_key(text):
+    return KEY_PREFIX + hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def is_translatable(text):
+    # Nothing to translate in numbers, codes or punctuation
+    return isinstance(text, str) and any(ch.isalpha() for ch in text)
+
+
+class TranslationMemory:
+    def __init__(self, max_entries=TRANSLATION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._translator = None
+
+    def _cached(self, texts):
+        found = {}
+        with self._lock:
+            for text in texts:
+                value = self.entries.get(text)
+                if value is not None:
+                    self.entries.move_to_end(text)
+                    found[text] = value
+            self.hits += len(found)
+            self.misses += len(texts) - len(found)
+        return found
+
+    def _remember(self, translations):
+        with self._lock:
+            for text, value in translations.items():
+                self.entries[text] = value
+                self.entries.move_to_end(text)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _stored(self, texts):
+        keys = {memory_key(text): text for text in texts}
+        rows = Localization.objects.filter(key_name__in=list(keys), hindi_text__isnull=False)
+        return {keys[key]: hindi for key, hindi in rows.values_list("key_name", "hindi_text")}
+
+    def _translate(self, texts):
+        if self._translator is None:
+            self._translator = Translator(timeout=TRANSLATE_TIMEOUT)
+        try:
+            results = self._translator.translate(list(texts), dest="hi")
+        except Exception:
+            return {}
+        translations = {text: result.text for text, result in zip(texts, results)}
+        Localization.objects.bulk_create(
+            [Localization(key_name=memory_key(text), english_text=text, hindi_text=hindi)
+             for text, hindi in translations.items()],
+            ignore_conflicts=True,
+        )
+        return translations
+
+    def lookup_many(self, texts):
+        """{text: hindi} for every distinct text; untranslatable ones map to themselves."""
+        texts = {text for text in texts if is_translatable(text)}
+        translations = self._cached(texts)
+        missing = texts - translations.keys()
+        if missing:
+            stored = self._stored(missing)
+            missing -= stored.keys()
+            if missing:
+                stored.update(self._translate(sorted(missing)))
+            self._remember(stored)
+            translations.update(stored)
+        return translations
+
+    def stats(self):
+        return {"entries": len(self.entries), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses}
+
+
+memory = TranslationMemory()
+
+
+def translate_records_to_hindi(records):
+    """Translate the translatable fields of many serialized records with one lookup."""
+    texts = {record[field] for record in records for field in TRANSLATABLE_FIELDS
+             if isinstance(record.get(field), str)}
+    translations = memory.lookup_many(texts)
+    return [
+        {k: translations.get(v, v) if k in TRANSLATABLE_FIELDS and isinstance(v, str) else v
+         for k, v in record.items()}
+        for record in records
+    ]
+
+
+def translate_data_to_hindi(data):
+    return translate_records_to_hindi([data])[0]
+
+
+def translate_list_to_hindi(data):
+    # Works with both plain and paginated list responses
+    if isinstance(data, dict) and "results" in data:
+        return {**data, "results": translate_records_to_hindi(data["results"])}
+    return translate_records_to_hindi(list(data))
@@ -8,6 +8,11 @@ urlpatterns = [
     path("update/<int:pk>/", VoterUpdateAPI.as_view()),
     path("delete/<int:pk>/", VoterDeleteAPI.as_view()),
     path("search/", VoterSearchAPI.as_view()),
+    path("search/age/", VoterAgeSearchAPI.as_view()),
+    path("search/age/bands/", AgeBandCountsAPI.as_view()),
+    path("analytics/voters/", VoterCountsAPI.as_view()),
+    path("analytics/summary/", VoterSummaryAPI.as_view()),
+    path("analytics/trend/", VoterTrendAPI.as_view()),
     path("download/<int:pk>/", VoterDownloadAPI.as_view()),
 
     #path('', views.VoterListCreate.as_view(), name='voter_list_create'), 
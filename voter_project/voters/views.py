@@ -1,38 +1,30 @@
 from rest_framework import generics
 from .models import *
-from .serializers import VoterSerializer
+from .serializers import VoterReadEncoder, VoterSerializer
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 import pdfkit  # pip install pdfkit
-from django.db.models import Q
+from django.db.models import Count, Q
 from rest_framework.generics import ListAPIView
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.negotiation import DefaultContentNegotiation
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from googletrans import Translator
 from django.contrib.gis.geoip2 import GeoIP2
 from io import BytesIO
-from django.http import FileResponse
-from googletrans import Translator
+from django.http import FileResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+import json
+from datetime import date
 from io import BytesIO
 from weasyprint import HTML
 from django.template.loader import render_to_string
-from xhtml2pdf import pisa
-
-translator = Translator()
-
-def translate_data_to_hindi(data):
-    hindi_data = {}
-    for k, v in data.items():
-        if isinstance(v, str):
-            try:
-                # synchronous translation
-                hindi_data[k] = translator.translate(v, dest="hi").text
-            except Exception:
-                # fallback to original text if translation fails
-                hindi_data[k] = v
-        else:
-            hindi_data[k] = v
-    return hindi_data
+from concurrent.futures import TimeoutError as RenderTimeout
+from .pdf_cache import PdfBusy, cache as pdf_cache
+from .translation import translate_data_to_hindi, translate_list_to_hindi
+from . import search_index
+from .pagination import KeysetPagination
+from . import ages, stats
 
 ##CRUD API
 #class VoterListCreate (generics.ListCreateAPIView): 
@@ -66,15 +58,19 @@ class VoterGetAPI(generics.RetrieveAPIView):
     serializer_class = VoterSerializer
 
     def retrieve(self, request, *args, **kwargs):
+        # One query: the voter row with its state, constituency and booth names
         lang = request.GET.get("lang", "en")
-
-        response = super().retrieve(request, *args, **kwargs)
+        encoder = VoterReadEncoder()
+        row = encoder.values(self.get_queryset().filter(pk=kwargs["pk"])).first()
+        if row is None:
+            raise NotFound()
+        data = encoder.encode_row(row)
 
         # convert fields
         if lang == "hi":
-            response.data = translate_data_to_hindi(response.data)
+            data = translate_data_to_hindi(data)
 
-        return response
+        return Response(data)
 
 class VoterUpdateAPI(generics.UpdateAPIView):
     queryset = Voter.objects.all()
@@ -85,53 +81,293 @@ class VoterDeleteAPI(generics.DestroyAPIView):
     serializer_class = VoterSerializer
 
 
+STREAM_CHUNK_SIZE = 2000
+
 class VoterSearchAPI(ListAPIView):
+    """
+    Name / phone / EPIC / code match as substrings. Once the search index is
+    built they resolve to ids there first: pages in the default id order and
+    ?stream=1 walk the whole result through the index; ?order=name|created
+    sorts at most VOTER_SEARCH_LIMIT matches and says "truncated" when there
+    were more. Streams of indexed searches come in id order.
+    """
     serializer_class = VoterSerializer
+    pagination_class = KeysetPagination
 
-    def get_queryset(self):
-        qs = Voter.objects.filter(status='active')
+    def search_terms(self):
+        return {term: self.request.GET.get(term) for term in ("name", "phone", "epic", "code")}
+
+    def base_queryset(self):
+        qs = Voter.objects.filter(status='active').select_related('state', 'constituency', 'booth')
         
         constituency = self.request.GET.get("constituency")
         booth = self.request.GET.get("booth")
-        phone = self.request.GET.get("phone")
-        name = self.request.GET.get("name")
-        epic = self.request.GET.get("epic")
-        code = self.request.GET.get("code")
         
          # 🔵 Search by constituency
         if constituency:
-            qs = qs.filter(constituency__icontains=constituency)
+            qs = qs.filter(constituency__name__icontains=constituency)
 
         # 🔵 Search by booth
         if booth:
-            qs = qs.filter(booth__icontains=booth)
-            
-        if phone and name:
-            qs = qs.filter(Q(phone__icontains=phone) & Q(name__icontains=name))
-        if epic:
-            qs = qs.filter(epic_number__icontains=epic)
-        if code:
-            qs = qs.filter(unique_code__icontains=code)
+            qs = qs.filter(booth__name__icontains=booth)
 
         return qs
 
+    def get_queryset(self):
+        # Index not built yet: the same matches by scanning
+        qs = self.base_queryset()
+        terms = self.search_terms()
+        if terms["name"]:
+            qs = qs.filter(name__icontains=terms["name"].strip())
+        if terms["phone"]:
+            # Digits only, as the index stores and matches phone numbers
+            phone = search_index.KEY_NORMALIZERS["phone"](terms["phone"])
+            qs = qs.filter(phone__icontains=phone) if phone else qs.none()
+        if terms["epic"]:
+            qs = qs.filter(epic_number__icontains=terms["epic"].strip())
+        if terms["code"]:
+            qs = qs.filter(unique_code__icontains=terms["code"].strip())
+        return qs
+
     def list(self, request, *args, **kwargs):
+        # A page is one query (plus the index lookups): rows come from
+        # VoterReadEncoder.values(), never through VoterSerializer
         lang = request.GET.get("lang", "en")
+        encoder = VoterReadEncoder()
+        terms = self.search_terms()
+        indexed = search_index.index.serves(**terms)
+        stream = request.GET.get("stream") == "1"
+
+        if indexed:
+            queryset = encoder.values(self.filter_queryset(self.base_queryset()))
+
+            def fetch(ids):
+                return list(queryset.filter(pk__in=ids).order_by("id"))
+
+            if stream:
+                rows = (row for ids in search_index.index.search_all(**terms) for row in fetch(ids))
+                return self.stream_response(rows, encoder, lang)
+            if self.paginator.get_ordering(request) == "id":
+                rows = self.paginator.paginate_ids(
+                    lambda after, limit: search_index.index.search(**terms, after=after, limit=limit),
+                    fetch, request)
+                return self.page_response(rows, encoder, lang)
+            ids = search_index.index.search(**terms, limit=search_index.SEARCH_LIMIT + 1)
+            self.paginator.truncated = len(ids) > search_index.SEARCH_LIMIT
+            queryset = queryset.filter(pk__in=ids[:search_index.SEARCH_LIMIT])
+        else:
+            queryset = encoder.values(self.filter_queryset(self.get_queryset()))
+            if stream:
+                rows = self.paginator.order_queryset(queryset, request).iterator(chunk_size=STREAM_CHUNK_SIZE)
+                return self.stream_response(rows, encoder, lang)
+
+        return self.page_response(self.paginate_queryset(queryset), encoder, lang)
 
-        response = super().list(request, *args, **kwargs)
+    def page_response(self, rows, encoder, lang):
+        data = encoder.encode(rows)
         if lang == "hi":
-            response.data = translate_list_to_hindi(response.data)
+            data = translate_list_to_hindi(data)
+        return self.get_paginated_response(data)
+
+    def stream_response(self, rows, encoder, lang):
+        # ?stream=1: the whole result as NDJSON, one voter per line, in flat memory
+        response = StreamingHttpResponse(self.stream_ndjson(rows, encoder, lang),
+                                         content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="voters.ndjson"'
         return response
 
+    def stream_ndjson(self, rows, encoder, lang, chunk_size=STREAM_CHUNK_SIZE):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield self.render_chunk(chunk, encoder, lang)
+                chunk = []
+        if chunk:
+            yield self.render_chunk(chunk, encoder, lang)
+
+    def render_chunk(self, rows, encoder, lang):
+        data = encoder.encode(rows)
+        if lang == "hi":
+            data = translate_list_to_hindi(data)
+        return "".join(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + "\n" for row in data)
+
+##===========================================
+# Age-range / cohort search
+##===========================================
+# "Age A to B as of year Y" (GetAgeOnYear in Voting_DB.sql) becomes a
+# date_of_birth range, so the filter is a range scan on the
+# (constituency, date_of_birth) / (booth, date_of_birth) indexes instead of
+# an age computed per row.
+
+DEFAULT_AGE_BANDS = "18-19,20-29,30-39,40-49,50-59,60-69,70-79,80-"
+MAX_AGE_BANDS = 20
+# Ages and ?year= beyond these would shift dates past what date() can hold
+MAX_AGE = 200
+MIN_YEAR = 1900
+MAX_YEARS_AHEAD = 100
+
+
+def int_param(request, name, default=None, minimum=0, maximum=None):
+    value = request.GET.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError({name: "Must be a whole number."})
+    if value < minimum:
+        raise ValidationError({name: f"Must be at least {minimum}."})
+    if maximum is not None and value > maximum:
+        raise ValidationError({name: f"Must be at most {maximum}."})
+    return value
+
+
+def year_param(request):
+    return int_param(request, "year", minimum=MIN_YEAR, maximum=date.today().year + MAX_YEARS_AHEAD)
+
+
+def age_filters(request):
+    """Voter filters shared by the age search and the band counts."""
+    filters = {"status": "active"}
+    gender = request.GET.get("gender")
+    if gender:
+        filters["gender"] = gender
+    constituency = int_param(request, "constituency", minimum=1)
+    if constituency is not None:
+        filters["constituency_id"] = constituency
+    booth = int_param(request, "booth", minimum=1)
+    if booth is not None:
+        filters["booth_id"] = booth
+    return filters
+
+
+def parse_band(band):
+    """'18-25' -> (18, 25); '60-' -> (60, None)."""
+    low, sep, high = band.strip().partition("-")
+    try:
+        low, high = int(low), (int(high) if high else None)
+    except ValueError:
+        raise ValidationError({"bands": f"Invalid band {band!r}; use e.g. 18-25 or 80-."})
+    if not sep or low < 0 or (high is not None and not low <= high <= MAX_AGE) or low > MAX_AGE:
+        raise ValidationError({"bands": f"Invalid band {band!r}; use e.g. 18-25 or 80-."})
+    return low, high
+
+
+class VoterAgeSearchAPI(VoterSearchAPI):
+    """
+    ?min_age=&max_age=&year=  plus optional gender, constituency (id), booth (id).
+    Ages are as of today's calendar day in `year` (default: this year).
+    Paging, ?order= and ?stream=1 work as in VoterSearchAPI.
+    """
+
+    def search_terms(self):
+        return {}  # never served by the search index
+
+    def get_queryset(self):
+        request = self.request
+        min_age = int_param(request, "min_age", maximum=MAX_AGE)
+        max_age = int_param(request, "max_age", maximum=MAX_AGE)
+        if min_age is None and max_age is None:
+            raise ValidationError({"min_age": "Give min_age, max_age or both."})
+        if min_age is not None and max_age is not None and max_age < min_age:
+            raise ValidationError({"max_age": "Must not be less than min_age."})
+        year = year_param(request)
+        return Voter.objects.filter(**age_filters(request), **ages.dob_range(min_age, max_age, year=year))
+
+
+class AgeBandCountsAPI(APIView):
+    """
+    Voter counts per age band in one query:
+    ?bands=18-19,20-29,80-&year=  plus optional gender, constituency (id), booth (id).
+    """
+
+    def get(self, request):
+        bands = [parse_band(band) for band in request.GET.get("bands", DEFAULT_AGE_BANDS).split(",") if band.strip()]
+        if not bands or len(bands) > MAX_AGE_BANDS:
+            raise ValidationError({"bands": f"Give between 1 and {MAX_AGE_BANDS} bands."})
+        year = year_param(request)
+        today = date.today()
+
+        # Only the span covered by the bands is read, then each band is a
+        # conditional count over it
+        lowest = min(low for low, _ in bands)
+        highest = None if any(high is None for _, high in bands) else max(high for _, high in bands)
+        qs = Voter.objects.filter(**age_filters(request), **ages.dob_range(lowest, highest, today, year))
+        labels = [f"{low}-{'' if high is None else high}" for low, high in bands]
+        counts = qs.aggregate(**{
+            f"band_{i}": Count("id", filter=Q(**ages.dob_range(low, high, today, year)))
+            for i, (low, high) in enumerate(bands)
+        })
+        return Response({
+            "year": year or today.year,
+            "bands": [
+                {"band": label, "min_age": low, "max_age": high, "count": counts[f"band_{i}"]}
+                for i, (label, (low, high)) in enumerate(zip(labels, bands))
+            ],
+        })
+
+##===========================================
+# Analytics (read-only, from the voters/stats.py aggregate tables)
+##===========================================
+
+def stats_filters(request):
+    filters = {}
+    for name in ("state", "constituency", "booth"):
+        value = int_param(request, name, minimum=1)
+        if value is not None:
+            filters[f"{name}_id"] = value
+    if request.GET.get("gender"):
+        filters["gender"] = request.GET["gender"]
+    status = request.GET.get("status", "active")
+    if status != "all":
+        filters["status"] = status
+    return filters
+
+
+class VoterCountsAPI(APIView):
+    """
+    ?group_by=state,gender,age_band  (state, constituency, booth, gender, status, age_band)
+    plus optional state, constituency, booth (ids), gender, status (default active; "all"),
+    bands (for age_band, as in search/age/bands/) and year.
+    """
+
+    def get(self, request):
+        group_by = [d.strip() for d in request.GET.get("group_by", "state").split(",") if d.strip()]
+        bands = [parse_band(band) for band in request.GET.get("bands", DEFAULT_AGE_BANDS).split(",") if band.strip()]
+        year = year_param(request)
+        try:
+            rows = stats.counts(group_by, stats_filters(request), bands, year)
+        except stats.StatsQueryError as exc:
+            raise ValidationError({"group_by": str(exc)})
+        return Response({"group_by": group_by, "results": rows})
+
+
+class VoterSummaryAPI(APIView):
+    """Totals, under-18 and over-100 counts, largest/smallest state and constituency, 7-day trend."""
+
+    def get(self, request):
+        year = year_param(request)
+        return Response(stats.summary(request.GET.get("status", "active"), year))
+
+
+class VoterTrendAPI(APIView):
+    """New registrations per day: ?days=7&state=<id>."""
+
+    def get(self, request):
+        days = int_param(request, "days", stats.TREND_DAYS, minimum=1)
+        if days > 366:
+            raise ValidationError({"days": "At most 366."})
+        return Response(stats.trend(days, int_param(request, "state", minimum=1)))
+
 def get_age(dob):
     from datetime import date 
-    today = date.today()
-    return today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+    return ages.age_on(dob, date.today())
 
 def generate_voter_pdf(request, voter, lang='en'):
     """
-    Generate PDF for a voter using WeasyPrint.
-    Logs the download event.
+    Open the voter's PDF, from the PDF cache or rendered in its worker pool
+    (voters/pdf_cache.py). Logs the download event.
     """
     # Log download
     LoginLog.objects.create(
@@ -154,39 +390,39 @@ def generate_voter_pdf(request, voter, lang='en'):
         'lang': lang
     }
 
-    html_string = render_to_string(template, context)
-    pdf_file = BytesIO()
-    pisa_status = pisa.CreatePDF(html, dest=pdf_file)
-    if pisa_status.err:
-        raise Exception("PDF generation failed")
+    path = pdf_cache.get(voter, lang, render_to_string(template, context))
+    return open(path, 'rb')
 
-    pdf_file.seek(0)
-    return pdf_file
+class DownloadContentNegotiation(DefaultContentNegotiation):
+    # ?format=json|pdf is read by VoterDownloadAPI itself, not DRF's renderer override
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
 
 class VoterDownloadAPI(APIView):
+    content_negotiation_class = DownloadContentNegotiation
+
     def get(self, request, pk):
         lang = request.GET.get("lang", "en")
         fmt = request.GET.get("format", "json")
         epic = request.GET.get('epic')
         phone = request.GET.get('phone')
         
-        # Fetch voter
-        try:
-            if epic:
-                voter = Voter.objects.get(epic_number=epic)
-            elif phone:
-                voter = Voter.objects.get(phone=phone)
-            elif pk:
-                voter = Voter.objects.get(pk=pk)
-                print("voter:",voter)
-            else:
-                return Response({"error": "No identifier provided"}, status=400)
-        except Voter.DoesNotExist:
-            return Response({"error": "Voter not found"}, status=404)
+        if epic:
+            lookup = {"epic_number": epic}
+        elif phone:
+            lookup = {"phone": phone}
+        elif pk:
+            lookup = {"pk": pk}
+        else:
+            return Response({"error": "No identifier provided"}, status=400)
 
-        # JSON output
+        # JSON output: one query, same read path as VoterGetAPI
         if fmt == "json":
-            data = VoterSerializer(voter).data
+            encoder = VoterReadEncoder()
+            row = encoder.values(Voter.objects.filter(**lookup)).first()
+            if row is None:
+                return Response({"error": "Voter not found"}, status=404)
+            data = encoder.encode_row(row)
             print("data:",data)
             if lang == "hi":
                 data = translate_data_to_hindi(data)
@@ -196,15 +432,22 @@ class VoterDownloadAPI(APIView):
         # PDF output
         elif fmt == "pdf":
             print("PDF branch called")
+            try:
+                voter = Voter.objects.get(**lookup)
+            except Voter.DoesNotExist:
+                return Response({"error": "Voter not found"}, status=404)
             try:
                 pdf_file = generate_voter_pdf(request, voter, lang=lang)
-                print("PDF generated, size:", pdf_file.getbuffer().nbytes)
                 return FileResponse(
                     pdf_file,
                     as_attachment=True,
                     filename=f"voter_{voter.epic_number}.pdf",
                     content_type='application/pdf'
                 )
+            except PdfBusy as e:
+                return Response({"error": str(e)}, status=503, headers={"Retry-After": "5"})
+            except RenderTimeout:
+                return Response({"error": "PDF generation timed out"}, status=504)
             except Exception as e:
                 print("PDF generation error:", e)
                 return Response({"error": f"PDF generation failed: {e}"}, status=500)
@@ -278,10 +521,18 @@ def verify_voter_pdf(request, pk):
 
 #    return HttpResponse(f"OTP sent to {voter.phone}. Valid for 5 minutes.")
 
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait
 from django.views.decorators.csrf import csrf_exempt
+from .ml_client import MLServiceUnavailable, get_ml_client
+
+# Total seconds the face and fingerprint checks may take together
+BIOMETRIC_TIMEOUT = 5
+BIOMETRIC_CHECKS = (("face", "face_image"), ("fingerprint", "fingerprint"))
+biometric_pool = ThreadPoolExecutor(max_workers=8)
 
-FASTAPI_URL = "http://127.0.0.1:8001"
+def verify_biometric(kind, voter_id, data, timeout):
+    """1:1 check of one uploaded sample against the voter's stored template."""
+    return get_ml_client().verify(kind, voter_id, data, timeout=timeout).get("match", False)
 
 @csrf_exempt
 def verify_voter_pdf(request, voter_id):
@@ -295,30 +546,35 @@ def verify_voter_pdf(request, voter_id):
     if str(input_otp) != str(cached_otp):
         return HttpResponse("OTP Verification Failed", status=400)
 
-    # Optional: Face verification
-    face_file = request.FILES.get("face_image")
-    if face_file:
-        resp = requests.post(
-            f"{FASTAPI_URL}/check_duplicate_face/",
-            files={"file": face_file}
-        )
-        data = resp.json()
-        if not data.get("duplicates") or all(d["voter_id"] != voter.id for d in data["duplicates"]):
-            return HttpResponse("Face verification failed", status=400)
-
-    # Optional: Fingerprint verification
-    fingerprint_file = request.FILES.get("fingerprint")
-    if fingerprint_file:
-        resp = requests.post(
-            f"{FASTAPI_URL}/check_duplicate_fingerprint/",
-            files={"file": fingerprint_file}
-        )
-        data = resp.json()
-        if not data.get("match") or data.get("voter_id") != voter.id:
-            return HttpResponse("Fingerprint verification failed", status=400)
+    # Optional: Face / fingerprint verification, run together under one budget
+    futures = {
+        kind: biometric_pool.submit(verify_biometric, kind, voter.id, upload.read(), BIOMETRIC_TIMEOUT)
+        for kind, field in BIOMETRIC_CHECKS
+        if (upload := request.FILES.get(field))
+    }
+    done, _ = wait(futures.values(), timeout=BIOMETRIC_TIMEOUT)
+    for kind, future in futures.items():
+        if future not in done:
+            return HttpResponse("Biometric verification timed out", status=504)
+        try:
+            matched = future.result()
+        except MLServiceUnavailable:
+            return HttpResponse("Biometric service unavailable", status=503)
+        if not matched:
+            return HttpResponse(f"{kind.capitalize()} verification failed", status=400)
 
     # OTP + biometric passed → Generate PDF
-    return generate_voter_pdf(request, voter.id)
-
-
-
+    try:
+        pdf_file = generate_voter_pdf(request, voter)
+    except PdfBusy as e:
+        response = HttpResponse(str(e), status=503)
+        response["Retry-After"] = "5"
+        return response
+    except RenderTimeout:
+        return HttpResponse("PDF generation timed out", status=504)
+    return FileResponse(
+        pdf_file,
+        as_attachment=True,
+        filename=f"voter_{voter.epic_number}.pdf",
+        content_type='application/pdf'
+    )